@@ -1,10 +1,12 @@
 from typing import Final
-from pymongo import MongoClient
 from flask import Flask, jsonify, request
 from flask_cors import cross_origin
 from pymongo.errors import DuplicateKeyError
 
 from movieship.auth import AuthError, decorate_requires_auth, requires_scope
+from movieship.cache import cached_response
+from movieship.connection import ProcessClient
+from movieship.serialization import OrjsonProvider
 
 from movieship.controllers.root import *
 from movieship.controllers import root, profile
@@ -12,11 +14,14 @@ from movieship.controllers import explore
 from movieship.controllers import review
 from movieship.controllers import watchlist
 from movieship.exceptions import ResourceNotFoundException, DisplayNameDuplicateException, ProfileNotValidException, \
-    ProfileAlreadyExistsException
+    ProfileAlreadyExistsException, InvalidPaginationException, TooManyIdentifiersException, \
+    InvalidFieldException
 
-MONGO: Final[MongoClient] = MongoClient("mongodb://127.0.0.1:27017")
+# connects lazily in each process, so it is safe to import before the workers fork
+MONGO: Final[ProcessClient] = ProcessClient()
 
 APP: Final[Flask] = Flask(__name__)
+APP.json = OrjsonProvider(APP)
 
 
 @APP.errorhandler(AuthError)
@@ -26,20 +31,59 @@ def handle_auth_error(ex):
     return response
 
 
+@APP.errorhandler(InvalidPaginationException)
+def handle_invalid_pagination(ex):
+    return make_response(jsonify(ApiResponse(None, [{"error": "InvalidPaginationException", "code": 1}])), 400)
+
+
+@APP.errorhandler(InvalidFieldException)
+def handle_invalid_field(ex):
+    return make_response(jsonify(ApiResponse(None, [{"error": "InvalidFieldException", "code": 9}])), 400)
+
+
 @APP.route(API_ROOT_PATH, methods=['GET'])
 @cross_origin()
 def root():
     return make_response(jsonify(ApiResponse(routes(), [])), 200)
 
 
+@APP.route(STATS_PATH, methods=['GET'])
+@cross_origin()
+def stats():
+    return make_response(jsonify(ApiResponse({
+        'explore_cache': explore.EXPLORE_RESPONSE_CACHE.stats(),
+        'posters': explore.POSTER_ENRICHER.stats(),
+        'autocomplete': explore.TITLE_AUTOCOMPLETE.stats(),
+        'catalog': explore.CATALOG_SNAPSHOTS.stats(),
+    }, [])), 200)
+
+
 @APP.route(EXPLORE_PATH, methods=['GET'])
 @cross_origin("http://localhost:4200")
+@cached_response(explore.EXPLORE_RESPONSE_CACHE)
 def explore_listing():
     return make_response(jsonify(ApiResponse(explore.get_list(MONGO), [])), 200)
 
 
+@APP.route(EXPLORE_BATCH_PATH, methods=['GET'])
+@cross_origin()
+@cached_response(explore.EXPLORE_RESPONSE_CACHE)
+def explore_batch():
+    try:
+        return make_response(jsonify(ApiResponse(explore.get_batch(MONGO), [])), 200)
+    except TooManyIdentifiersException:
+        return make_response(jsonify(ApiResponse(None, [{"error": "TooManyIdentifiersException", "code": 8}])), 400)
+
+
+@APP.route(EXPLORE_AUTOCOMPLETE_PATH, methods=['GET'])
+@cross_origin()
+def explore_autocomplete():
+    return make_response(jsonify(ApiResponse(explore.autocomplete(MONGO), [])), 200)
+
+
 @APP.route(EXPLORE_RESOURCE_PATH, methods=['GET'])
 @cross_origin()
+@cached_response(explore.EXPLORE_RESPONSE_CACHE)
 def explore_resource(imdb_id):
     return make_response(jsonify(ApiResponse(explore.get_resource(MONGO, imdb_id), [])), 200)
 
@@ -73,6 +117,16 @@ def watchlist_update(watchlist_id):
     return make_response(jsonify(ApiResponse(watchlist.update(MONGO, watchlist_id), [])), 200)
 
 
+@APP.route(WATCHLIST_MOVIES_PATH, methods=['GET'])
+@cross_origin()
+@decorate_requires_auth
+def watchlist_movies(watchlist_id):
+    try:
+        return make_response(jsonify(ApiResponse(watchlist.get_movies(MONGO, watchlist_id), [])), 200)
+    except ResourceNotFoundException:
+        return make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])), 404)
+
+
 @APP.route(WATCHLIST_DELETE_PATH, methods=['POST'])
 @cross_origin()
 @decorate_requires_auth
@@ -137,7 +191,30 @@ def profile_resource():
 @cross_origin()
 @decorate_requires_auth
 def profile_add_to_watch_list():
-    return make_response(jsonify(ApiResponse(profile.add_to_watchlist(MONGO), [])), 200)
+    try:
+        return make_response(jsonify(ApiResponse(profile.add_to_watchlist(MONGO), [])), 200)
+    except ResourceNotFoundException:
+        return make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])), 404)
+
+
+@APP.route(PROFILE_REMOVE_FROM_WATCH_LIST_PATH, methods=['POST'])
+@cross_origin()
+@decorate_requires_auth
+def profile_remove_from_watch_list():
+    try:
+        return make_response(jsonify(ApiResponse(profile.remove_from_watchlist(MONGO), [])), 200)
+    except ResourceNotFoundException:
+        return make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])), 404)
+
+
+@APP.route(PROFILE_WATCH_LIST_MOVIES_PATH, methods=['GET'])
+@cross_origin()
+@decorate_requires_auth
+def profile_watch_list_movies():
+    try:
+        return make_response(jsonify(ApiResponse(profile.get_watchlist_movies(MONGO), [])), 200)
+    except ResourceNotFoundException:
+        return make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])), 404)
 
 
 @APP.route(PROFILE_CREATE_PATH, methods=['POST'])
@@ -0,0 +1,276 @@
+from typing import Final
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
+from quart_cors import route_cors
+
+from movieship.auth import AuthError, decorate_requires_auth_async, JWKS_CACHE
+from movieship.cache import cached_response_async
+from movieship.connection import MONGO_URI, mongo_options
+from movieship.serialization import OrjsonProvider
+
+from movieship.controllers.root import *
+from movieship.controllers import root, profile
+from movieship.controllers import explore
+from movieship.controllers import review
+from movieship.controllers import watchlist
+from movieship.exceptions import ResourceNotFoundException, DisplayNameDuplicateException, ProfileNotValidException, \
+    ProfileAlreadyExistsException, InvalidPaginationException, TooManyIdentifiersException, \
+    InvalidFieldException
+# after the star import, which brings Flask's jsonify and make_response
+from quart import Quart, jsonify, request, make_response
+
+# the async serving mode, same routes and responses as app.py: hypercorn asgi:APP
+MONGO: Final[AsyncIOMotorClient] = AsyncIOMotorClient(MONGO_URI, **mongo_options())
+
+APP: Final[Quart] = Quart(__name__)
+APP.json = OrjsonProvider(APP)
+
+
+@APP.before_serving
+async def resume_renames():
+    profile.PROFILE_RENAMES.resume(MONGO.delegate)
+
+
+@APP.before_serving
+async def load_autocomplete():
+    explore.TITLE_AUTOCOMPLETE.load(MONGO.delegate)
+    explore.TITLE_AUTOCOMPLETE.start(MONGO.delegate)
+
+
+@APP.before_serving
+async def poll_cache_invalidations():
+    explore.EXPLORE_RESPONSE_CACHE.start(MONGO.delegate)
+
+
+@APP.after_serving
+async def close_clients():
+    await JWKS_CACHE.aclose()
+    MONGO.close()
+
+
+@APP.errorhandler(AuthError)
+async def handle_auth_error(ex):
+    response = jsonify(ex.error)
+    response.status_code = ex.status_code
+    return response
+
+
+@APP.errorhandler(InvalidPaginationException)
+async def handle_invalid_pagination(ex):
+    return await make_response(jsonify(ApiResponse(None, [{"error": "InvalidPaginationException", "code": 1}])), 400)
+
+
+@APP.errorhandler(InvalidFieldException)
+async def handle_invalid_field(ex):
+    return await make_response(jsonify(ApiResponse(None, [{"error": "InvalidFieldException", "code": 9}])), 400)
+
+
+@APP.route(API_ROOT_PATH, methods=['GET'])
+@route_cors()
+async def root():
+    return await make_response(jsonify(ApiResponse(routes(), [])), 200)
+
+
+@APP.route(STATS_PATH, methods=['GET'])
+@route_cors()
+async def stats():
+    return await make_response(jsonify(ApiResponse({
+        'explore_cache': explore.EXPLORE_RESPONSE_CACHE.stats(),
+        'posters': explore.POSTER_ENRICHER.stats(),
+        'autocomplete': explore.TITLE_AUTOCOMPLETE.stats(),
+        'catalog': explore.CATALOG_SNAPSHOTS.stats(),
+    }, [])), 200)
+
+
+@APP.route(EXPLORE_PATH, methods=['GET'])
+@route_cors(allow_origin="http://localhost:4200")
+@cached_response_async(explore.EXPLORE_RESPONSE_CACHE)
+async def explore_listing():
+    return await make_response(jsonify(ApiResponse(await explore.get_list_async(MONGO), [])), 200)
+
+
+@APP.route(EXPLORE_BATCH_PATH, methods=['GET'])
+@route_cors()
+@cached_response_async(explore.EXPLORE_RESPONSE_CACHE)
+async def explore_batch():
+    try:
+        return await make_response(jsonify(ApiResponse(await explore.get_batch_async(MONGO), [])), 200)
+    except TooManyIdentifiersException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "TooManyIdentifiersException", "code": 8}])),
+                                   400)
+
+
+@APP.route(EXPLORE_AUTOCOMPLETE_PATH, methods=['GET'])
+@route_cors()
+async def explore_autocomplete():
+    return await make_response(jsonify(ApiResponse(await explore.autocomplete_async(MONGO), [])), 200)
+
+
+@APP.route(EXPLORE_RESOURCE_PATH, methods=['GET'])
+@route_cors()
+@cached_response_async(explore.EXPLORE_RESPONSE_CACHE)
+async def explore_resource(imdb_id):
+    return await make_response(jsonify(ApiResponse(await explore.get_resource_async(MONGO, imdb_id), [])), 200)
+
+
+@APP.route(WATCHLIST_PATH, methods=['GET'])
+@route_cors()
+@decorate_requires_auth_async
+async def watchlist_listing():
+    return await make_response(jsonify(ApiResponse(await watchlist.get_list_async(MONGO), [])), 200)
+
+
+@APP.route(WATCHLIST_CREATE_PATH, methods=['POST'])
+@route_cors()
+@decorate_requires_auth_async
+async def watchlist_create():
+    try:
+        return await make_response(jsonify(ApiResponse(await watchlist.create_resource_async(MONGO), [])), 200)
+    except DuplicateKeyError:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "WatchlistAlreadyExistsWithName",
+                                                               "code": 5}])), 400)
+
+
+@APP.route(WATCHLIST_RESOURCE_PATH, methods=['POST'])
+@route_cors()
+@decorate_requires_auth_async
+async def watchlist_update(watchlist_id):
+    return await make_response(jsonify(ApiResponse(await watchlist.update_async(MONGO, watchlist_id), [])), 200)
+
+
+@APP.route(WATCHLIST_MOVIES_PATH, methods=['GET'])
+@route_cors()
+@decorate_requires_auth_async
+async def watchlist_movies(watchlist_id):
+    try:
+        return await make_response(jsonify(ApiResponse(await watchlist.get_movies_async(MONGO, watchlist_id), [])),
+                                   200)
+    except ResourceNotFoundException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])),
+                                   404)
+
+
+@APP.route(WATCHLIST_DELETE_PATH, methods=['POST'])
+@route_cors()
+@decorate_requires_auth_async
+async def watchlist_delete(watchlist_id):
+    try:
+        return await make_response(jsonify(ApiResponse(await watchlist.delete_resource_async(MONGO, watchlist_id),
+                                                       [])), 200)
+    except ResourceNotFoundException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])),
+                                   404)
+
+
+@APP.route(REVIEW_LISTING_PATH, methods=['GET'])
+@route_cors()
+async def review_listing(imdb_id):
+    return await make_response(jsonify(ApiResponse(await review.get_list_async(MONGO, imdb_id), [])), 200)
+
+
+@APP.route(REVIEW_PATH, methods=['GET', 'POST'])
+@route_cors()
+@decorate_requires_auth_async
+async def comments_resource_delete_update(imdb_id):
+    if request.method == 'POST':
+        return await make_response(jsonify(ApiResponse(await review.update_resource_async(MONGO, imdb_id), [])), 200)
+    else:
+        try:
+            return await make_response(jsonify(ApiResponse(await review.get_resource_async(MONGO, imdb_id), [])),
+                                       200)
+        except ResourceNotFoundException:
+            return await make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException",
+                                                                   "code": 2}])), 404)
+
+
+@APP.route(REVIEW_DELETE_PATH, methods=['POST'])
+@route_cors()
+@decorate_requires_auth_async
+async def review_delete(imdb_id):
+    return await make_response(jsonify(ApiResponse(await review.delete_resource_async(MONGO, imdb_id), [])), 200)
+
+
+@APP.route(REVIEW_CREATE_PATH, methods=['POST'])
+@route_cors()
+@decorate_requires_auth_async
+async def review_create(imdb_id):
+    try:
+        return await make_response(jsonify(ApiResponse(await review.create_resource_async(MONGO, imdb_id), [])),
+                                   200)
+    except ResourceNotFoundException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])),
+                                   404)
+    except ProfileNotValidException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "ProfileNotValidException", "code": 3}])),
+                                   400)
+
+
+@APP.route(PROFILE_PATH_RESOURCE, methods=['GET'])
+@route_cors()
+@decorate_requires_auth_async
+async def profile_resource():
+    try:
+        return await make_response(jsonify(ApiResponse(await profile.get_resource_async(MONGO), [])), 200)
+    except ResourceNotFoundException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])),
+                                   404)
+
+
+@APP.route(PROFILE_ADD_TO_WATCH_LIST_PATH, methods=['POST'])
+@route_cors()
+@decorate_requires_auth_async
+async def profile_add_to_watch_list():
+    try:
+        return await make_response(jsonify(ApiResponse(await profile.add_to_watchlist_async(MONGO), [])), 200)
+    except ResourceNotFoundException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])),
+                                   404)
+
+
+@APP.route(PROFILE_REMOVE_FROM_WATCH_LIST_PATH, methods=['POST'])
+@route_cors()
+@decorate_requires_auth_async
+async def profile_remove_from_watch_list():
+    try:
+        return await make_response(jsonify(ApiResponse(await profile.remove_from_watchlist_async(MONGO), [])), 200)
+    except ResourceNotFoundException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])),
+                                   404)
+
+
+@APP.route(PROFILE_WATCH_LIST_MOVIES_PATH, methods=['GET'])
+@route_cors()
+@decorate_requires_auth_async
+async def profile_watch_list_movies():
+    try:
+        return await make_response(jsonify(ApiResponse(await profile.get_watchlist_movies_async(MONGO), [])), 200)
+    except ResourceNotFoundException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "ResourceNotFoundException", "code": 2}])),
+                                   404)
+
+
+@APP.route(PROFILE_CREATE_PATH, methods=['POST'])
+@route_cors()
+@decorate_requires_auth_async
+async def profile_create():
+    try:
+        return await make_response(jsonify(ApiResponse(await profile.create_async(MONGO), [])), 200)
+    except ProfileAlreadyExistsException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "ProfileAlreadyExistsException",
+                                                               "code": 6}])), 404)
+
+
+@APP.route(PROFILE_PATH_RESOURCE, methods=['POST'])
+@route_cors()
+@decorate_requires_auth_async
+async def profile_update():
+    try:
+        return await make_response(jsonify(ApiResponse(await profile.update_async(MONGO), [])), 200)
+    except DisplayNameDuplicateException:
+        return await make_response(jsonify(ApiResponse(None, [{"error": "DisplayNameDuplicateException",
+                                                               "code": 3}])), 404)
+
+
+if __name__ == '__main__':
+    APP.run(debug=True)
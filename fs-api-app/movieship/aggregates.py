@@ -0,0 +1,224 @@
+from dataclasses import dataclass, field
+from typing import Final, Mapping, Iterator
+
+import pymongo
+from pymongo import UpdateOne
+
+from movieship.importer import batched
+
+REVIEW_STATS_FIELD: Final[str] = 'reviewStats'
+REVIEW_STATS_TRACKED_FIELDS: Final[tuple[str, ...]] = ('rating', 'timestamp')
+REVIEW_STATS_PROJECTION: Final[dict[str, int]] = {'_id': 0, **{field: 1 for field in REVIEW_STATS_TRACKED_FIELDS}}
+REVIEW_STATS_WRITE_BATCH_SIZE: Final[int] = 1000
+REVIEW_LATEST_ORDER: Final[list[tuple[str, int]]] = [('timestamp', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+
+def rating_key(rating) -> str | None:
+    """The histogram bucket of a rating, None for reviews without a numeric rating
+    """
+    if isinstance(rating, bool) or not isinstance(rating, (int, float)):
+        return None
+
+    return str(round(rating))
+
+
+def review_delta(before: Mapping | None, after: Mapping | None) -> dict[str, int | float]:
+    """The $inc that moves a title's aggregate from counting `before` to counting `after`
+
+    Either side is None for a created or deleted review.
+    """
+    delta: dict[str, int | float] = {}
+
+    def add(path, value):
+        delta[path] = delta.get(path, 0) + value
+
+    for (review, sign) in ((before, -1), (after, 1)):
+        if review is None:
+            continue
+
+        add('count', sign)
+        key = rating_key(review.get('rating'))
+
+        if key is not None:
+            add('rated', sign)
+            add('sum', sign * review['rating'])
+            add('histogram.' + key, sign)
+
+    return {'{}.{}'.format(REVIEW_STATS_FIELD, path): value for (path, value) in delta.items() if value != 0}
+
+
+def review_update(before: Mapping | None, after: Mapping | None) -> dict | None:
+    """The update applied to the title document, None when the aggregate does not change
+    """
+    update = {}
+
+    delta = review_delta(before, after)
+    if delta:
+        update['$inc'] = delta
+
+    if after is not None and before is None and after.get('timestamp') is not None:
+        update['$max'] = {REVIEW_STATS_FIELD + '.lastReview': after['timestamp']}
+
+    return update or None
+
+
+@dataclass
+class ReviewStats:
+    count: int = 0
+    rated: int = 0
+    sum: int | float = 0
+    histogram: dict[str, int] = field(default_factory=dict)
+    lastReview: int | None = None
+
+    def document(self) -> dict[str, any]:
+        document = {'count': self.count, 'rated': self.rated, 'sum': self.sum, 'histogram': self.histogram}
+        if self.lastReview is not None:
+            document['lastReview'] = self.lastReview
+        return document
+
+    @classmethod
+    def of(cls, document: Mapping | None) -> 'ReviewStats':
+        document = document or {}
+        return cls(document.get('count', 0), document.get('rated', 0), document.get('sum', 0),
+                   {key: value for (key, value) in document.get('histogram', {}).items() if value != 0},
+                   document.get('lastReview'))
+
+
+class ReviewAggregates:
+    """Per-title review count, rating sum, rating histogram and last review time, stored on the title
+
+    Writes move the aggregate with the $inc of the review document they actually inserted, updated or
+    deleted, so concurrent writes never overwrite each other. The review and the title are separate
+    documents, a crash between the two writes is what `check` detects and `rebuild` repairs.
+    """
+
+    def __init__(self, reviews_collection_name: str, titles_collection_name: str, title_field: str):
+        self._reviews_collection_name: Final[str] = reviews_collection_name
+        self._titles_collection_name: Final[str] = titles_collection_name
+        self._title_field: Final[str] = title_field
+
+    def _titles(self, mongo):
+        return mongo['movieDB'][self._titles_collection_name]
+
+    def apply(self, mongo, imdb_id: str, before: Mapping | None, after: Mapping | None) -> bool:
+        """Moves the aggregate of imdb_id from `before` to `after`, returns whether anything changed
+        """
+        update = review_update(before, after)
+        if update is None:
+            return False
+
+        self._titles(mongo).update_one({self._title_field: imdb_id}, update)
+
+        if after is None:
+            self._titles(mongo).update_one({self._title_field: imdb_id},
+                                           self._last_review_update(self._latest(mongo, imdb_id)))
+
+        return True
+
+    async def apply_async(self, mongo, imdb_id: str, before: Mapping | None, after: Mapping | None) -> bool:
+        update = review_update(before, after)
+        if update is None:
+            return False
+
+        await self._titles(mongo).update_one({self._title_field: imdb_id}, update)
+
+        if after is None:
+            latest = await mongo['movieDB'][self._reviews_collection_name].find_one(
+                {'imdb_id': imdb_id}, REVIEW_STATS_PROJECTION, sort=REVIEW_LATEST_ORDER)
+            await self._titles(mongo).update_one({self._title_field: imdb_id}, self._last_review_update(latest))
+
+        return True
+
+    def _latest(self, mongo, imdb_id: str) -> Mapping | None:
+        # served by the (imdb_id, timestamp, _id) index of the listing
+        return mongo['movieDB'][self._reviews_collection_name].find_one(
+            {'imdb_id': imdb_id}, REVIEW_STATS_PROJECTION, sort=REVIEW_LATEST_ORDER)
+
+    @staticmethod
+    def _last_review_update(latest: Mapping | None) -> dict:
+        """A deleted review may have been the latest one, the time is taken from the newest remaining review
+        """
+        if latest is None or latest.get('timestamp') is None:
+            return {'$unset': {REVIEW_STATS_FIELD + '.lastReview': ''}}
+
+        return {'$set': {REVIEW_STATS_FIELD + '.lastReview': latest['timestamp']}}
+
+    def compute(self, mongo, imdb_ids: list[str] | None = None) -> dict[str, ReviewStats]:
+        """Aggregates the reviews from scratch, for every title or only for imdb_ids
+        """
+        pipeline = [] if imdb_ids is None else [{'$match': {'imdb_id': {'$in': imdb_ids}}}]
+        pipeline.append({
+            '$group': {
+                '_id': {'imdb_id': '$imdb_id', 'rating': '$rating'},
+                'count': {'$sum': 1},
+                'lastReview': {'$max': '$timestamp'}
+            }
+        })
+
+        stats: dict[str, ReviewStats] = {}
+        for group in mongo['movieDB'][self._reviews_collection_name].aggregate(pipeline, allowDiskUse=True):
+            title = stats.setdefault(group['_id']['imdb_id'], ReviewStats())
+            title.count += group['count']
+
+            if group.get('lastReview') is not None:
+                title.lastReview = max(title.lastReview or group['lastReview'], group['lastReview'])
+
+            rating = group['_id'].get('rating')
+            key = rating_key(rating)
+            if key is not None:
+                title.rated += group['count']
+                title.sum += rating * group['count']
+                title.histogram[key] = title.histogram.get(key, 0) + group['count']
+
+        return stats
+
+    def _stored(self, mongo) -> Iterator[tuple[str, ReviewStats]]:
+        for title in self._titles(mongo).find({REVIEW_STATS_FIELD: {'$exists': True}},
+                                              {'_id': 0, self._title_field: 1, REVIEW_STATS_FIELD: 1}):
+            yield title[self._title_field], ReviewStats.of(title[REVIEW_STATS_FIELD])
+
+    def check(self, mongo) -> list[tuple[str, ReviewStats, ReviewStats]]:
+        """Lists the titles whose stored aggregate differs from their reviews, as (imdb_id, stored, actual)
+
+        Only titles present in the titles collection are compared, reviews of unknown titles have
+        nowhere to be counted.
+        """
+        actual = self.compute(mongo)
+        drift = []
+
+        for (imdb_id, stored) in self._stored(mongo):
+            expected = actual.pop(imdb_id, ReviewStats())
+            if stored != expected:
+                drift.append((imdb_id, stored, expected))
+
+        known = set()
+        for imdb_ids in batched(list(actual), REVIEW_STATS_WRITE_BATCH_SIZE):
+            known.update(title[self._title_field] for title in self._titles(mongo).find(
+                {self._title_field: {'$in': imdb_ids}}, {'_id': 0, self._title_field: 1}))
+
+        drift += [(imdb_id, ReviewStats(), actual[imdb_id]) for imdb_id in known]
+
+        return drift
+
+    def rebuild(self, mongo, imdb_ids: list[str] | None = None) -> int:
+        """Replaces the stored aggregates with ones recomputed from the reviews, returns the titles written
+        """
+        actual = self.compute(mongo, imdb_ids)
+        written = 0
+
+        for imdb_ids_batch in batched(list(actual), REVIEW_STATS_WRITE_BATCH_SIZE):
+            self._titles(mongo).bulk_write(
+                [UpdateOne({self._title_field: imdb_id}, {'$set': {REVIEW_STATS_FIELD: actual[imdb_id].document()}})
+                 for imdb_id in imdb_ids_batch], ordered=False)
+            written += len(imdb_ids_batch)
+
+        # titles that no longer have any review
+        if imdb_ids is None:
+            imdb_ids = [imdb_id for (imdb_id, _) in self._stored(mongo)]
+
+        for imdb_ids_batch in batched([imdb_id for imdb_id in imdb_ids if imdb_id not in actual],
+                                      REVIEW_STATS_WRITE_BATCH_SIZE):
+            self._titles(mongo).update_many({self._title_field: {'$in': imdb_ids_batch}},
+                                            {'$unset': {REVIEW_STATS_FIELD: ''}})
+
+        return written
@@ -1,7 +1,11 @@
+from collections import OrderedDict
 from urllib.request import urlopen
-from flask import request, g
 from functools import wraps
 from jose import jwt
+from movieship.context import current_request, request_globals
+import hashlib
+import threading
+import time
 import json
 
 # Code based on Auth0 sample - https://github.com/auth0-developer-hub/api_flask_python_hello-world
@@ -10,6 +14,12 @@ import json
 AUTH0_DOMAIN = "dev-506k7dq3fy4p4ivj.eu.auth0.com"
 API_AUDIENCE = "https://hello-world.example.com"
 ALGORITHMS = ["RS256"]
+JWKS_URL = "https://" + AUTH0_DOMAIN + "/.well-known/jwks.json"
+JWKS_TTL_SECONDS = 60 * 60
+JWKS_STALE_SECONDS = 60 * 60 * 24
+JWKS_REFRESH_MIN_INTERVAL_SECONDS = 30
+JWKS_FETCH_TIMEOUT_SECONDS = 5
+VERIFIED_TOKEN_CACHE_SIZE = 1024
 
 
 # Error handler
@@ -22,7 +32,7 @@ class AuthError(Exception):
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
-    auth = request.headers.get("Authorization", None)
+    auth = current_request().headers.get("Authorization", None)
     if not auth:
         raise AuthError({"code": "authorization_header_missing",
                          "description":
@@ -48,6 +58,289 @@ def get_token_auth_header():
     return token
 
 
+class JwksCache:
+    """Caches the JSON Web Key Set by kid
+
+    Keys are served from memory for `ttl` seconds. Once expired they are still
+    served for up to `stale` seconds while a background refresh runs. An unknown
+    kid triggers a synchronous refresh, rate limited by `refresh_interval`.
+
+    The *_async variants do the blocking fetches on an async HTTP client instead,
+    so the ASGI app never parks its event loop on the key set.
+    """
+
+    def __init__(self, url, ttl=JWKS_TTL_SECONDS, stale=JWKS_STALE_SECONDS,
+                 refresh_interval=JWKS_REFRESH_MIN_INTERVAL_SECONDS, timeout=JWKS_FETCH_TIMEOUT_SECONDS):
+        self._url = url
+        self._ttl = ttl
+        self._stale = stale
+        self._refresh_interval = refresh_interval
+        self._timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._async_client = None
+
+    def _fetch(self):
+        jsonurl = urlopen(self._url, timeout=self._timeout)
+        return self._parse(json.loads(jsonurl.read()))
+
+    async def _fetch_async(self):
+        if self._async_client is None:
+            # only the ASGI app fetches asynchronously, the WSGI app runs without httpx
+            import httpx
+            self._async_client = httpx.AsyncClient(timeout=self._timeout)
+
+        response = await self._async_client.get(self._url)
+        response.raise_for_status()
+        return self._parse(response.json())
+
+    @staticmethod
+    def _parse(jwks):
+        return {key["kid"]: {
+            "kty": key["kty"],
+            "kid": key["kid"],
+            "use": key["use"],
+            "n": key["n"],
+            "e": key["e"]
+        } for key in jwks["keys"] if "kid" in key}
+
+    def refresh(self):
+        """Fetches the key set, keeping the previous keys if the fetch fails
+
+        Without previous keys no token can be verified, the failure is raised as
+        a 503 AuthError.
+        """
+        self._last_attempt = time.monotonic()
+        try:
+            keys = self._fetch()
+        except Exception as ex:
+            if self._fetched_at is None:
+                print("jwks fetch failed", ex)
+                raise self._unavailable()
+            return False
+
+        self._store(keys)
+        return True
+
+    async def refresh_async(self):
+        self._last_attempt = time.monotonic()
+        try:
+            keys = await self._fetch_async()
+        except Exception as ex:
+            if self._fetched_at is None:
+                print("jwks fetch failed", ex)
+                raise self._unavailable()
+            return False
+
+        self._store(keys)
+        return True
+
+    @staticmethod
+    def _unavailable():
+        return AuthError({"code": "jwks_unavailable",
+                          "description":
+                              "Unable to fetch the signing keys"}, 503)
+
+    def _store(self, keys):
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get_key(self, kid):
+        now = time.monotonic()
+
+        if self._fetched_at is None or now - self._fetched_at > self._ttl + self._stale:
+            self.refresh()
+        elif now - self._fetched_at > self._ttl:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+
+        if key is None and self._may_refresh():
+            self.refresh()
+            key = self._keys.get(kid)
+
+        return key
+
+    async def get_key_async(self, kid):
+        now = time.monotonic()
+
+        if self._fetched_at is None or now - self._fetched_at > self._ttl + self._stale:
+            await self.refresh_async()
+        elif now - self._fetched_at > self._ttl:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+
+        if key is None and self._may_refresh():
+            await self.refresh_async()
+            key = self._keys.get(kid)
+
+        return key
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def _may_refresh(self):
+        return self._last_attempt is None or time.monotonic() - self._last_attempt >= self._refresh_interval
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of already verified tokens keyed by token hash, each entry expiring at the token `exp`
+    """
+
+    def __init__(self, max_size=VERIFIED_TOKEN_CACHE_SIZE):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return payload
+
+    def put(self, token, payload):
+        expires_at = payload.get("exp")
+        if not isinstance(expires_at, (int, float)) or expires_at <= time.time():
+            return
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+JWKS_CACHE = JwksCache(JWKS_URL)
+VERIFIED_TOKEN_CACHE = VerifiedTokenCache()
+
+
+def verify_token(token, jwks_cache=JWKS_CACHE, token_cache=VERIFIED_TOKEN_CACHE):
+    """Verifies the Access Token against the cached key set and returns its claims
+    """
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
+    return _decode_token(token, jwks_cache.get_key(_unverified_kid(token)), token_cache)
+
+
+async def verify_token_async(token, jwks_cache=JWKS_CACHE, token_cache=VERIFIED_TOKEN_CACHE):
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
+    return _decode_token(token, await jwks_cache.get_key_async(_unverified_kid(token)), token_cache)
+
+
+def _unverified_kid(token):
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except Exception:
+        raise AuthError({"code": "invalid_header",
+                         "description":
+                             "Unable to parse authentication"
+                             " token."}, 401)
+
+    return unverified_header.get("kid")
+
+
+def _decode_token(token, rsa_key, token_cache):
+    if not rsa_key:
+        raise AuthError({"code": "invalid_header",
+                         "description": "Unable to find appropriate key"}, 401)
+
+    try:
+        payload = jwt.decode(
+            token,
+            rsa_key,
+            algorithms=ALGORITHMS,
+            audience=API_AUDIENCE,
+            issuer="https://" + AUTH0_DOMAIN + "/"
+        )
+    except jwt.ExpiredSignatureError:
+        raise AuthError({"code": "token_expired",
+                         "description": "token is expired"}, 401)
+    except jwt.JWTClaimsError:
+        raise AuthError({"code": "invalid_claims",
+                         "description":
+                             "incorrect claims,"
+                             "please check the audience and issuer"}, 401)
+    except Exception:
+        raise AuthError({"code": "invalid_header",
+                         "description":
+                             "Unable to parse authentication"
+                             " token."}, 401)
+
+    token_cache.put(token, payload)
+    return payload
+
+
+def current_claims():
+    """The claims of the current request's token, decoded once per request
+
+    Behind decorate_requires_auth these are the verified claims, elsewhere the token
+    is only decoded, as the controllers did before.
+    """
+    g = request_globals()
+    claims = getattr(g, 'claims', None)
+
+    if claims is None:
+        claims = jwt.get_unverified_claims(get_token_auth_header())
+        g.claims = claims
+
+    return claims
+
+
+def current_sub():
+    return current_claims()['sub']
+
+
 def decorate_requires_auth(f):
     """Determines if the Access Token is valid
     """
@@ -55,46 +348,25 @@ def decorate_requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         token = get_token_auth_header()
-        jsonurl = urlopen("https://" + AUTH0_DOMAIN + "/.well-known/jwks.json")
-        jwks = json.loads(jsonurl.read())
-        unverified_header = jwt.get_unverified_header(token)
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"]
-                }
-        if rsa_key:
-            try:
-                payload = jwt.decode(
-                    token,
-                    rsa_key,
-                    algorithms=ALGORITHMS,
-                    audience=API_AUDIENCE,
-                    issuer="https://" + AUTH0_DOMAIN + "/"
-                )
-            except jwt.ExpiredSignatureError:
-                raise AuthError({"code": "token_expired",
-                                 "description": "token is expired"}, 401)
-            except jwt.JWTClaimsError:
-                raise AuthError({"code": "invalid_claims",
-                                 "description":
-                                     "incorrect claims,"
-                                     "please check the audience and issuer"}, 401)
-            except Exception:
-                raise AuthError({"code": "invalid_header",
-                                 "description":
-                                     "Unable to parse authentication"
-                                     " token."}, 401)
-
-            g._request_ctx_stack = payload
-            return f(*args, **kwargs)
-        raise AuthError({"code": "invalid_header",
-                         "description": "Unable to find appropriate key"}, 401)
+        payload = verify_token(token)
+
+        request_globals().claims = payload
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+def decorate_requires_auth_async(f):
+    """Determines if the Access Token is valid, for the ASGI app's coroutine views
+    """
+
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        token = get_token_auth_header()
+        payload = await verify_token_async(token)
+
+        request_globals().claims = payload
+        return await f(*args, **kwargs)
 
     return decorated
 
@@ -104,8 +376,7 @@ def requires_scope(required_scope):
     Args:
         required_scope (str): The scope required to access the resource
     """
-    token = get_token_auth_header()
-    unverified_claims = jwt.get_unverified_claims(token)
+    unverified_claims = current_claims()
     if unverified_claims.get("scope"):
         token_scopes = unverified_claims["scope"].split()
         for token_scope in token_scopes:
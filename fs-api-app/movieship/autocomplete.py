@@ -0,0 +1,371 @@
+import bisect
+import heapq
+import os
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Final, Iterable, Iterator, Mapping
+
+from movieship.importer import IMPORT_DATABASE_NAME, IMPORT_RUN_COLLECTION_NAME, batched, tconst_key, imdb_id
+from movieship.search import title_key
+
+AUTOCOMPLETE_MAX_TITLES: Final[int] = int(os.environ.get('MOVIESHIP_AUTOCOMPLETE_MAX_TITLES', 1_000_000))
+AUTOCOMPLETE_TITLE_TYPES: Final[tuple[str, ...]] = ('movie', 'tvSeries', 'tvMiniSeries', 'tvMovie', 'tvSpecial',
+                                                    'short', 'tvShort', 'video', 'videoGame')
+AUTOCOMPLETE_LIMIT: Final[int] = 10
+AUTOCOMPLETE_MAX_LIMIT: Final[int] = 25
+AUTOCOMPLETE_POLL_SECONDS: Final[float] = 60.0
+AUTOCOMPLETE_OVERLAY_LIMIT: Final[int] = 50_000
+AUTOCOMPLETE_FETCH_BATCH_SIZE: Final[int] = 5000
+AUTOCOMPLETE_FIELDS: Final[dict[str, int]] = {'_id': 0, 'tconst': 1, 'primaryTitle': 1, 'titleType': 1,
+                                              'averageRatingVotes': 1}
+
+
+@dataclass
+class Suggestion:
+    imdb_id: str
+    primaryTitle: str
+    titleType: str
+    averageRatingVotes: int
+
+
+class PackedTitles:
+    """Titles sorted by normalized key, packed into contiguous arrays
+
+    Keys and display titles are UTF-8 blobs addressed by offset arrays, next to parallel arrays of
+    tconst number, vote count and title type, and a segment tree of the best voted title of every
+    range. A prefix is two binary searches over the keys, the top-k inside it pops k ranges off a heap.
+    Roughly 60 bytes a title, with no Python object per title.
+    """
+
+    def __init__(self, entries: list[tuple[bytes, bytes, int, int, str]]):
+        entries.sort(key=lambda entry: (entry[0], -entry[3]))
+
+        self._title_types: Final[tuple[str, ...]] = tuple(sorted({entry[4] for entry in entries}))
+        type_indexes = {title_type: index for (index, title_type) in enumerate(self._title_types)}
+
+        self._keys = bytearray()
+        self._key_offsets = array('I', [0])
+        self._titles = bytearray()
+        self._title_offsets = array('I', [0])
+        self._tconsts = array('I')
+        self._weights = array('I')
+        self._types = array('B')
+
+        for (key, title, tconst, weight, title_type) in entries:
+            self._keys += key
+            self._key_offsets.append(len(self._keys))
+            self._titles += title
+            self._title_offsets.append(len(self._titles))
+            self._tconsts.append(tconst)
+            self._weights.append(weight)
+            self._types.append(type_indexes[title_type])
+
+        self._keys = bytes(self._keys)
+        self._titles = bytes(self._titles)
+        self._size: Final[int] = len(entries)
+        self._tree = self._build_tree()
+
+    def _build_tree(self) -> array:
+        n = self._size
+        weights = self._weights
+        tree = array('I', [0]) * (2 * n)
+
+        for index in range(n):
+            tree[n + index] = index
+        for node in range(n - 1, 0, -1):
+            (left, right) = (tree[2 * node], tree[2 * node + 1])
+            tree[node] = left if weights[left] >= weights[right] else right
+
+        return tree
+
+    def __len__(self):
+        return self._size
+
+    def nbytes(self) -> int:
+        return len(self._keys) + len(self._titles) + sum(
+            values.itemsize * len(values) for values in (self._key_offsets, self._title_offsets, self._tconsts,
+                                                        self._weights, self._types, self._tree))
+
+    def min_weight(self) -> int:
+        return min(self._weights) if self._size else 0
+
+    def _key(self, index: int) -> bytes:
+        return self._keys[self._key_offsets[index]:self._key_offsets[index + 1]]
+
+    def _prefix_range(self, prefix: bytes) -> tuple[int, int]:
+        (low, high) = (0, self._size)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+
+        start = low
+        high = self._size
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle)[:len(prefix)] <= prefix:
+                low = middle + 1
+            else:
+                high = middle
+
+        return start, low
+
+    def _best(self, start: int, end: int) -> int:
+        """The index of the most voted title in [start, end), the first one on ties
+        """
+        weights = self._weights
+        tree = self._tree
+        best = -1
+        (low, high) = (start + self._size, end + self._size)
+
+        while low < high:
+            if low & 1:
+                candidate = tree[low]
+                if best < 0 or weights[candidate] > weights[best] or \
+                        (weights[candidate] == weights[best] and candidate < best):
+                    best = candidate
+                low += 1
+            if high & 1:
+                high -= 1
+                candidate = tree[high]
+                if best < 0 or weights[candidate] > weights[best] or \
+                        (weights[candidate] == weights[best] and candidate < best):
+                    best = candidate
+            low >>= 1
+            high >>= 1
+
+        return best
+
+    def ranked(self, prefix: bytes) -> Iterator[int]:
+        """Yields the indexes of the titles starting with prefix, most voted first
+        """
+        (start, end) = self._prefix_range(prefix)
+        if start >= end:
+            return
+
+        best = self._best(start, end)
+        heap = [(-self._weights[best], best, start, end)]
+
+        while heap:
+            (_, best, start, end) = heapq.heappop(heap)
+            yield best
+
+            for (low, high) in ((start, best), (best + 1, end)):
+                if low < high:
+                    candidate = self._best(low, high)
+                    heapq.heappush(heap, (-self._weights[candidate], candidate, low, high))
+
+    def tconst(self, index: int) -> int:
+        return self._tconsts[index]
+
+    def suggestion(self, index: int) -> Suggestion:
+        title = self._titles[self._title_offsets[index]:self._title_offsets[index + 1]].decode('utf-8')
+        return Suggestion(imdb_id(self._tconsts[index]), title, self._title_types[self._types[index]],
+                          self._weights[index])
+
+
+def title_entry(show: Mapping) -> tuple[bytes, bytes, int, int, str] | None:
+    """The packed entry of a show, None for shows autocomplete does not suggest
+    """
+    tconst = tconst_key(show.get('tconst') or '')
+    key = title_key(show.get('primaryTitle'))
+
+    if tconst is None or not key or show.get('titleType') not in AUTOCOMPLETE_TITLE_TYPES:
+        return None
+
+    return key.encode('utf-8'), show['primaryTitle'].encode('utf-8'), tconst, \
+        int(show.get('averageRatingVotes') or 0), show['titleType']
+
+
+class TitleAutocomplete:
+    """Most voted titles by normalized prefix, answered from memory
+
+    The `max_titles` most voted titles are packed once, in the master before the workers fork when
+    served pre-forked, so every worker shares the same pages. Refreshes announced by the importer are
+    applied as a small overlay of changed titles plus the tconsts hidden from the packed snapshot, and
+    the snapshot is rebuilt once the overlay outgrows `overlay_limit` or an import asks for a rebuild.
+    """
+
+    def __init__(
+            self,
+            collection_name: str,
+            max_titles: int = AUTOCOMPLETE_MAX_TITLES,
+            overlay_limit: int = AUTOCOMPLETE_OVERLAY_LIMIT,
+            poll_seconds: float = AUTOCOMPLETE_POLL_SECONDS
+    ):
+        self._collection_name: Final[str] = collection_name
+        self._max_titles = max_titles
+        self._overlay_limit = overlay_limit
+        self._poll_seconds = poll_seconds
+        self._packed: PackedTitles | None = None
+        self._floor = 0
+        self._overlay: dict[int, tuple[bytes, bytes, int, int, str]] = {}
+        self._overlay_keys: list[tuple[bytes, int]] = []
+        self._hidden: set[int] = set()
+        self._seen_run: datetime | None = None
+        self._loaded_in = 0.0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._poller = None
+
+        os.register_at_fork(after_in_child=self._forget_threads)
+
+    def _forget_threads(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._poller = None
+
+    def _shows(self, mongo):
+        return mongo[IMPORT_DATABASE_NAME][self._collection_name]
+
+    def _runs(self, mongo):
+        return mongo[IMPORT_DATABASE_NAME][IMPORT_RUN_COLLECTION_NAME]
+
+    def _load(self, mongo):
+        started = time.perf_counter()
+        latest = self._runs(mongo).find_one({}, {'finishedAt': 1}, sort=[('finishedAt', -1)])
+
+        shows = self._shows(mongo).find({'titleType': {'$in': list(AUTOCOMPLETE_TITLE_TYPES)}},
+                                        AUTOCOMPLETE_FIELDS, sort=[('averageRatingVotes', -1)],
+                                        limit=self._max_titles, allow_disk_use=True,
+                                        batch_size=AUTOCOMPLETE_FETCH_BATCH_SIZE)
+        packed = PackedTitles([entry for entry in map(title_entry, shows) if entry is not None])
+
+        with self._lock:
+            self._packed = packed
+            self._floor = packed.min_weight() if len(packed) >= self._max_titles else 0
+            self._overlay = {}
+            self._overlay_keys = []
+            self._hidden = set()
+            self._seen_run = latest['finishedAt'] if latest else None
+            self._loaded_in = time.perf_counter() - started
+
+    def load(self, mongo):
+        """Packs the most voted titles and forgets the overlay
+        """
+        with self._load_lock:
+            self._load(mongo)
+
+    def ensure_loaded(self, mongo):
+        if self._packed is not None:
+            return
+
+        with self._load_lock:
+            if self._packed is None:
+                self._load(mongo)
+
+    def _unlink(self, tconst: int):
+        entry = self._overlay.pop(tconst, None)
+        if entry is not None:
+            index = bisect.bisect_left(self._overlay_keys, (entry[0], tconst))
+            del self._overlay_keys[index]
+
+    def apply(self, shows: Iterable[Mapping], removed: Iterable[int] = ()):
+        """Overlays changed titles and hides removed ones
+        """
+        entries = [(tconst_key(show.get('tconst') or ''), title_entry(show)) for show in shows]
+
+        with self._lock:
+            for (tconst, entry) in entries:
+                if tconst is None:
+                    continue
+
+                self._hidden.add(tconst)
+                self._unlink(tconst)
+
+                if entry is not None and entry[3] >= self._floor:
+                    self._overlay[tconst] = entry
+                    bisect.insort(self._overlay_keys, (entry[0], tconst))
+
+            for tconst in removed:
+                self._hidden.add(tconst)
+                self._unlink(tconst)
+
+    def poll(self, mongo) -> int:
+        """Applies the imports finished since the last poll, returns how many were applied
+        """
+        query = {} if self._seen_run is None else {'finishedAt': {'$gt': self._seen_run}}
+        runs = list(self._runs(mongo).find(query, sort=[('finishedAt', 1)]))
+
+        for run in runs:
+            if run.get('rebuild'):
+                self.load(mongo)
+                return len(runs)
+
+            (changed, removed) = (array('I'), array('I'))
+            changed.frombytes(run['changed'])
+            removed.frombytes(run['removed'])
+
+            for keys in batched(changed, AUTOCOMPLETE_FETCH_BATCH_SIZE):
+                self.apply(self._shows(mongo).find({'tconst': {'$in': [imdb_id(key) for key in keys]}},
+                                                   AUTOCOMPLETE_FIELDS))
+            self.apply([], removed)
+            self._seen_run = run['finishedAt']
+
+        if len(self._hidden) > self._overlay_limit:
+            self.load(mongo)
+
+        return len(runs)
+
+    def start(self, mongo):
+        """Polls for finished imports on a background thread of this process
+        """
+        if self._poller is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self._poll_seconds)
+                try:
+                    self.poll(mongo)
+                except Exception as ex:
+                    print("autocomplete refresh failed", ex)
+
+        self._poller = threading.Thread(target=run, name="autocomplete", daemon=True)
+        self._poller.start()
+
+    def suggest(self, query: str, limit: int = AUTOCOMPLETE_LIMIT) -> list[Suggestion]:
+        prefix = title_key(query).encode('utf-8')
+        if not prefix or limit <= 0:
+            return []
+
+        with self._lock:
+            packed = self._packed
+            candidates: list[Suggestion] = []
+
+            if packed is not None:
+                for index in packed.ranked(prefix):
+                    if packed.tconst(index) in self._hidden:
+                        continue
+                    candidates.append(packed.suggestion(index))
+                    if len(candidates) >= limit:
+                        break
+
+            start = bisect.bisect_left(self._overlay_keys, (prefix,))
+            overlaid = []
+            for (key, tconst) in self._overlay_keys[start:]:
+                if not key.startswith(prefix):
+                    break
+                overlaid.append(self._overlay[tconst])
+
+        for (_, title, tconst, weight, title_type) in heapq.nlargest(limit, overlaid, key=lambda entry: entry[3]):
+            candidates.append(Suggestion(imdb_id(tconst), title.decode('utf-8'), title_type, weight))
+
+        return heapq.nlargest(limit, candidates, key=lambda suggestion: suggestion.averageRatingVotes)
+
+    def stats(self) -> dict[str, any]:
+        with self._lock:
+            packed = self._packed
+            return {
+                'titles': len(packed) if packed is not None else 0,
+                'bytes': packed.nbytes() if packed is not None else 0,
+                'overlay': len(self._overlay),
+                'hidden': len(self._hidden),
+                'loaded_in_seconds': round(self._loaded_in, 3),
+                'last_import': self._seen_run,
+            }
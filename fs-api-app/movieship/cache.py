@@ -0,0 +1,331 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import wraps
+from typing import Final, Callable
+
+from flask import request, make_response
+
+from movieship.context import request_globals
+
+RESPONSE_CACHE_TTL_SECONDS: Final[float] = 60 * 10
+RESPONSE_CACHE_MAX_ENTRIES: Final[int] = 2048
+RESPONSE_CACHE_MAX_BYTES: Final[int] = 64 * 1024 * 1024
+RESPONSE_CACHE_UNORDERED_ARGS: Final[set[str]] = {'se', 'sl', 'sil', 'sp', 'st'}
+RESPONSE_CACHE_POLL_SECONDS: Final[float] = 2.0
+RESPONSE_CACHE_INVALIDATION_DATABASE_NAME: Final[str] = 'movieDB'
+RESPONSE_CACHE_INVALIDATION_COLLECTION_NAME: Final[str] = 'cache_invalidations'
+RESPONSE_CACHE_INVALIDATION_HISTORY: Final[int] = 256
+# larger changes, e.g. a whole import, drop everything instead of growing the invalidation document
+RESPONSE_CACHE_MAX_PUBLISHED_TAGS: Final[int] = 1000
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    mimetype: str
+    etag: str
+    expires_at: float
+    tags: frozenset[str]
+
+
+def make_etag(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """Bounded LRU of serialized responses keyed by the normalized request, evicted by TTL, count and size
+
+    Entries can be tagged, e.g. with the imdb_ids they contain, so a change to one title only drops the
+    responses that include it.
+
+    Each worker process holds its own entries. Changes are published to a version counter in Mongo that
+    keeps the last invalidations, every worker polls it and drops the same entries within `poll_seconds`.
+    Changes made outside Mongo, e.g. a new catalog snapshot, are checked by the watchers run with each poll.
+    """
+
+    def __init__(self, name: str, ttl: float = RESPONSE_CACHE_TTL_SECONDS,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+                 unordered_args: set[str] = RESPONSE_CACHE_UNORDERED_ARGS,
+                 poll_seconds: float = RESPONSE_CACHE_POLL_SECONDS):
+        self._name: Final[str] = name
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._unordered_args = unordered_args
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._bytes = 0
+        self._poll_seconds = poll_seconds
+        self._seen_version: int | None = None
+        self._lock = threading.Lock()
+        self._poller = None
+        self._watchers: list[Callable[[], object]] = []
+        self._counters: dict[str, int] = {
+            'hits': 0,
+            'misses': 0,
+            'not_modified': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'published': 0,
+            'polled': 0,
+        }
+
+        os.register_at_fork(after_in_child=self._forget_threads)
+
+    def _forget_threads(self):
+        self._lock = threading.Lock()
+        self._poller = None
+
+    def _invalidations(self, mongo):
+        return mongo[RESPONSE_CACHE_INVALIDATION_DATABASE_NAME][RESPONSE_CACHE_INVALIDATION_COLLECTION_NAME]
+
+    def key(self, path: str, args) -> str:
+        """Normalizes the query so equivalent filter lists share an entry, order params keep their order
+        """
+        normalized = []
+        for (name, value) in sorted(args.items(multi=True)):
+            if name in self._unordered_args:
+                value = ','.join(sorted(value.split(',')))
+            normalized.append((name, value))
+
+        return path + '?' + '&'.join('{}={}'.format(name, value) for (name, value) in normalized)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.body)
+
+    def get(self, key: str) -> CachedResponse | None:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry
+
+    def put(self, key: str, body: bytes, mimetype: str, tags: set[str] | None = None) -> CachedResponse:
+        entry = CachedResponse(body, mimetype, make_etag(body), time.monotonic() + self._ttl,
+                               frozenset(tags or ()))
+
+        if len(body) > self._max_bytes:
+            return entry
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = entry
+            self._bytes += len(body)
+
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._counters['evictions'] += 1
+
+        return entry
+
+    def invalidate(self, tags: set[str] | None = None):
+        """Drops the entries carrying any of `tags`, or everything when no tags are given
+        """
+        with self._lock:
+            if tags is None:
+                keys = list(self._entries)
+            else:
+                keys = [key for (key, entry) in self._entries.items() if not entry.tags.isdisjoint(tags)]
+
+            for key in keys:
+                self._remove(key)
+
+            self._counters['invalidations'] += len(keys)
+
+    def publish(self, mongo, tags: set[str] | None = None):
+        """Invalidates `tags` here and, once they poll, in the other workers
+        """
+        if tags is not None and len(tags) > RESPONSE_CACHE_MAX_PUBLISHED_TAGS:
+            tags = None
+
+        self.invalidate(tags)
+
+        try:
+            self._invalidations(mongo).update_one({'_id': self._name}, {
+                '$inc': {'version': 1},
+                '$push': {'recent': {'$each': [None if tags is None else sorted(tags)],
+                                     '$slice': -RESPONSE_CACHE_INVALIDATION_HISTORY}}
+            }, upsert=True)
+        except Exception as ex:
+            print("cache invalidation publish failed", ex)
+        else:
+            with self._lock:
+                self._counters['published'] += 1
+
+    def poll(self, mongo) -> int:
+        """Applies the invalidations published since the last poll, returns how many were applied
+        """
+        document = self._invalidations(mongo).find_one({'_id': self._name}) or {}
+        (version, recent) = (document.get('version', 0), document.get('recent', []))
+
+        # the first poll only marks where this process starts, its entries are all newer
+        missed = 0 if self._seen_version is None else version - self._seen_version
+        self._seen_version = version
+
+        if missed < 0 or missed > len(recent):
+            # the counter was reset or this process fell behind the kept history
+            self.invalidate()
+        elif missed > 0:
+            for tags in recent[-missed:]:
+                self.invalidate(None if tags is None else set(tags))
+
+        missed = max(missed, 0)
+        with self._lock:
+            self._counters['polled'] += missed
+
+        return missed
+
+    def add_watcher(self, watcher: Callable[[], object]):
+        """Registers a callable run on the poller thread after each poll, it invalidates what it sees change
+        """
+        self._watchers.append(watcher)
+
+    def _poll_all(self, mongo):
+        try:
+            self.poll(mongo)
+        except Exception as ex:
+            print("cache invalidation poll failed", ex)
+
+        for watcher in self._watchers:
+            try:
+                watcher()
+            except Exception as ex:
+                print("cache watcher failed", ex)
+
+    def start(self, mongo):
+        """Polls for invalidations published by the other workers on a background thread of this process
+        """
+        if self._poller is not None:
+            return
+
+        self._poll_all(mongo)
+
+        def run():
+            while True:
+                time.sleep(self._poll_seconds)
+                self._poll_all(mongo)
+
+        self._poller = threading.Thread(target=run, name="response-cache", daemon=True)
+        self._poller.start()
+
+    def not_modified(self):
+        with self._lock:
+            self._counters['not_modified'] += 1
+
+    def stats(self) -> dict[str, any]:
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            return {
+                **self._counters,
+                'hit_rate': self._counters['hits'] / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+
+def cache_tags(tags: set[str]):
+    """Tags the response of the current request for ResponseCache.invalidate
+    """
+    g = request_globals()
+    g.response_cache_tags = getattr(g, 'response_cache_tags', set()) | set(tags)
+
+
+def skip_response_cache():
+    """Keeps the response of the current request out of the cache, e.g. while it holds placeholders
+    """
+    request_globals().response_cache_skip = True
+
+
+def cached_response(cache: ResponseCache):
+    """Serves the view from `cache`, answering If-None-Match with a 304 without running the view
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = cache.key(request.path, request.args)
+            entry = cache.get(key)
+
+            if entry is None:
+                response = f(*args, **kwargs)
+
+                if response.status_code != 200:
+                    return response
+
+                body = response.get_data()
+
+                if getattr(request_globals(), 'response_cache_skip', False):
+                    response.set_etag(make_etag(body))
+                    return response.make_conditional(request)
+
+                entry = cache.put(key, body, response.mimetype, getattr(request_globals(), 'response_cache_tags', None))
+
+            if request.if_none_match.contains(entry.etag):
+                cache.not_modified()
+                response = make_response('', 304)
+            else:
+                response = make_response(entry.body, 200)
+                response.mimetype = entry.mimetype
+
+            response.set_etag(entry.etag)
+            return response
+
+        return decorated
+
+    return decorator
+
+
+def cached_response_async(cache: ResponseCache):
+    """cached_response for the ASGI app's coroutine views
+    """
+    import quart
+
+
+    def decorator(f):
+        @wraps(f)
+        async def decorated(*args, **kwargs):
+            key = cache.key(quart.request.path, quart.request.args)
+            entry = cache.get(key)
+
+            if entry is None:
+                response = await f(*args, **kwargs)
+
+                if response.status_code != 200:
+                    return response
+
+                body = await response.get_data()
+
+                if getattr(request_globals(), 'response_cache_skip', False):
+                    entry = CachedResponse(body, response.mimetype, make_etag(body), 0.0, frozenset())
+                else:
+                    entry = cache.put(key, body, response.mimetype,
+                                      getattr(request_globals(), 'response_cache_tags', None))
+
+            if quart.request.if_none_match.contains(entry.etag):
+                cache.not_modified()
+                response = await quart.make_response('', 304)
+            else:
+                response = await quart.make_response(entry.body, 200)
+                response.mimetype = entry.mimetype
+
+            response.set_etag(entry.etag)
+            return response
+
+        return decorated
+
+    return decorator
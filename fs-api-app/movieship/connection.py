@@ -0,0 +1,70 @@
+import os
+import threading
+from typing import Final, Callable
+
+from pymongo import MongoClient
+
+MONGO_URI: Final[str] = os.environ.get('MOVIESHIP_MONGO_URI', 'mongodb://127.0.0.1:27017')
+MONGO_MAX_POOL_SIZE: Final[int] = int(os.environ.get('MOVIESHIP_MONGO_MAX_POOL_SIZE', 32))
+MONGO_MIN_POOL_SIZE: Final[int] = int(os.environ.get('MOVIESHIP_MONGO_MIN_POOL_SIZE', 4))
+MONGO_MAX_IDLE_TIME_MS: Final[int] = int(os.environ.get('MOVIESHIP_MONGO_MAX_IDLE_TIME_MS', 60_000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS: Final[int] = int(os.environ.get('MOVIESHIP_MONGO_SERVER_SELECTION_TIMEOUT_MS',
+                                                                   5_000))
+MONGO_CONNECT_TIMEOUT_MS: Final[int] = int(os.environ.get('MOVIESHIP_MONGO_CONNECT_TIMEOUT_MS', 5_000))
+
+
+def mongo_options() -> dict[str, any]:
+    """Client options shared by the sync and the async client, read from MOVIESHIP_MONGO_* variables
+    """
+    return {
+        'maxPoolSize': MONGO_MAX_POOL_SIZE,
+        'minPoolSize': MONGO_MIN_POOL_SIZE,
+        'maxIdleTimeMS': MONGO_MAX_IDLE_TIME_MS,
+        'serverSelectionTimeoutMS': MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        'connectTimeoutMS': MONGO_CONNECT_TIMEOUT_MS,
+    }
+
+
+def make_client() -> MongoClient:
+    return MongoClient(MONGO_URI, **mongo_options())
+
+
+class ProcessClient:
+    """A MongoClient created on first use in each process
+
+    A client inherited across fork shares its sockets and monitor threads with the parent, so the
+    child forgets it and connects again the next time it is used.
+    """
+
+    def __init__(self, factory: Callable[[], MongoClient] = make_client):
+        self._factory = factory
+        self._client: MongoClient | None = None
+        self._lock = threading.Lock()
+
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self) -> MongoClient:
+        client = self._client
+        if client is not None:
+            return client
+
+        with self._lock:
+            if self._client is None:
+                self._client = self._factory()
+            return self._client
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def __getitem__(self, name):
+        return self.get()[name]
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
@@ -0,0 +1,38 @@
+import sys
+
+import flask
+
+
+def _quart():
+    """Quart once the ASGI app imported it, the WSGI app runs without it and so never has its contexts
+    """
+    return sys.modules.get('quart')
+
+
+def has_request_context() -> bool:
+    quart = _quart()
+    return flask.has_request_context() or (quart is not None and quart.has_request_context())
+
+
+def current_request():
+    """The request being served, by the Flask app or by the ASGI app
+    """
+    quart = _quart()
+    if quart is not None and quart.has_request_context():
+        return quart.request
+
+    return flask.request
+
+
+def request_globals():
+    quart = _quart()
+    if quart is not None and quart.has_app_context():
+        return quart.g
+
+    return flask.g
+
+
+async def request_json():
+    import quart
+
+    return await quart.request.get_json()
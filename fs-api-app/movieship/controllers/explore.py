@@ -1,20 +1,33 @@
-from typing import Final
+from dataclasses import replace
+from typing import Final, TYPE_CHECKING
 
-import requests
 from flask import make_response, jsonify
-from pymongo import MongoClient, UpdateOne
+from pymongo import MongoClient
 
 import movieship.logic
-from movieship.controllers.root import PageResponse
+from movieship.autocomplete import TitleAutocomplete, Suggestion, AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_MAX_LIMIT
+from movieship.cache import ResponseCache, cache_tags, skip_response_cache
+from movieship.context import current_request
+from movieship.controllers.root import PageResponse, BatchResponse
+from movieship.exceptions import TooManyIdentifiersException
 
-from movieship.logic import SearchOrder, OrderType
+from movieship.indexes import IndexSpec, index
+from movieship.logic import SearchOrder, OrderType, SearchMetaData, parse_search_value, parse_limit
+from movieship.posters import PosterEnricher, POSTER_PLACEHOLDER, poster_missing
+from movieship.snapshot import CatalogSnapshots, CatalogSnapshot
+
+if TYPE_CHECKING:
+    # only the ASGI app needs the async driver, the WSGI app runs without it
+    from motor.motor_asyncio import AsyncIOMotorClient
 
 EXPLORE_COLLECTION_NAME: Final[str] = 'shows'
 EXPLORE_IDENTIFIER_FIELD: Final[str] = 'imdb_id'
 EXPLORE_IDENTITY_ORDER_FIELD: Final[SearchOrder] = SearchOrder('imdb_id', OrderType.ASCENDING, False)
 EXPLORE_PAGE_SIZE_LIMIT: Final[int] = 25
-EXPLORE_ALLOWED_ORDER_FIELDS: Final[set[str]] = {'imdb_id', 'start_year', 'primaryTitle', 'titleType'}
+EXPLORE_BATCH_SIZE_LIMIT: Final[int] = 100
+EXPLORE_ALLOWED_ORDER_FIELDS: Final[set[str]] = {'imdb_id', 'startYear', 'primaryTitle', 'titleType'}
 EXPLORE_ALLOWED_SEARCH_FIELDS: Final[set[str]] = {'imdb_id', 'primaryTitle', 'titleType'}
+EXPLORE_TERM_FIELDS: Final[set[str]] = {'primaryTitle'}
 EXPLORE_RESOURCE_FIELDS: Final[dict[str, str]] = {
     'imdb_id': '$tconst',
     'titleType': '$titleType',
@@ -27,38 +40,203 @@ EXPLORE_RESOURCE_FIELDS: Final[dict[str, str]] = {
     'averageRating': '$averageRating',
     'averageRatingVotes': '$averageRatingVotes',
     'poster': '$poster',
+    'reviewStats': '$reviewStats',
+    'searchScore': '$searchScore',
 }
+# written after the import by the poster enricher and the review aggregates, so never read from a snapshot
+EXPLORE_LIVE_FIELDS: Final[set[str]] = {'poster', 'reviewStats'}
+EXPLORE_INDEXES: Final[list[IndexSpec]] = [
+    index('tconst', unique=True),
+    index('startYear', 'tconst'),
+    index('primaryTitle', 'tconst'),
+    index('titleType', 'tconst'),
+    index('titleType', 'startYear', 'tconst'),
+    index('titleType', 'primaryTitle', 'tconst'),
+    index('primaryTitleTerms'),
+    index('titleType', 'primaryTitleTerms'),
+]
+POSTER_ENRICHER: Final[PosterEnricher] = PosterEnricher(EXPLORE_COLLECTION_NAME, 'tconst')
+EXPLORE_RESPONSE_CACHE: Final[ResponseCache] = ResponseCache(EXPLORE_COLLECTION_NAME)
+TITLE_AUTOCOMPLETE: Final[TitleAutocomplete] = TitleAutocomplete(EXPLORE_COLLECTION_NAME)
+CATALOG_SNAPSHOTS: Final[CatalogSnapshots] = CatalogSnapshots()
+
+POSTER_ENRICHER.add_listener(EXPLORE_RESPONSE_CACHE.publish)
+CATALOG_SNAPSHOTS.add_listener(EXPLORE_RESPONSE_CACHE.invalidate)
+# cache hits never reach the listings that check the pointer, so every worker's poller checks it too
+EXPLORE_RESPONSE_CACHE.add_watcher(CATALOG_SNAPSHOTS.current)
 
 
 class ExploreFieldLogic(movieship.logic.FieldLogic):
-    def _enhancer(self, mongo, values):
-        data_to_enhance = []
+    def _enhancer(self, mongo, values, fields=None):
+        if fields is not None and 'poster' not in fields:
+            return values
 
         for movie in values:
-            poster = ''
+            poster = movie.get('poster')
 
-            if 'poster' in movie:
-                poster = movie['poster']
+            if poster_missing(poster):
+                movie['poster'] = POSTER_PLACEHOLDER
+                movie['posterPending'] = POSTER_ENRICHER.submit(mongo, movie['imdb_id'])
 
-            if poster == '' or poster == 'N/A' or poster is None:
-                response = requests.get("http://www.omdbapi.com/?apikey=8126e5b4&i={}".format(movie['imdb_id'])).json()
+        return values
 
-                if 'Poster' in response:
-                    poster = response['Poster']
+    def _snapshot_rows(self, snapshot: CatalogSnapshot, search_meta_data: SearchMetaData) -> list[int] | None:
+        """Answers a listing ordered by one field and the imdb_id from the snapshot, None to ask Mongo
+        """
+        orders = self._key_set_orders(search_meta_data.orders)
+        if self._backwards(search_meta_data):
+            orders = [order.reversed() for order in orders]
 
-                if poster == '' or poster == 'N/A' or poster is None:
-                    if 'Error' not in response:
-                        poster = "https://placehold.co/332x249"
+        (order, identity) = (orders[0], orders[-1])
+        if len(orders) > 2 or identity.field != self._identifier_field or order.type != identity.type:
+            return None
 
-                movie['poster'] = poster
-                data_to_enhance.append(UpdateOne({'_id': movie['_id']}, {"$set": {'poster': poster}}))
+        position = self._listing_key_set_actions(replace(search_meta_data, orders=orders))
+        filters = [(self.map_db_field_name(search_filter.field), search_filter.type, search_filter.value)
+                   for search_filter in search_meta_data.filters]
 
-            movie['_id'] = str(movie['_id'])
+        return snapshot.listing(self.map_db_field_name(order.field), order.type == OrderType.DESCENDING,
+                                order.allow_nulls, position, filters, search_meta_data.limit)
 
-        if len(data_to_enhance) != 0:
-            mongo['movieDB'][EXPLORE_COLLECTION_NAME].bulk_write(data_to_enhance)
+    def _snapshot_resources(self, snapshot: CatalogSnapshot, rows: list[int], fields: set[str] | None,
+                            extra: set[str] = frozenset()) -> list[dict[str, any]]:
+        projection = {field: expression.removeprefix('$')
+                      for (field, expression) in self._projection(fields, extra).items()
+                      if field not in EXPLORE_LIVE_FIELDS and snapshot.has_field(expression.removeprefix('$'))}
 
-        return values
+        return [{'_id': snapshot.value('_id', row),
+                 **{field: snapshot.value(db_field, row) for (field, db_field) in projection.items()}}
+                for row in rows]
+
+    def _live_query(self, resources: list[dict[str, any]], fields: set[str] | None) \
+            -> tuple[dict, dict[str, int]] | None:
+        live = [field for field in EXPLORE_LIVE_FIELDS if fields is None or field in fields]
+        if not live or not resources:
+            return None
+
+        identifier_field = self.map_db_field_name(self._identifier_field)
+        return {identifier_field: {'$in': [resource[self._identifier_field] for resource in resources]}}, \
+            {'_id': 0, identifier_field: 1, **{self.map_db_field_name(field): 1 for field in live}}
+
+    def _merge_live(self, resources: list[dict[str, any]], documents: list[dict[str, any]]):
+        identifier_field = self.map_db_field_name(self._identifier_field)
+        by_identifier = {document[identifier_field]: document for document in documents}
+
+        for resource in resources:
+            document = by_identifier.get(resource[self._identifier_field], {})
+            for field in EXPLORE_LIVE_FIELDS:
+                if self.map_db_field_name(field) in document:
+                    resource[field] = document[self.map_db_field_name(field)]
+
+        return resources
+
+    def _with_live_fields(self, mongo, resources, fields):
+        query = self._live_query(resources, fields)
+        if query is None:
+            return resources
+
+        return self._merge_live(resources, list(mongo['movieDB'][self._collection_name].find(*query)))
+
+    async def _with_live_fields_async(self, mongo, resources, fields):
+        query = self._live_query(resources, fields)
+        if query is None:
+            return resources
+
+        return self._merge_live(resources, await mongo['movieDB'][self._collection_name].find(*query).to_list(None))
+
+    def _snapshot_page(self, search_meta_data: SearchMetaData):
+        """The page and cursor of a listing read from the snapshot, None when Mongo has to answer it
+        """
+        snapshot = CATALOG_SNAPSHOTS.current()
+        if snapshot is None:
+            return None
+
+        rows = self._snapshot_rows(snapshot, search_meta_data)
+        CATALOG_SNAPSHOTS.record(rows is not None)
+        if rows is None:
+            return None
+
+        # sort fields stay projected, the cursor is built from them
+        extra = {order.field for order in self._key_set_orders(search_meta_data.orders)}
+        return self._listing_page(search_meta_data,
+                                  self._snapshot_resources(snapshot, rows, search_meta_data.fields, extra))
+
+    def _snapshot_many(self, identifiers: list, match_expression: object | None) -> list[dict] | None:
+        """The resources of identifiers from the snapshot, None unless it holds every one of them
+        """
+        snapshot = CATALOG_SNAPSHOTS.current()
+        if snapshot is None or match_expression is not None:
+            return None
+
+        rows = [snapshot.find(identifier) for identifier in identifiers]
+        CATALOG_SNAPSHOTS.record(None not in rows)
+        if None in rows:
+            return None
+
+        return self._snapshot_resources(snapshot, rows, self.requested_fields())
+
+    def fetch_listing(self, mongo: MongoClient, search_meta_data: SearchMetaData = None):
+        if search_meta_data is None:
+            search_meta_data = self.get_search_meta_data()
+
+        page = self._snapshot_page(search_meta_data)
+        if page is None:
+            return super().fetch_listing(mongo, search_meta_data)
+
+        (result, cursor) = page
+        result = self._with_live_fields(mongo, result, search_meta_data.fields)
+        return PageResponse(self._enhancer(mongo, result, search_meta_data.fields), cursor)
+
+    async def fetch_listing_async(self, mongo: 'AsyncIOMotorClient', search_meta_data: SearchMetaData = None):
+        if search_meta_data is None:
+            search_meta_data = self.get_search_meta_data()
+
+        page = self._snapshot_page(search_meta_data)
+        if page is None:
+            return await super().fetch_listing_async(mongo, search_meta_data)
+
+        (result, cursor) = page
+        result = await self._with_live_fields_async(mongo, result, search_meta_data.fields)
+        return PageResponse(await self._enhancer_async(mongo, result, search_meta_data.fields), cursor)
+
+    def fetch_single(self, mongo: MongoClient, identifier, match_expression: object | None = None):
+        result = self._snapshot_many([parse_search_value(identifier)], match_expression)
+        if result is None:
+            return super().fetch_single(mongo, identifier, match_expression)
+
+        fields = self.requested_fields()
+        return self._enhancer(mongo, self._with_live_fields(mongo, result, fields), fields)[0]
+
+    async def fetch_single_async(self, mongo: 'AsyncIOMotorClient', identifier, match_expression: object | None = None):
+        result = self._snapshot_many([parse_search_value(identifier)], match_expression)
+        if result is None:
+            return await super().fetch_single_async(mongo, identifier, match_expression)
+
+        fields = self.requested_fields()
+        return (await self._enhancer_async(mongo, await self._with_live_fields_async(mongo, result, fields),
+                                           fields))[0]
+
+    def fetch_many(self, mongo: MongoClient, identifiers: list,
+                   match_expression: object | None = None) -> BatchResponse:
+        parsed = list(dict.fromkeys(parse_search_value(identifier) for identifier in identifiers))
+        result = self._snapshot_many(parsed, match_expression)
+        if result is None:
+            return super().fetch_many(mongo, identifiers, match_expression)
+
+        fields = self.requested_fields()
+        self._enhancer(mongo, self._with_live_fields(mongo, result, fields), fields)
+        return self._batch_response(parsed, result)
+
+    async def fetch_many_async(self, mongo: 'AsyncIOMotorClient', identifiers: list,
+                               match_expression: object | None = None) -> BatchResponse:
+        parsed = list(dict.fromkeys(parse_search_value(identifier) for identifier in identifiers))
+        result = self._snapshot_many(parsed, match_expression)
+        if result is None:
+            return await super().fetch_many_async(mongo, identifiers, match_expression)
+
+        fields = self.requested_fields()
+        await self._enhancer_async(mongo, await self._with_live_fields_async(mongo, result, fields), fields)
+        return self._batch_response(parsed, result)
 
 
 EXPLORE_FIELD_LOGIC: Final[ExploreFieldLogic] = ExploreFieldLogic(
@@ -69,12 +247,80 @@ EXPLORE_FIELD_LOGIC: Final[ExploreFieldLogic] = ExploreFieldLogic(
     EXPLORE_ALLOWED_ORDER_FIELDS,
     EXPLORE_ALLOWED_SEARCH_FIELDS,
     EXPLORE_PAGE_SIZE_LIMIT,
+    indexes=EXPLORE_INDEXES,
+    term_fields=EXPLORE_TERM_FIELDS
 )
 
 
+def _tag_for_cache(movies):
+    cache_tags({movie['imdb_id'] for movie in movies})
+
+    if any(movie.get('posterPending') for movie in movies):
+        skip_response_cache()
+
+
 def get_list(mongo: MongoClient) -> PageResponse:
-    return EXPLORE_FIELD_LOGIC.fetch_listing(mongo)
+    result = EXPLORE_FIELD_LOGIC.fetch_listing(mongo)
+    _tag_for_cache(result.page)
+
+    return result
+
+
+async def get_list_async(mongo: 'AsyncIOMotorClient') -> PageResponse:
+    result = await EXPLORE_FIELD_LOGIC.fetch_listing_async(mongo)
+    _tag_for_cache(result.page)
+
+    return result
 
 
 def get_resource(mongo, imdb_id):
-    return EXPLORE_FIELD_LOGIC.fetch_single(mongo, imdb_id)
+    result = EXPLORE_FIELD_LOGIC.fetch_single(mongo, imdb_id)
+    _tag_for_cache([result])
+
+    return result
+
+
+async def get_resource_async(mongo, imdb_id):
+    result = await EXPLORE_FIELD_LOGIC.fetch_single_async(mongo, imdb_id)
+    _tag_for_cache([result])
+
+    return result
+
+
+def autocomplete(mongo: MongoClient) -> list[Suggestion]:
+    """Titles starting with ?q=, most voted first, answered from memory
+    """
+    limit = AUTOCOMPLETE_LIMIT
+    if current_request().args.get('l'):
+        limit = parse_limit(current_request().args.get('l'), AUTOCOMPLETE_MAX_LIMIT)
+
+    TITLE_AUTOCOMPLETE.ensure_loaded(mongo)
+    return TITLE_AUTOCOMPLETE.suggest(current_request().args.get('q', ''), limit)
+
+
+async def autocomplete_async(mongo: 'AsyncIOMotorClient') -> list[Suggestion]:
+    # loaded before serving, so this never waits on the database
+    return autocomplete(mongo.delegate)
+
+
+def _batch_imdb_ids() -> list[str]:
+    imdb_ids = [imdb_id.strip() for imdb_id in current_request().args.get('ids', '').split(',') if imdb_id.strip()]
+
+    if len(imdb_ids) > EXPLORE_BATCH_SIZE_LIMIT:
+        raise TooManyIdentifiersException("at most {} imdb_ids per batch".format(EXPLORE_BATCH_SIZE_LIMIT))
+
+    return imdb_ids
+
+
+def get_batch(mongo) -> BatchResponse:
+    result = EXPLORE_FIELD_LOGIC.fetch_many(mongo, _batch_imdb_ids())
+    _tag_for_cache(result.resources)
+
+    return result
+
+
+async def get_batch_async(mongo) -> BatchResponse:
+    result = await EXPLORE_FIELD_LOGIC.fetch_many_async(mongo, _batch_imdb_ids())
+    _tag_for_cache(result.resources)
+
+    return result
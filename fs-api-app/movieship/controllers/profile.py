@@ -2,14 +2,20 @@ import uuid
 from typing import Final
 
 from flask import request
-from jose import jwt
+from pymongo import ReturnDocument
 from pymongo.errors import DuplicateKeyError
 
 import movieship.logic
-from movieship.auth import get_token_auth_header
-from movieship.exceptions import DisplayNameDuplicateException, ProfileAlreadyExistsException
+from movieship.auth import current_sub
+from movieship.context import request_json, current_request
+from movieship.controllers.watchlist import WATCHLIST_HYDRATION_LIMIT, hydrate_movies, movies_page_pipeline, \
+    movies_page_response, movies_page_request
+from movieship.exceptions import DisplayNameDuplicateException, ProfileAlreadyExistsException, \
+    ResourceNotFoundException
 
-from movieship.logic import SearchOrder, OrderType
+from movieship.indexes import IndexSpec, index
+from movieship.logic import SearchOrder, OrderType, expand_requested, PipelineModifier
+from movieship.renames import NameFanout
 
 PROFILE_COLLECTION_NAME: Final[str] = 'profile'
 PROFILE_IDENTIFIER_FIELD: Final[str] = 'sub'
@@ -21,31 +27,42 @@ PROFILE_RESOURCE_FIELDS: Final[dict[str, str]] = {
     'watchlist': '$watchlist',
     'watchlist_movies': '$watchlist_movies'
 }
-PROFILE_PIPELINE_QUERY_MODIFIER = [{
-    '$unwind': {
-        'path': '$watchlist',
-        'includeArrayIndex': 'watch',
-        'preserveNullAndEmptyArrays': True
+PROFILE_INDEXES: Final[list[IndexSpec]] = [
+    index('sub', unique=True),
+    index('sub', 'name'),
+]
+PROFILE_NAME_PROJECTION: Final[dict[str, int]] = {'_id': 0, 'name': 1}
+WATCHLIST_MUTATION_ATTEMPTS: Final[int] = 3
+# every list keeps its count but only its first WATCHLIST_HYDRATION_LIMIT titles, the rest is paged
+PROFILE_PIPELINE_QUERY_MODIFIER: Final[list[PipelineModifier]] = [PipelineModifier({'watchlist_movies'}, [{
+    '$set': {
+        'watchlist_page': {
+            '$reduce': {
+                'input': {'$ifNull': ['$watchlist', []]},
+                'initialValue': [],
+                'in': {'$setUnion': ['$$value', {'$slice': [{'$ifNull': ['$$this.imdb_ids', []]},
+                                                            WATCHLIST_HYDRATION_LIMIT]}]}
+            }
+        }
     }
-}, {
-    '$lookup': {
-        'from': 'movies',
-        'localField': 'watchlist.imdb_ids',
-        'foreignField': 'tconst',
-        'as': 'watchlist_movies'
+}, hydrate_movies('watchlist_page', 'watchlist_movies')]), PipelineModifier({'watchlist'}, [{
+    '$set': {
+        'watchlist': {
+            '$map': {
+                'input': {'$ifNull': ['$watchlist', []]},
+                'in': {
+                    'title': '$$this.title',
+                    'count': {'$size': {'$ifNull': ['$$this.imdb_ids', []]}},
+                    'imdb_ids': {'$slice': [{'$ifNull': ['$$this.imdb_ids', []]}, WATCHLIST_HYDRATION_LIMIT]}
+                }
+            }
+        }
     }
-}]
+}])]
 
 
 class ProfileFieldLogic(movieship.logic.FieldLogic):
-    def _enhancer(self, mongo, values):
-        for profile in values:
-            profile['_id'] = str(profile['_id'])
-
-            if 'watchlist_movies' in profile:
-                for movie in profile['watchlist_movies']:
-                    movie['_id'] = str(movie['_id'])
-
+    def _enhancer(self, mongo, values, fields=None):
         return values
 
 
@@ -54,77 +71,234 @@ PROFILE_FIELD_LOGIC: Final[ProfileFieldLogic] = ProfileFieldLogic(
     PROFILE_IDENTIFIER_FIELD,
     PROFILE_IDENTITY_ORDER_FIELD,
     PROFILE_RESOURCE_FIELDS,
-    pipeline_query_modifiers=PROFILE_PIPELINE_QUERY_MODIFIER
+    pipeline_query_modifiers=PROFILE_PIPELINE_QUERY_MODIFIER,
+    indexes=PROFILE_INDEXES
 )
 
 
+# collections keeping a copy of the display name register themselves with add_target
+PROFILE_RENAMES: Final[NameFanout] = NameFanout()
+
+
+def profile_name(mongo, sub) -> str | None:
+    """The display name of the profile, None when there is no profile or it has no name yet
+
+    Reviews copy the name when they are written, the (sub, name) index covers this lookup.
+    """
+    profile = mongo['movieDB'][PROFILE_COLLECTION_NAME].find_one({'sub': sub}, PROFILE_NAME_PROJECTION)
+
+    if profile is None:
+        return None
+
+    return profile.get('name')
+
+
+async def profile_name_async(mongo, sub) -> str | None:
+    profile = await mongo['movieDB'][PROFILE_COLLECTION_NAME].find_one({'sub': sub}, PROFILE_NAME_PROJECTION)
+
+    if profile is None:
+        return None
+
+    return profile.get('name')
+
+
 def get_resource(mongo):
-    auth_sub = jwt.get_unverified_claims(get_token_auth_header())['sub']
+    auth_sub = current_sub()
 
     return PROFILE_FIELD_LOGIC.fetch_single(mongo, auth_sub)
 
 
+async def get_resource_async(mongo):
+    auth_sub = current_sub()
+
+    return await PROFILE_FIELD_LOGIC.fetch_single_async(mongo, auth_sub)
+
+
+def _watchlist_entry_projection(title) -> dict[str, object]:
+    return {'_id': 0, 'sub': 1, 'watchlist': {'$elemMatch': {'title': title}}}
+
+
+def _watchlist_mutations(sub, title, imdb_id) -> list[tuple[dict, dict, list | None]]:
+    """The conditional updates that add imdb_id to the named list, tried in order
+
+    Adding to an existing list and creating a missing one are each a single atomic update, the
+    title guards keep two racing requests from both creating the list.
+    """
+    return [
+        ({'sub': sub, 'watchlist.title': title},
+         {'$addToSet': {'watchlist.$[list].imdb_ids': imdb_id}},
+         [{'list.title': title}]),
+        ({'sub': sub, 'watchlist.title': {'$ne': title}},
+         {'$push': {'watchlist': {'title': title, 'imdb_ids': [imdb_id]}}},
+         None),
+    ]
+
+
+def _watchlist_response(mongo, auth_sub, document):
+    if document is None:
+        raise ResourceNotFoundException("profile not found with sub {}".format(auth_sub))
+
+    if expand_requested():
+        return PROFILE_FIELD_LOGIC.fetch_single(mongo, auth_sub)
+
+    return document
+
+
 def add_to_watchlist(mongo):
-    auth_sub = jwt.get_unverified_claims(get_token_auth_header())['sub']
-    current = PROFILE_FIELD_LOGIC.fetch_single(mongo, auth_sub)
+    """Adds the title to the named watchlist, creating the list when missing, answering with that list only
+    """
+    auth_sub = current_sub()
+    event = request.json
+    collection = mongo['movieDB'][PROFILE_COLLECTION_NAME]
+
+    # a list created or removed between the two updates sends us around once more
+    for _ in range(WATCHLIST_MUTATION_ATTEMPTS):
+        for (match, update, array_filters) in _watchlist_mutations(auth_sub, event['title'], event['imdb_id']):
+            document = collection.find_one_and_update(match, update, array_filters=array_filters,
+                                                      projection=_watchlist_entry_projection(event['title']),
+                                                      return_document=ReturnDocument.AFTER)
+            if document is not None:
+                return _watchlist_response(mongo, auth_sub, document)
+
+    return _watchlist_response(mongo, auth_sub, None)
+
+
+async def add_to_watchlist_async(mongo):
+    auth_sub = current_sub()
+    event = await request_json()
+    collection = mongo['movieDB'][PROFILE_COLLECTION_NAME]
+
+    for _ in range(WATCHLIST_MUTATION_ATTEMPTS):
+        for (match, update, array_filters) in _watchlist_mutations(auth_sub, event['title'], event['imdb_id']):
+            document = await collection.find_one_and_update(match, update, array_filters=array_filters,
+                                                            projection=_watchlist_entry_projection(event['title']),
+                                                            return_document=ReturnDocument.AFTER)
+            if document is not None:
+                return await _watchlist_response_async(mongo, auth_sub, document)
+
+    return await _watchlist_response_async(mongo, auth_sub, None)
+
+
+async def _watchlist_response_async(mongo, auth_sub, document):
+    if document is None:
+        raise ResourceNotFoundException("profile not found with sub {}".format(auth_sub))
+
+    if expand_requested():
+        return await PROFILE_FIELD_LOGIC.fetch_single_async(mongo, auth_sub)
+
+    return document
 
+
+def remove_from_watchlist(mongo):
+    """Pulls the title from the named watchlist in one update, answering with that list only
+    """
+    auth_sub = current_sub()
     event = request.json
-    watchlist_name_to_add_or_create = event['title']
-
-    watchlist_to_save = []
-
-    if 'watchlist' in current:
-        watchlist_current = current['watchlist']
-        watchlist_to_add_to = None
-
-        for title in watchlist_current:
-            if title == watchlist_name_to_add_or_create:
-                watchlist_to_add_to = title
-            else:
-                watchlist_to_save.append(title)
-
-        if watchlist_to_add_to is None:
-            watchlist_to_save += [{
-                'title': watchlist_name_to_add_or_create,
-                'imdb_ids': [event['imdb_id']]
-            }]
-        else:
-            watchlist_to_save += [{
-                'title': watchlist_name_to_add_or_create,
-                'imdb_ids': list({event['imdb_id'], *(watchlist_to_add_to['imdb_ids'])})
-            }]
-    else:
-        watchlist_to_save += [{
-            'title': watchlist_name_to_add_or_create,
-            'imdb_ids': [event['imdb_id']]
-        }]
-
-    current['watchlist'] = watchlist_to_save
-    current.pop('_id', None)
-
-    result = mongo['movieDB'][PROFILE_COLLECTION_NAME].update_one({'sub': current['sub']}, {'$set': current})
 
-    return PROFILE_FIELD_LOGIC.fetch_single(mongo, auth_sub)
+    document = mongo['movieDB'][PROFILE_COLLECTION_NAME].find_one_and_update(
+        {'sub': auth_sub},
+        {'$pull': {'watchlist.$[list].imdb_ids': event['imdb_id']}},
+        array_filters=[{'list.title': event['title']}],
+        projection=_watchlist_entry_projection(event['title']),
+        return_document=ReturnDocument.AFTER
+    )
+
+    return _watchlist_response(mongo, auth_sub, document)
+
+
+async def remove_from_watchlist_async(mongo):
+    auth_sub = current_sub()
+    event = await request_json()
+
+    document = await mongo['movieDB'][PROFILE_COLLECTION_NAME].find_one_and_update(
+        {'sub': auth_sub},
+        {'$pull': {'watchlist.$[list].imdb_ids': event['imdb_id']}},
+        array_filters=[{'list.title': event['title']}],
+        projection=_watchlist_entry_projection(event['title']),
+        return_document=ReturnDocument.AFTER
+    )
+
+    return await _watchlist_response_async(mongo, auth_sub, document)
+
+
+def _watchlist_movies_ids() -> dict:
+    title = current_request().args.get('title', '')
+
+    return {'$getField': {
+        'field': 'imdb_ids',
+        'input': {'$first': {'$filter': {'input': '$watchlist', 'cond': {'$eq': ['$$this.title', title]}}}}
+    }}
+
+
+def get_watchlist_movies(mongo):
+    """One page of the titles in the profile's watchlist named by ?title=, with the list's full count
+    """
+    (offset, limit) = movies_page_request()
+    pipeline = movies_page_pipeline({'sub': current_sub()}, _watchlist_movies_ids(), offset, limit)
+
+    return movies_page_response(list(mongo['movieDB'][PROFILE_COLLECTION_NAME].aggregate(pipeline)), offset, limit)
+
+
+async def get_watchlist_movies_async(mongo):
+    (offset, limit) = movies_page_request()
+    pipeline = movies_page_pipeline({'sub': current_sub()}, _watchlist_movies_ids(), offset, limit)
+
+    return movies_page_response(await mongo['movieDB'][PROFILE_COLLECTION_NAME].aggregate(pipeline).to_list(None),
+                                offset, limit)
 
 
 def create(mongo):
     event = request.json
-    sub = jwt.get_unverified_claims(get_token_auth_header())['sub']
+    sub = current_sub()
     event['sub'] = sub
     event['watchlist'] = []
 
     try:
-        return PROFILE_FIELD_LOGIC.create_m(mongo, event, sub)  # get_resource(mongo)
+        return PROFILE_FIELD_LOGIC.create_m(mongo, event, sub, expand_requested())  # get_resource(mongo)
+    except DuplicateKeyError:
+        raise ProfileAlreadyExistsException("already exists")
+
+
+async def create_async(mongo):
+    event = await request_json()
+    sub = current_sub()
+    event['sub'] = sub
+    event['watchlist'] = []
+
+    try:
+        return await PROFILE_FIELD_LOGIC.create_m_async(mongo, event, sub, expand_requested())
     except DuplicateKeyError:
         raise ProfileAlreadyExistsException("already exists")
 
 
 def update(mongo):
-    auth_sub = jwt.get_unverified_claims(get_token_auth_header())['sub']
+    auth_sub = current_sub()
 
     event = request.json
 
     try:
-        return PROFILE_FIELD_LOGIC.update(mongo, event, auth_sub)  # get_resource(mongo)
+        result = PROFILE_FIELD_LOGIC.update(mongo, event, auth_sub, expand_requested())  # get_resource(mongo)
     except DuplicateKeyError:
         raise DisplayNameDuplicateException("name duplicate")
+
+    if 'name' in event:
+        PROFILE_RENAMES.submit(mongo, auth_sub, event['name'])
+
+    return result
+
+
+async def update_async(mongo):
+    auth_sub = current_sub()
+
+    event = await request_json()
+
+    try:
+        result = await PROFILE_FIELD_LOGIC.update_async(mongo, event, auth_sub, expand_requested())
+    except DuplicateKeyError:
+        raise DisplayNameDuplicateException("name duplicate")
+
+    if 'name' in event:
+        # the fan-out runs on its own thread with the driver's sync client
+        PROFILE_RENAMES.submit(mongo.delegate, auth_sub, event['name'])
+
+    return result
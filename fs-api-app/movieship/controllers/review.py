@@ -2,17 +2,22 @@ import time
 from datetime import datetime
 from typing import Final
 
+import pymongo
 from bson import ObjectId
 from flask import request
-from jose import jwt
 
 import movieship.logic
-from movieship.auth import get_token_auth_header
+from movieship.aggregates import ReviewAggregates, REVIEW_STATS_TRACKED_FIELDS
+from movieship.auth import current_sub
+from movieship.context import current_request, request_json
 
 from movieship.controllers import root, profile
-from movieship.exceptions import ProfileNotValidException, ResourceNotFoundException
+from movieship.controllers.explore import EXPLORE_COLLECTION_NAME, EXPLORE_RESPONSE_CACHE
+from movieship.exceptions import ProfileNotValidException
 
-from movieship.logic import SearchFilter, SearchType, SearchOrder, OrderType, parse_search_value
+from movieship.indexes import IndexSpec, index
+from movieship.logic import SearchFilter, SearchType, SearchOrder, OrderType, parse_search_value, \
+    expand_requested
 
 REVIEW_COLLECTION_NAME: Final[str] = 'reviews'
 REVIEW_IDENTIFIER_FIELD: Final[str] = '_id'
@@ -29,36 +34,25 @@ REVIEW_RESOURCE_FIELDS: Final[dict[str, str]] = {
     'user': '$user',
     'username': '$username',
 }
-REVIEW_PIPELINE_QUERY_MODIFIER = [{
-    '$lookup': {
-        'from': 'profile',
-        'localField': 'user',
-        'foreignField': 'sub',
-        'as': 'result'
-    }
-}, {
-    '$set': {
-        'username': {
-            '$first': '$result.name'
-        }
-    }
-}]
+REVIEW_INDEXES: Final[list[IndexSpec]] = [
+    index(('user', pymongo.DESCENDING), ('imdb_id', pymongo.DESCENDING), unique=True),
+    index('imdb_id', ('timestamp', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)),
+]
+# username is copied from the profile when the review is written and rewritten by PROFILE_RENAMES
+REVIEW_READ_ONLY_FIELDS: Final[tuple[str, ...]] = ('user', 'username')
 
 
 def getCurrentUser():
     current_user = None
 
-    if "Authorization" in request.headers:
-        current_user = jwt.get_unverified_claims(get_token_auth_header())['sub']
+    if "Authorization" in current_request().headers:
+        current_user = current_sub()
 
     return current_user
 
 
 class CommentFieldLogic(movieship.logic.FieldLogic):
-    def _enhancer(self, mongo, values):
-        for review in values:
-            review['_id'] = str(review['_id'])
-
+    def _enhancer(self, mongo, values, fields=None):
         return values
 
 
@@ -70,11 +64,23 @@ REVIEW_FIELD_LOGIC: Final[CommentFieldLogic] = CommentFieldLogic(
     REVIEW_ALLOWED_ORDER_FIELDS,
     REVIEW_ALLOWED_SEARCH_FIELDS,
     REVIEW_PAGE_SIZE_LIMIT,
-    pipeline_query_modifiers=REVIEW_PIPELINE_QUERY_MODIFIER
+    indexes=REVIEW_INDEXES
 )
+profile.PROFILE_RENAMES.add_target(REVIEW_COLLECTION_NAME, 'user', 'username')
+REVIEW_AGGREGATES: Final[ReviewAggregates] = ReviewAggregates(REVIEW_COLLECTION_NAME, EXPLORE_COLLECTION_NAME, 'tconst')
 
 
-def get_list(mongo, imdb_id):
+def _aggregate(mongo, imdb_id, before, after):
+    if REVIEW_AGGREGATES.apply(mongo, imdb_id, before, after):
+        EXPLORE_RESPONSE_CACHE.publish(mongo, {imdb_id})
+
+
+async def _aggregate_async(mongo, imdb_id, before, after):
+    if await REVIEW_AGGREGATES.apply_async(mongo, imdb_id, before, after):
+        EXPLORE_RESPONSE_CACHE.publish(mongo.delegate, {imdb_id})
+
+
+def _listing_search_meta(imdb_id):
     search_meta = REVIEW_FIELD_LOGIC.get_search_meta_data()
 
     search_meta.filters.append(SearchFilter(
@@ -83,59 +89,137 @@ def get_list(mongo, imdb_id):
         SearchType.EQUIVALENT
     ))
 
-    result = REVIEW_FIELD_LOGIC.fetch_listing(mongo, search_meta)
+    return search_meta
+
+
+def get_list(mongo, imdb_id):
+    result = REVIEW_FIELD_LOGIC.fetch_listing(mongo, _listing_search_meta(imdb_id))
 
     return result
 
 
+async def get_list_async(mongo, imdb_id):
+    return await REVIEW_FIELD_LOGIC.fetch_listing_async(mongo, _listing_search_meta(imdb_id))
+
+
 def create_resource(mongo, imdb_id):
     event = request.json
-    event['user'] = jwt.get_unverified_claims(get_token_auth_header())['sub']
+    event['user'] = current_sub()
+    event['username'] = profile.profile_name(mongo, event['user'])
 
-    try:
-        user_profile = profile.get_resource(mongo)
+    if not event['username']:
+        raise ProfileNotValidException("profile does not exist or name is missing")
 
-        # if user_profile is None or user_profile['name'] is None or user_profile['name'] is '':
-        #     raise ProfileNotValidException("profile does not exist or name is missing")
+    event['imdb_id'] = imdb_id
+    event['timestamp'] = int(round(datetime.now().timestamp()))
+
+    print("inserting", event)
+    result = REVIEW_FIELD_LOGIC.create(mongo, event, expand_requested())
+    _aggregate(mongo, imdb_id, None, event)
+
+    return result
 
-        event['imdb_id'] = imdb_id
-        event['timestamp'] = int(round(datetime.now().timestamp()))
 
-        print("inserting", event)
-        return REVIEW_FIELD_LOGIC.create(mongo, event)
-    except ResourceNotFoundException:
+async def create_resource_async(mongo, imdb_id):
+    event = await request_json()
+    event['user'] = current_sub()
+    event['username'] = await profile.profile_name_async(mongo, event['user'])
+
+    if not event['username']:
         raise ProfileNotValidException("profile does not exist or name is missing")
 
+    event['imdb_id'] = imdb_id
+    event['timestamp'] = int(round(datetime.now().timestamp()))
 
-def get_resource(mongo, imdb_id):
-    current_user = getCurrentUser()
+    result = await REVIEW_FIELD_LOGIC.create_async(mongo, event, expand_requested())
+    await _aggregate_async(mongo, imdb_id, None, event)
+
+    return result
 
-    return REVIEW_FIELD_LOGIC.fetch_single_with_expression(mongo, {
+
+def _current_user_review(imdb_id):
+    return {
         '$and': [{
             'imdb_id': {
                 '$eq': parse_search_value(imdb_id)
             }
         }, {
             'user': {
-                '$eq': parse_search_value(current_user)
+                '$eq': parse_search_value(getCurrentUser())
             }
         }]
-    })
+    }
+
+
+def get_resource(mongo, imdb_id):
+    return REVIEW_FIELD_LOGIC.fetch_single_with_expression(mongo, _current_user_review(imdb_id))
+
+
+async def get_resource_async(mongo, imdb_id):
+    return await REVIEW_FIELD_LOGIC.fetch_single_with_expression_async(mongo, _current_user_review(imdb_id))
+
+
+def _writable(event):
+    for read_only in REVIEW_READ_ONLY_FIELDS:
+        event.pop(read_only, None)
+
+    return event
 
 
 def update_resource(mongo, imdb_id):
     current_user = getCurrentUser()
 
-    event = request.json
+    event = _writable(request.json)
+    event['imdb_id'] = imdb_id
+    match = {'user': current_user, 'imdb_id': imdb_id}
+
+    if 'rating' not in event:
+        return REVIEW_FIELD_LOGIC.update_m(mongo, event, match, expand_requested())  # get_resource(mongo)
+
+    # the rating it replaced comes from the same write, so the aggregate moves by exactly this update
+    (resource, before) = REVIEW_FIELD_LOGIC.update_m_with_previous(mongo, event, match, REVIEW_STATS_TRACKED_FIELDS,
+                                                                   expand_requested())
+    _aggregate(mongo, imdb_id, before, {**before, **event})
+
+    return resource
+
+
+async def update_resource_async(mongo, imdb_id):
+    current_user = getCurrentUser()
+
+    event = _writable(await request_json())
     event['imdb_id'] = imdb_id
+    match = {'user': current_user, 'imdb_id': imdb_id}
+
+    if 'rating' not in event:
+        return await REVIEW_FIELD_LOGIC.update_m_async(mongo, event, match, expand_requested())
 
-    return REVIEW_FIELD_LOGIC.update_m(mongo, event,
-                                       {'user': current_user, 'imdb_id': imdb_id})  # get_resource(mongo)
+    (resource, before) = await REVIEW_FIELD_LOGIC.update_m_with_previous_async(
+        mongo, event, match, REVIEW_STATS_TRACKED_FIELDS, expand_requested())
+    await _aggregate_async(mongo, imdb_id, before, {**before, **event})
+
+    return resource
 
 
 def delete_resource(mongo, imdb_id):
     current_user = getCurrentUser()
 
-    event = request.json
+    match = {"imdb_id": imdb_id, "user": current_user}
+
+    # the rating is projected along with the resource, the aggregate needs it even when fields= leaves it out
+    (resource, deleted) = REVIEW_FIELD_LOGIC.delete_with_previous(mongo, match, REVIEW_STATS_TRACKED_FIELDS)
+    _aggregate(mongo, imdb_id, deleted, None)
+
+    return resource
+
+
+async def delete_resource_async(mongo, imdb_id):
+    current_user = getCurrentUser()
+
+    match = {"imdb_id": imdb_id, "user": current_user}
+
+    (resource, deleted) = await REVIEW_FIELD_LOGIC.delete_with_previous_async(mongo, match,
+                                                                              REVIEW_STATS_TRACKED_FIELDS)
+    await _aggregate_async(mongo, imdb_id, deleted, None)
 
-    return REVIEW_FIELD_LOGIC.delete(mongo, {"imdb_id": imdb_id, "user": current_user})
+    return resource
@@ -14,8 +14,8 @@ class ApiResponse:
 
 @dataclass
 class Cursor:
-    next: str
-    previous: str
+    next: str | None
+    previous: str | None
 
 
 @dataclass
@@ -24,8 +24,21 @@ class PageResponse:
     cursor: Cursor | None
 
 
+@dataclass
+class CountedPageResponse:
+    page: list[T]
+    cursor: Cursor | None
+    count: int
+
+
+@dataclass
+class BatchResponse:
+    resources: list[T]
+    missing: list[str]
+
+
 def make_api(root: dict[str, any], name: str, can_create: str = "", can_destroy="", can_update="", can_list="",
-             can_resource="", path_identifiers: list[str] = None, primary_identifier: str = None):
+             can_resource="", path_identifiers: list[str] = None, primary_identifier: str = None, can_batch=""):
     if can_create:
         root[name + "_CREATE"] = can_create
     if can_destroy:
@@ -36,6 +49,8 @@ def make_api(root: dict[str, any], name: str, can_create: str = "", can_destroy=
         root[name + "_LISTING"] = can_list
     if can_resource:
         root[name + "_RESOURCE"] = can_resource
+    if can_batch:
+        root[name + "_BATCH"] = can_batch
     if path_identifiers:
         root[name + "_PATH_IDENTIFIERS"] = path_identifiers
     if primary_identifier:
@@ -45,9 +60,12 @@ def make_api(root: dict[str, any], name: str, can_create: str = "", can_destroy=
 
 
 API_ROOT_PATH: Final[str] = "/api/v1"
+STATS_PATH: Final[str] = API_ROOT_PATH + "/stats"
 
 EXPLORE_PATH: Final[str] = API_ROOT_PATH + "/explore"
 EXPLORE_RESOURCE_PATH: Final[str] = EXPLORE_PATH + "/<imdb_id>"
+EXPLORE_BATCH_PATH: Final[str] = EXPLORE_PATH + "/batch"
+EXPLORE_AUTOCOMPLETE_PATH: Final[str] = EXPLORE_PATH + "/autocomplete"
 
 REVIEW_PATH: Final[str] = EXPLORE_RESOURCE_PATH + "/review"
 REVIEW_LISTING_PATH: Final[str] = REVIEW_PATH + "/list"
@@ -58,11 +76,14 @@ PROFILE_PATH_RESOURCE: Final[str] = API_ROOT_PATH + "/profile"
 PROFILE_CREATE_PATH: Final[str] = PROFILE_PATH_RESOURCE + "/create"
 
 PROFILE_ADD_TO_WATCH_LIST_PATH: Final[str] = PROFILE_PATH_RESOURCE + "/watchlist"
+PROFILE_REMOVE_FROM_WATCH_LIST_PATH: Final[str] = PROFILE_ADD_TO_WATCH_LIST_PATH + "/remove"
+PROFILE_WATCH_LIST_MOVIES_PATH: Final[str] = PROFILE_ADD_TO_WATCH_LIST_PATH + "/movies"
 
 WATCHLIST_PATH: Final[str] = API_ROOT_PATH + "/watchlist"
 WATCHLIST_RESOURCE_PATH: Final[str] = WATCHLIST_PATH + "/<watchlist_id>"
 WATCHLIST_CREATE_PATH: Final[str] = WATCHLIST_PATH + "/create"
 WATCHLIST_DELETE_PATH: Final[str] = WATCHLIST_RESOURCE_PATH + "/delete"
+WATCHLIST_MOVIES_PATH: Final[str] = WATCHLIST_RESOURCE_PATH + "/movies"
 
 
 def routes():
@@ -70,7 +91,8 @@ def routes():
     api_root["API_ROOT"] = API_ROOT_PATH
 
     make_api(api_root, "EXPLORE", can_list=EXPLORE_PATH, can_resource=EXPLORE_RESOURCE_PATH,
-             path_identifiers=['imdb_id'], primary_identifier='imdb_id')
+             path_identifiers=['imdb_id'], primary_identifier='imdb_id', can_batch=EXPLORE_BATCH_PATH)
+    api_root["EXPLORE_AUTOCOMPLETE"] = EXPLORE_AUTOCOMPLETE_PATH
     make_api(api_root, "REVIEW", can_list=REVIEW_LISTING_PATH, can_resource=REVIEW_PATH,
              can_create=REVIEW_CREATE_PATH, can_update=REVIEW_PATH, can_destroy=REVIEW_DELETE_PATH,
              path_identifiers=['imdb_id']),
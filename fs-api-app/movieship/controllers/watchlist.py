@@ -1,16 +1,22 @@
 import uuid
 from typing import Final
 
+import pymongo
 from bson import ObjectId
 from flask import request
-from jose import jwt
 from pymongo.errors import DuplicateKeyError
 
 import movieship.logic
-from movieship.auth import get_token_auth_header
-from movieship.exceptions import DisplayNameDuplicateException
+from movieship.auth import current_sub
+from movieship.context import request_json, current_request
+from movieship.controllers.explore import EXPLORE_COLLECTION_NAME
+from movieship.controllers.root import CountedPageResponse, Cursor
+from movieship.exceptions import DisplayNameDuplicateException, ResourceNotFoundException, \
+    InvalidPaginationException
 
-from movieship.logic import SearchOrder, OrderType, SearchType, SearchFilter
+from movieship.indexes import IndexSpec, index
+from movieship.logic import SearchOrder, OrderType, SearchType, SearchFilter, expand_requested, \
+    PipelineModifier, CursorDirection, encode_cursor, decode_cursor, parse_limit
 
 WATCHLIST_COLLECTION_NAME: Final[str] = 'watchlist'
 WATCHLIST_IDENTIFIER_FIELD: Final[str] = '_id'
@@ -23,27 +29,64 @@ WATCHLIST_RESOURCE_FIELDS: Final[dict[str, str]] = {
     'title': '$title',
     'sub': '$sub',
     'watchlist': '$watchlist',
+    'watchlist_count': '$watchlist_count',
     'watchlist_movies': '$watchlist_movies'
 }
-WATCHLIST_PIPELINE_QUERY_MODIFIER = [{
-    '$lookup': {
-        'from': 'movies',
-        'localField': 'watchlist',
-        'foreignField': 'tconst',
-        'as': 'watchlist_movies'
+WATCHLIST_INDEXES: Final[list[IndexSpec]] = [
+    index(('sub', pymongo.DESCENDING), ('title', pymongo.DESCENDING), unique=True),
+    index('sub', '_id'),
+]
+WATCHLIST_HYDRATION_LIMIT: Final[int] = 25
+WATCHLIST_MOVIES_PAGE_SIZE_LIMIT: Final[int] = 50
+WATCHLIST_MOVIE_FIELDS: Final[dict[str, object]] = {
+    '_id': 0,
+    'imdb_id': '$tconst',
+    'titleType': '$titleType',
+    'primaryTitle': '$primaryTitle',
+    'startYear': '$startYear',
+    'averageRating': '$averageRating',
+    'poster': '$poster',
+}
+WATCHLIST_OFFSET_ORDER: Final[list[SearchOrder]] = [SearchOrder('offset', OrderType.ASCENDING, False)]
+
+
+def hydrate_movies(ids_field: str, as_field: str) -> dict:
+    """$lookup of the titles listed in ids_field, matched on the tconst index and projected to what a watchlist shows
+    """
+    return {
+        '$lookup': {
+            'from': EXPLORE_COLLECTION_NAME,
+            'localField': ids_field,
+            'foreignField': 'tconst',
+            'pipeline': [{'$project': WATCHLIST_MOVIE_FIELDS}],
+            'as': as_field
+        }
     }
-}]
 
 
-class WatchlistFieldLogic(movieship.logic.FieldLogic):
-    def _enhancer(self, mongo, values):
-        for profile in values:
-            profile['_id'] = str(profile['_id'])
+# the list keeps its count but only its first WATCHLIST_HYDRATION_LIMIT titles, the rest is paged
+WATCHLIST_PIPELINE_QUERY_MODIFIER: Final[list[PipelineModifier]] = [
+    PipelineModifier({'watchlist', 'watchlist_count'}, [{
+        '$set': {
+            'watchlist_count': {'$size': {'$ifNull': ['$watchlist', []]}},
+            'watchlist': {'$slice': [{'$ifNull': ['$watchlist', []]}, WATCHLIST_HYDRATION_LIMIT]}
+        }
+    }]),
+    PipelineModifier({'watchlist_movies'}, [{
+        '$set': {
+            'watchlist_page': {'$slice': [{'$ifNull': ['$watchlist', []]}, WATCHLIST_HYDRATION_LIMIT]}
+        }
+    }, hydrate_movies('watchlist_page', 'watchlist_movies')])
+]
 
-            if 'watchlist_movies' in profile:
-                for movie in profile['watchlist_movies']:
-                    movie['_id'] = str(movie['_id'])
 
+class WatchlistFieldLogic(movieship.logic.FieldLogic):
+    def _enhancer(self, mongo, values, fields=None):
+        # writes return the stored list, trimmed here the way the read modifier trims it
+        for value in values:
+            if isinstance(value.get('watchlist'), list):
+                value.setdefault('watchlist_count', len(value['watchlist']))
+                value['watchlist'] = value['watchlist'][:WATCHLIST_HYDRATION_LIMIT]
         return values
 
 
@@ -55,14 +98,15 @@ WATCHLIST_FIELD_LOGIC: Final[WatchlistFieldLogic] = WatchlistFieldLogic(
     WATCHLIST_ALLOWED_ORDER_FIELDS,
     WATCHLIST_ALLOWED_SEARCH_FIELDS,
     WATCHLIST_PAGE_SIZE_LIMIT,
-    pipeline_query_modifiers=WATCHLIST_PIPELINE_QUERY_MODIFIER
+    pipeline_query_modifiers=WATCHLIST_PIPELINE_QUERY_MODIFIER,
+    indexes=WATCHLIST_INDEXES
 )
 
 
-def get_list(mongo):
+def _listing_search_meta():
     search_meta = WATCHLIST_FIELD_LOGIC.get_search_meta_data()
 
-    sub = jwt.get_unverified_claims(get_token_auth_header())['sub']
+    sub = current_sub()
 
     search_meta.filters.append(SearchFilter(
         "sub",
@@ -70,35 +114,140 @@ def get_list(mongo):
         SearchType.EQUIVALENT
     ))
 
-    result = WATCHLIST_FIELD_LOGIC.fetch_listing(mongo, search_meta)
+    return search_meta
+
+
+def get_list(mongo):
+    result = WATCHLIST_FIELD_LOGIC.fetch_listing(mongo, _listing_search_meta())
 
     return result
 
 
+async def get_list_async(mongo):
+    return await WATCHLIST_FIELD_LOGIC.fetch_listing_async(mongo, _listing_search_meta())
+
+
 def create_resource(mongo):
     event = request.json
-    event['sub'] = jwt.get_unverified_claims(get_token_auth_header())['sub']
+    event['sub'] = current_sub()
+    event['watchlist'] = []
+
+    return WATCHLIST_FIELD_LOGIC.create(mongo, event, expand_requested())
+
+
+async def create_resource_async(mongo):
+    event = await request_json()
+    event['sub'] = current_sub()
     event['watchlist'] = []
 
-    return WATCHLIST_FIELD_LOGIC.create(mongo, event)
+    return await WATCHLIST_FIELD_LOGIC.create_async(mongo, event, expand_requested())
 
 
 def get_resource(mongo):
-    auth_sub = jwt.get_unverified_claims(get_token_auth_header())['sub']
+    auth_sub = current_sub()
 
     return WATCHLIST_FIELD_LOGIC.fetch_single(mongo, auth_sub)
 
 
+async def get_resource_async(mongo):
+    auth_sub = current_sub()
+
+    return await WATCHLIST_FIELD_LOGIC.fetch_single_async(mongo, auth_sub)
+
+
 def update(mongo, watchlist_id):
-    sub = jwt.get_unverified_claims(get_token_auth_header())['sub']
+    sub = current_sub()
 
     event = request.json
 
     return WATCHLIST_FIELD_LOGIC.update_m(mongo, event,
-                                          {'sub': sub, '_id': ObjectId(watchlist_id)})
+                                          {'sub': sub, '_id': ObjectId(watchlist_id)}, expand_requested())
+
+
+async def update_async(mongo, watchlist_id):
+    sub = current_sub()
+
+    event = await request_json()
+
+    return await WATCHLIST_FIELD_LOGIC.update_m_async(mongo, event,
+                                                      {'sub': sub, '_id': ObjectId(watchlist_id)}, expand_requested())
 
 
 def delete_resource(mongo, watchlist_id):
-    sub = jwt.get_unverified_claims(get_token_auth_header())['sub']
+    sub = current_sub()
+
+    return WATCHLIST_FIELD_LOGIC.delete(mongo, {"_id": ObjectId(watchlist_id), "sub": sub}, expand_requested())
+
+
+async def delete_resource_async(mongo, watchlist_id):
+    sub = current_sub()
+
+    return await WATCHLIST_FIELD_LOGIC.delete_async(mongo, {"_id": ObjectId(watchlist_id), "sub": sub},
+                                                    expand_requested())
+
+
+def movies_page_request() -> tuple[int, int]:
+    offset = 0
+    if current_request().args.get('p'):
+        position = decode_cursor(current_request().args.get('p'))
+        offset = position.values.get('offset')
+
+        if list(position.values) != ['offset'] or not isinstance(offset, int) or offset < 0:
+            raise InvalidPaginationException("cursor does not match a watchlist page")
+
+    limit = parse_limit(current_request().args.get('l'), WATCHLIST_MOVIES_PAGE_SIZE_LIMIT)
+
+    return offset, limit
+
+
+def movies_page_pipeline(match: dict, ids_expression: object, offset: int, limit: int) -> list[dict]:
+    """Hydrates one slice of a list of imdb_ids, counting the whole list without loading it
+    """
+    ids = {'$ifNull': [ids_expression, []]}
+
+    return [{'$match': match}, {'$limit': 1}, {
+        '$project': {
+            '_id': 0,
+            'count': {'$size': ids},
+            'page': {'$slice': [ids, offset, limit]}
+        }
+    }, hydrate_movies('page', 'movies')]
+
+
+def movies_page_response(documents: list, offset: int, limit: int) -> CountedPageResponse:
+    if len(documents) == 0:
+        raise ResourceNotFoundException("watchlist not found")
+
+    document = documents[0]
+    positions = {imdb_id: position for (position, imdb_id) in enumerate(document['page'])}
+    movies = sorted(document['movies'], key=lambda movie: positions.get(movie.get('imdb_id'), 0))
+
+    cursor_next = encode_cursor(WATCHLIST_OFFSET_ORDER, {'offset': offset + limit}, CursorDirection.NEXT) \
+        if offset + limit < document['count'] else None
+    cursor_previous = encode_cursor(WATCHLIST_OFFSET_ORDER, {'offset': max(0, offset - limit)},
+                                    CursorDirection.PREVIOUS) if offset > 0 else None
+    cursor = Cursor(cursor_next, cursor_previous) if cursor_next or cursor_previous else None
+
+    return CountedPageResponse(movies, cursor, document['count'])
+
+
+def _movies_match(watchlist_id) -> dict:
+    return {'_id': ObjectId(watchlist_id), 'sub': current_sub()}
+
+
+def get_movies(mongo, watchlist_id) -> CountedPageResponse:
+    """One page of a watchlist's titles in list order, `count` is the length of the whole list
+    """
+    (offset, limit) = movies_page_request()
+    pipeline = movies_page_pipeline(_movies_match(watchlist_id), '$watchlist', offset, limit)
+
+    return movies_page_response(list(mongo['movieDB'][WATCHLIST_COLLECTION_NAME].aggregate(pipeline)),
+                                offset, limit)
+
+
+async def get_movies_async(mongo, watchlist_id) -> CountedPageResponse:
+    (offset, limit) = movies_page_request()
+    pipeline = movies_page_pipeline(_movies_match(watchlist_id), '$watchlist', offset, limit)
 
-    return WATCHLIST_FIELD_LOGIC.delete(mongo, {"_id": ObjectId(watchlist_id), "sub": sub})
+    return movies_page_response(await mongo['movieDB'][WATCHLIST_COLLECTION_NAME].aggregate(pipeline).to_list(None),
+                                offset, limit)
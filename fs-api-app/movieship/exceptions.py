@@ -24,3 +24,15 @@ class AlreadyReviewedException(Exception):
 
 class WatchlistAlreadyExistsWithName(Exception):
     pass
+
+
+class TooManyIdentifiersException(Exception):
+    pass
+
+
+class InvalidFieldException(Exception):
+    pass
+
+
+class ImportAbortedException(Exception):
+    pass
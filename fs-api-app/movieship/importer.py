@@ -0,0 +1,501 @@
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import time
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Final, Iterable, Iterator
+
+from bson import Binary
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from movieship.exceptions import ImportAbortedException
+from movieship.indexes import declare_indexes, index
+from movieship.search import search_terms, terms_field
+
+IMDB_NULL: Final[str] = '\\N'
+IMPORT_DATABASE_NAME: Final[str] = 'movieDB'
+IMPORT_SHOWS_COLLECTION_NAME: Final[str] = 'shows'
+IMPORT_BATCH_SIZE: Final[int] = 5000
+DUPLICATE_KEY_ERROR_CODE: Final[int] = 11000
+BASICS_INT_FIELDS: Final[set[str]] = {'startYear', 'endYear', 'runtimeMinutes'}
+BASICS_LIST_FIELDS: Final[set[str]] = {'genres'}
+BASICS_TERMS_FIELDS: Final[tuple[str, ...]] = ('primaryTitle',)
+IMPORT_CHECKPOINT_COLLECTION_NAME: Final[str] = 'import_checkpoints'
+IMPORT_PARTITIONS: Final[int] = os.cpu_count() or 1
+IMPORT_RUN_COLLECTION_NAME: Final[str] = 'import_runs'
+IMPORT_RUN_MAX_KEYS: Final[int] = 1_000_000
+IMPORT_RUN_KEEP: Final[timedelta] = timedelta(days=30)
+# a dump missing more of the stored titles than this is more likely truncated than a real catalog change
+IMPORT_MAX_REMOVED_SHARE: Final[float] = 0.1
+
+declare_indexes(IMPORT_CHECKPOINT_COLLECTION_NAME, [index('run')])
+declare_indexes(IMPORT_RUN_COLLECTION_NAME,
+                [index('finishedAt', expire_after_seconds=int(IMPORT_RUN_KEEP.total_seconds()))])
+
+
+def open_tsv(path: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+def read_tsv(path: str) -> Iterator[dict[str, str]]:
+    """Streams an IMDb TSV dump as one dict per row
+
+    The dumps do not quote or escape fields, so rows are split on tabs rather than read with csv.
+    """
+    with open_tsv(path) as tsv:
+        header = tsv.readline().rstrip('\r\n').split('\t')
+
+        for line in tsv:
+            row = split_row(header, line)
+
+            if row is not None:
+                yield row
+
+
+def split_row(header: list[str], line: str) -> dict[str, str] | None:
+    values = line.rstrip('\r\n').split('\t')
+    return dict(zip(header, values)) if len(values) == len(header) else None
+
+
+def parse_value(value: str):
+    return None if value == IMDB_NULL or value == '' else value
+
+
+def parse_int(value: str):
+    value = parse_value(value)
+    return int(value) if value is not None and value.isdigit() else None
+
+
+def parse_show(row: dict[str, str]) -> dict[str, any] | None:
+    """Types a title.basics row, returning None for adult titles which are not imported
+    """
+    if row.pop('isAdult', '0') != '0':
+        return None
+
+    show = {}
+    for (field, value) in row.items():
+        if field in BASICS_INT_FIELDS:
+            show[field] = parse_int(value)
+        elif field in BASICS_LIST_FIELDS:
+            value = parse_value(value)
+            show[field] = value.split(',') if value is not None else []
+        else:
+            show[field] = parse_value(value)
+
+    for field in BASICS_TERMS_FIELDS:
+        show[terms_field(field)] = search_terms(show.get(field))
+
+    return show
+
+
+def tconst_key(tconst: str) -> int | None:
+    number = tconst[2:]
+    return int(number) if tconst.startswith('tt') and number.isdigit() else None
+
+
+def imdb_id(key: int) -> str:
+    return 'tt{:07d}'.format(key)
+
+
+class RatingsIndex:
+    """tconst -> (averageRating, numVotes) held in three parallel arrays sorted by tconst number
+
+    Ratings carry a single decimal so they are stored as tenths, which keeps the roughly
+    1.4 million rows of title.ratings to about 10 bytes each.
+    """
+
+    def __init__(self):
+        self._keys = array('I')
+        self._ratings = array('H')
+        self._votes = array('I')
+
+    def add(self, tconst: str, rating: str, votes: str):
+        key = tconst_key(tconst)
+        if key is None:
+            return
+
+        if len(self._keys) > 0 and key <= self._keys[-1]:
+            raise ValueError("ratings must be added in ascending tconst order")
+
+        self._keys.append(key)
+        self._ratings.append(round(float(rating) * 10))
+        self._votes.append(int(votes))
+
+    def get(self, tconst: str) -> tuple[float, int] | None:
+        key = tconst_key(tconst)
+        if key is None:
+            return None
+
+        index = bisect_left(self._keys, key)
+        if index == len(self._keys) or self._keys[index] != key:
+            return None
+
+        return self._ratings[index] / 10, self._votes[index]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def nbytes(self) -> int:
+        return sum(values.itemsize * len(values) for values in (self._keys, self._ratings, self._votes))
+
+    @classmethod
+    def load(cls, path: str) -> 'RatingsIndex':
+        index = cls()
+
+        try:
+            for row in read_tsv(path):
+                index.add(row['tconst'], row['averageRating'], row['numVotes'])
+        except ValueError:
+            # dumps are published sorted, only an unsorted file pays for holding its rows to sort them
+            index = cls()
+            for row in sorted(read_tsv(path), key=lambda row: tconst_key(row['tconst']) or 0):
+                index.add(row['tconst'], row['averageRating'], row['numVotes'])
+
+        return index
+
+
+def attach_ratings(shows: Iterable[dict[str, any]], ratings: RatingsIndex,
+                   rated_only: bool = False) -> Iterator[dict[str, any]]:
+    for show in shows:
+        rating = ratings.get(show['tconst'])
+
+        if rating is None and rated_only:
+            continue
+
+        show['averageRating'], show['averageRatingVotes'] = rating if rating is not None else (None, None)
+        yield show
+
+
+def content_hash(show: dict[str, any]) -> bytes:
+    return hashlib.blake2b(json.dumps(show, sort_keys=True, separators=(',', ':')).encode('utf-8'),
+                           digest_size=8).digest()
+
+
+def hash_shows(shows: Iterable[dict[str, any]]) -> Iterator[dict[str, any]]:
+    for show in shows:
+        show['contentHash'] = content_hash(show)
+        yield show
+
+
+def batched(values: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(values)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def read_shows(path: str) -> Iterator[dict[str, any]]:
+    return filter(None, map(parse_show, read_tsv(path)))
+
+
+def insert_batches(collection, documents: Iterable[dict], batch_size: int = IMPORT_BATCH_SIZE) -> int:
+    """Inserts the documents in unordered batches, documents hitting a unique index are skipped and reported
+
+    Raises ImportAbortedException when a batch fails for any other reason.
+    """
+    inserted = 0
+    duplicates = 0
+
+    for batch in batched(documents, batch_size):
+        try:
+            inserted += len(collection.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as ex:
+            inserted += ex.details['nInserted']
+            errors = ex.details['writeErrors']
+            failed = [error for error in errors if error['code'] != DUPLICATE_KEY_ERROR_CODE]
+
+            if failed:
+                raise ImportAbortedException("{} of {} documents failed to insert after {} were inserted: {}".format(
+                    len(failed), len(batch), inserted, failed[0].get('errmsg')))
+            if ex.details.get('writeConcernErrors'):
+                raise ImportAbortedException("write concern failed after {} documents were inserted: {}".format(
+                    inserted, ex.details['writeConcernErrors'][0].get('errmsg')))
+
+            duplicates += len(errors)
+
+    if duplicates:
+        print("skipped {} duplicate documents".format(duplicates))
+
+    return inserted
+
+
+def import_shows(client: MongoClient, basics_path: str, ratings_path: str | None = None,
+                 batch_size: int = IMPORT_BATCH_SIZE, drop: bool = True, rated_only: bool = False) -> int:
+    """Streams title.basics into the shows collection in unordered insert_many batches
+
+    Nulls, genres and numeric columns are typed while reading, so no fix-up passes are needed afterwards.
+    When a title.ratings dump is given it is loaded into a RatingsIndex first and joined onto each row
+    as it streams, replacing the ratings collection and its $lookup pass.
+    """
+    collection = client[IMPORT_DATABASE_NAME][IMPORT_SHOWS_COLLECTION_NAME]
+
+    if drop:
+        collection.drop()
+
+    started = time.perf_counter()
+    shows = read_shows(basics_path)
+
+    if ratings_path:
+        ratings = RatingsIndex.load(ratings_path)
+        print("loaded {} ratings into {} bytes in {:.1f}s".format(len(ratings), ratings.nbytes(),
+                                                                  time.perf_counter() - started))
+        shows = attach_ratings(shows, ratings, rated_only)
+
+    inserted = insert_batches(collection, hash_shows(shows), batch_size)
+    print("imported {} shows in {:.1f}s".format(inserted, time.perf_counter() - started))
+
+    record_run(client[IMPORT_DATABASE_NAME], 'import')
+
+    return inserted
+
+
+def uncompressed_tsv(path: str) -> str:
+    """Byte-range partitions need a seekable file, so gzipped dumps are expanded next to the original once
+    """
+    if not path.endswith('.gz'):
+        return path
+
+    target = path.removesuffix('.gz')
+    if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(path):
+        with gzip.open(path, 'rb') as source, open(target + '.partial', 'wb') as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+        os.replace(target + '.partial', target)
+
+    return target
+
+
+def partition_tsv(path: str, partitions: int) -> tuple[list[str], list[tuple[int, int]]]:
+    """Splits a TSV after its header into byte ranges aligned to line starts
+    """
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as tsv:
+        header = tsv.readline().decode('utf-8').rstrip('\r\n').split('\t')
+        data_start = tsv.tell()
+
+        boundaries = [data_start]
+        for partition in range(1, partitions):
+            tsv.seek(max(data_start + (size - data_start) * partition // partitions, boundaries[-1]))
+            if tsv.tell() > data_start:
+                tsv.readline()
+            boundaries.append(max(tsv.tell(), boundaries[-1]))
+        boundaries.append(size)
+
+    return header, [(start, end) for (start, end) in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def read_tsv_range(path: str, header: list[str], start: int, end: int) -> Iterator[tuple[int, dict[str, str]]]:
+    """Yields each row in [start, end) along with the offset of the line following it
+    """
+    with open(path, 'rb') as tsv:
+        tsv.seek(start)
+        offset = start
+
+        while offset < end:
+            line = tsv.readline()
+            if not line:
+                break
+
+            offset += len(line)
+            row = split_row(header, line.decode('utf-8'))
+
+            if row is not None:
+                yield offset, row
+
+
+_refresh_worker: dict[str, any] = {}
+
+
+def _init_refresh_worker(uri: str, ratings: RatingsIndex | None, rated_only: bool):
+    # every worker opens its own client, MongoClient is not fork safe
+    _refresh_worker['client'] = MongoClient(uri)
+    _refresh_worker['ratings'] = ratings
+    _refresh_worker['rated_only'] = rated_only
+
+
+def _refresh_partition(run: str, partition: int, path: str, header: list[str], start: int, end: int,
+                       batch_size: int) -> tuple[bytes, bytes | None, int, int]:
+    """Upserts the changed titles of one partition, returning its tconst keys, the changed ones and the write counts
+
+    Progress is checkpointed after every batch, and a resumed partition only re-reads the
+    already committed part of its range to collect keys. The titles changed before the interruption
+    are not known any more, so a resumed partition returns None for its changed keys.
+    """
+    client = _refresh_worker['client']
+    collection = client[IMPORT_DATABASE_NAME][IMPORT_SHOWS_COLLECTION_NAME]
+    checkpoints = client[IMPORT_DATABASE_NAME][IMPORT_CHECKPOINT_COLLECTION_NAME]
+    checkpoint_id = '{}:{}'.format(run, partition)
+
+    checkpoint = checkpoints.find_one_and_update(
+        {'_id': checkpoint_id},
+        {'$setOnInsert': {'run': run, 'partition': partition, 'start': start, 'end': end, 'offset': start,
+                          'upserted': 0, 'done': False}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    resume_at = checkpoint['offset']
+    upserted = checkpoint['upserted']
+    unchanged = 0
+
+    keys = array('I')
+    changed_keys = array('I')
+    batch = []
+
+    def flush(offset):
+        nonlocal upserted, unchanged
+        stored = {show['tconst']: show.get('contentHash') for show in
+                  collection.find({'tconst': {'$in': [show['tconst'] for show in batch]}},
+                                  {'_id': 0, 'tconst': 1, 'contentHash': 1})}
+        changed = [show for show in batch if stored.get(show['tconst']) != show['contentHash']]
+
+        if changed:
+            collection.bulk_write([UpdateOne({'tconst': show['tconst']}, {'$set': show}, upsert=True)
+                                   for show in changed], ordered=False)
+            changed_keys.extend(key for key in map(tconst_key, (show['tconst'] for show in changed)) if key is not None)
+
+        upserted += len(changed)
+        unchanged += len(batch) - len(changed)
+        checkpoints.update_one({'_id': checkpoint_id}, {'$set': {'offset': offset, 'upserted': upserted}})
+        batch.clear()
+
+    offset = start
+    for (offset, row) in read_tsv_range(path, header, start, end):
+        show = parse_show(row)
+        if show is None:
+            continue
+
+        if _refresh_worker['ratings'] is not None:
+            show = next(attach_ratings([show], _refresh_worker['ratings'], _refresh_worker['rated_only']), None)
+            if show is None:
+                continue
+
+        key = tconst_key(show['tconst'])
+        if key is not None:
+            keys.append(key)
+
+        if offset <= resume_at:
+            continue
+
+        show['contentHash'] = content_hash(show)
+        batch.append(show)
+
+        if len(batch) >= batch_size:
+            flush(offset)
+
+    if batch:
+        flush(offset)
+
+    checkpoints.update_one({'_id': checkpoint_id}, {'$set': {'offset': end, 'done': True}})
+
+    return keys.tobytes(), changed_keys.tobytes() if resume_at == start else None, upserted, unchanged
+
+
+def remove_missing(collection, keys: array, batch_size: int = IMPORT_BATCH_SIZE, removed_keys: array = None,
+                   allow_mass_delete: bool = False) -> int:
+    """Deletes titles whose tconst is not in the sorted keys of the latest dump, collecting them in removed_keys
+
+    Nothing is deleted when the dump holds less than 1 - IMPORT_MAX_REMOVED_SHARE of the stored titles,
+    unless allow_mass_delete is given.
+    """
+    stored = collection.estimated_document_count()
+    if not allow_mass_delete and len(keys) < stored * (1 - IMPORT_MAX_REMOVED_SHARE):
+        raise ImportAbortedException("the dump holds {} of {} stored titles, refusing to remove the rest without "
+                                     "allow_mass_delete".format(len(keys), stored))
+
+    removed = 0
+
+    def missing():
+        for show in collection.find({}, {'_id': 0, 'tconst': 1}).batch_size(batch_size):
+            key = tconst_key(show.get('tconst') or '')
+            index = bisect_left(keys, key) if key is not None else len(keys)
+            if key is None or index == len(keys) or keys[index] != key:
+                yield show.get('tconst')
+
+    for batch in batched(missing(), batch_size):
+        removed += collection.delete_many({'tconst': {'$in': batch}}).deleted_count
+
+        if removed_keys is not None:
+            removed_keys.extend(key for key in map(tconst_key, filter(None, batch)) if key is not None)
+
+    return removed
+
+
+def record_run(database, run: str, changed: array | None = None, removed: array | None = None) -> dict[str, any]:
+    """Announces a finished import to the running workers, with the tconst keys it changed and removed
+
+    Without the keys, or with more than IMPORT_RUN_MAX_KEYS of them, readers are told to rebuild instead.
+    """
+    rebuild = changed is None or removed is None or len(changed) + len(removed) > IMPORT_RUN_MAX_KEYS
+    document = {'run': run, 'finishedAt': datetime.utcnow(), 'rebuild': rebuild}
+
+    if not rebuild:
+        document['changed'] = Binary(changed.tobytes())
+        document['removed'] = Binary(removed.tobytes())
+
+    database[IMPORT_RUN_COLLECTION_NAME].insert_one(document)
+    return document
+
+
+def refresh_shows(uri: str, basics_path: str, ratings_path: str | None = None,
+                  partitions: int = IMPORT_PARTITIONS, batch_size: int = IMPORT_BATCH_SIZE,
+                  rated_only: bool = False, allow_mass_delete: bool = False) -> dict[str, int]:
+    """Incrementally refreshes shows from a new dump on a process pool
+
+    The dump is split into byte-range partitions, each worker compares every row's content hash
+    against the stored one and upserts only new or changed titles, then titles missing from the dump
+    are removed. Partition checkpoints are keyed by the dump file, so rerunning after an interruption
+    resumes where each partition stopped, also when remove_missing refused a mass delete.
+    """
+    started = time.perf_counter()
+    path = uncompressed_tsv(basics_path)
+    stat = os.stat(path)
+    run = hashlib.blake2b('{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode('utf-8'),
+                          digest_size=8).hexdigest()
+
+    ratings = RatingsIndex.load(ratings_path) if ratings_path else None
+    header, ranges = partition_tsv(path, partitions)
+    if not ranges:
+        raise ImportAbortedException("{} holds no titles".format(path))
+
+    keys = array('I')
+    changed = array('I')
+    upserted = 0
+    unchanged = 0
+
+    with ProcessPoolExecutor(max_workers=len(ranges), initializer=_init_refresh_worker,
+                             initargs=(uri, ratings, rated_only)) as pool:
+        futures = [pool.submit(_refresh_partition, run, partition, path, header, start, end, batch_size)
+                   for (partition, (start, end)) in enumerate(ranges)]
+
+        for future in futures:
+            (partition_keys, partition_changed, partition_upserted, partition_unchanged) = future.result()
+            keys.frombytes(partition_keys)
+
+            if partition_changed is None or changed is None:
+                changed = None
+            else:
+                changed.frombytes(partition_changed)
+            upserted += partition_upserted
+            unchanged += partition_unchanged
+
+    client = MongoClient(uri)
+    database = client[IMPORT_DATABASE_NAME]
+    keys = array('I', sorted(keys))
+    removed_keys = array('I')
+    removed = remove_missing(database[IMPORT_SHOWS_COLLECTION_NAME], keys, batch_size, removed_keys,
+                             allow_mass_delete)
+    database[IMPORT_CHECKPOINT_COLLECTION_NAME].delete_many({'run': run})
+    record_run(database, run, changed, removed_keys)
+
+    stats = {'upserted': upserted, 'unchanged': unchanged, 'removed': removed}
+    print("refreshed shows {} in {:.1f}s".format(stats, time.perf_counter() - started))
+
+    return stats
@@ -0,0 +1,112 @@
+from dataclasses import dataclass, field
+from typing import Final
+
+import pymongo
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+
+INDEX_DATABASE_NAME: Final[str] = 'movieDB'
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    keys: tuple[tuple[str, int], ...]
+    unique: bool = False
+    expire_after_seconds: int | None = None
+
+    @property
+    def name(self) -> str:
+        return '_'.join('{}_{}'.format(key, direction) for (key, direction) in self.keys)
+
+    def options(self) -> dict[str, any]:
+        options = {'name': self.name, 'background': True}
+        if self.unique:
+            options['unique'] = True
+        if self.expire_after_seconds is not None:
+            options['expireAfterSeconds'] = self.expire_after_seconds
+        return options
+
+    def matches(self, existing: dict[str, any]) -> bool:
+        return bool(existing.get('unique', False)) == self.unique \
+            and existing.get('expireAfterSeconds') == self.expire_after_seconds
+
+
+def index(*keys: str | tuple[str, int], unique: bool = False, expire_after_seconds: int | None = None) -> IndexSpec:
+    """Builds an IndexSpec from db field names, ascending unless given as a (field, direction) tuple
+    """
+    return IndexSpec(tuple(key if isinstance(key, tuple) else (key, pymongo.ASCENDING) for key in keys),
+                     unique, expire_after_seconds)
+
+
+@dataclass
+class IndexReport:
+    created: list[str] = field(default_factory=list)
+    extra: list[str] = field(default_factory=list)
+    conflicts: list[str] = field(default_factory=list)
+    failed: list[str] = field(default_factory=list)
+
+
+INDEX_REGISTRY: Final[dict[str, list[IndexSpec]]] = {}
+
+
+def declare_indexes(collection_name: str, specs: list[IndexSpec] | None):
+    declared = INDEX_REGISTRY.setdefault(collection_name, [])
+    for spec in specs or []:
+        if spec not in declared:
+            declared.append(spec)
+
+
+def reconcile_indexes(mongo: MongoClient, apply: bool = True) -> dict[str, IndexReport]:
+    """Compares the declared indexes with the database, creating missing ones when `apply` is set
+
+    Indexes on the same keys with different options are reported as conflicts rather than rebuilt,
+    and indexes nobody declared are only reported, never dropped.
+    """
+    reports: dict[str, IndexReport] = {}
+
+    for (collection_name, specs) in INDEX_REGISTRY.items():
+        collection = mongo[INDEX_DATABASE_NAME][collection_name]
+        report = reports.setdefault(collection_name, IndexReport())
+        existing = {tuple((key, int(direction) if isinstance(direction, (int, float)) else direction)
+                          for (key, direction) in info['key'].items()): info
+                    for info in collection.list_indexes()}
+
+        for spec in specs:
+            info = existing.pop(spec.keys, None)
+
+            if info is not None:
+                if not spec.matches(info):
+                    report.conflicts.append(info['name'])
+                continue
+
+            if apply:
+                try:
+                    collection.create_index(list(spec.keys), **spec.options())
+                except OperationFailure as ex:
+                    report.failed.append('{}: {}'.format(spec.name, ex))
+                    continue
+
+            report.created.append(spec.name)
+
+        report.extra += [info['name'] for (keys, info) in existing.items() if keys != (('_id', 1),)]
+
+    return reports
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import movieship.controllers.explore
+    import movieship.controllers.profile
+    import movieship.controllers.review
+    import movieship.controllers.watchlist
+    import movieship.indexes
+
+    parser = argparse.ArgumentParser(description="Creates the indexes declared by each FieldLogic")
+    parser.add_argument('--uri', default="mongodb://127.0.0.1:27017")
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    # run as __main__, so go through the imported module whose registry the controllers filled
+    for (name, result) in movieship.indexes.reconcile_indexes(MongoClient(args.uri), not args.dry_run).items():
+        print(name, result)
@@ -1,18 +1,53 @@
 import base64
+import binascii
+import functools
+import hashlib
+import hmac
+import os
 import re
-import urllib.parse
+import sys
 from abc import abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from enum import Enum
-from typing import Final, Mapping, Any
+from typing import Final, Mapping, Any, Iterable, TYPE_CHECKING
 
 import bson
 from bson import ObjectId
-from flask import request
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 
-from movieship.controllers.root import PageResponse, Cursor
-from movieship.exceptions import InvalidPaginationException, ResourceNotFoundException
+from movieship.connection import MONGO_URI
+from movieship.context import current_request, has_request_context
+from movieship.controllers.root import PageResponse, Cursor, BatchResponse
+from movieship.exceptions import InvalidPaginationException, ResourceNotFoundException, InvalidFieldException
+from movieship.indexes import IndexSpec, declare_indexes
+from movieship.search import search_terms, terms_field, typed_terms
+
+if TYPE_CHECKING:
+    # only the ASGI app needs the async driver, the WSGI app runs without it
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+CURSOR_SECRET_VARIABLE: Final[str] = 'MOVIESHIP_CURSOR_SECRET'
+
+
+def cursor_secret() -> bytes:
+    """The key cursors are signed with, it has to be the same in every worker and across restarts
+
+    Without MOVIESHIP_CURSOR_SECRET the key is derived from the Mongo URI, stable but as guessable as the URI
+    """
+    secret = os.environ.get(CURSOR_SECRET_VARIABLE, '')
+    if secret:
+        return secret.encode('utf-8')
+
+    print("WARNING: {} is not set, cursors are signed with a key derived from the Mongo URI, set it in "
+          "production".format(CURSOR_SECRET_VARIABLE), file=sys.stderr)
+    return hashlib.sha256(b'movieship-cursor:' + MONGO_URI.encode('utf-8')).digest()
+
+
+CURSOR_SECRET: Final[bytes] = cursor_secret()
+CURSOR_SIGNATURE_SIZE: Final[int] = 16
+QUERY_SHAPE_CACHE_SIZE: Final[int] = 256
+SEARCH_REGEX_CACHE_SIZE: Final[int] = 4096
+SEARCH_SCORE_FIELD: Final[str] = 'searchScore'
 
 
 def parse_search_value(value):
@@ -21,15 +56,58 @@ def parse_search_value(value):
     elif value.isnumeric():
         return int(value)
     elif value.lower() == "true" or value.lower() == "false":
-        return bool(value)
+        return value.lower() == "true"
     else:
         return value
 
 
+@functools.lru_cache(maxsize=SEARCH_REGEX_CACHE_SIZE)
+def search_regex(value: str, ignore_case: bool, anchored: bool = False) -> bson.regex.Regex:
+    """Compiles the escaped search text once, user input is matched literally rather than as a pattern
+    """
+    return bson.regex.Regex.from_native(re.compile(('^' if anchored else '') + re.escape(value),
+                                                   re.IGNORECASE if ignore_case else 0))
+
+
+def terms_condition(value: str) -> dict[str, any]:
+    """Every complete term of the value, its last one matched as a prefix while it is still being typed
+
+    The prefix is an anchored regex, which the multikey terms index answers with a range.
+    """
+    (terms, partial) = typed_terms(value)
+
+    # longest first, $all is answered from the index bounds of its first term and long terms are the rarest
+    condition = {'$all': sorted(terms, key=len, reverse=True)} if terms or not partial else {}
+    if partial:
+        condition['$regex'] = search_regex(partial, False, True)
+
+    return condition
+
+
 class SearchType(Enum):
     EQUIVALENT = 1
     LIKE = 2
     ILIKE = 3
+    PREFIX = 4
+    TERMS = 5
+
+    def condition(self, value: str) -> dict[str, any]:
+        match self:
+            case SearchType.EQUIVALENT:
+                return {'$eq': parse_search_value(value)}
+            case SearchType.LIKE:
+                return {'$regex': search_regex(value, False)}
+            case SearchType.ILIKE:
+                return {'$regex': search_regex(value, True)}
+            case SearchType.PREFIX:
+                return {'$regex': search_regex(value, False, True)}
+            case SearchType.TERMS:
+                return terms_condition(value)
+
+    def db_field(self, field: str) -> str:
+        """Term searches match the field's stored terms rather than the field itself
+        """
+        return terms_field(field) if self == SearchType.TERMS else field
 
 
 @dataclass
@@ -39,16 +117,8 @@ class SearchFilter:
     type: SearchType
 
     def search_field(self, resource_fields: dict[str, str]) -> tuple[str, any]:
-        field_name = resource_fields[self.field].removeprefix('$')
-        match self.type:
-
-            case SearchType.LIKE:
-                return field_name, {'$regex': bson.regex.Regex('{}'.format(parse_search_value(self.value)))}
-            case SearchType.EQUIVALENT:
-                return field_name, {'$eq': parse_search_value(self.value)}
-            case SearchType.ILIKE:
-                return field_name, {'$regex': bson.regex.Regex('{}'.format(parse_search_value(self.value))),
-                                    '$options': 'i'}
+        field_name = self.type.db_field(resource_fields[self.field].removeprefix('$'))
+        return field_name, self.type.condition(self.value)
 
 
 class OrderType(Enum):
@@ -58,9 +128,9 @@ class OrderType(Enum):
     def comparator(self):
         match self:
             case OrderType.ASCENDING:
-                return '$gte'
+                return '$gt'
             case OrderType.DESCENDING:
-                return '$lte'
+                return '$lt'
 
     def order(self):
         match self:
@@ -69,6 +139,13 @@ class OrderType(Enum):
             case OrderType.DESCENDING:
                 return -1
 
+    def reversed(self):
+        match self:
+            case OrderType.ASCENDING:
+                return OrderType.DESCENDING
+            case OrderType.DESCENDING:
+                return OrderType.ASCENDING
+
 
 @dataclass
 class SearchOrder:
@@ -80,58 +157,118 @@ class SearchOrder:
         field_name = resource_fields[self.field].removeprefix('$')
         return field_name, self.type.order()
 
+    def reversed(self):
+        return SearchOrder(self.field, self.type.reversed(), self.allow_nulls)
 
-def parse_order_meta(param, order_type: OrderType, allow_nulls: bool, order_fields: set[str]):
-    return [(lambda field: SearchOrder(field, order_type, allow_nulls))(field) for field in
-            filter(lambda field: field in order_fields,
-                   request.args.get(param).split(','))]
 
+def requested_fields(resource_fields: dict[str, str]) -> set[str] | None:
+    """Parses the fields= sparse fieldset, None when the caller wants every field
+    """
+    if not has_request_context() or not current_request().args.get('fields'):
+        return None
 
-def parse_filter_meta(param, search_type: SearchType, search_fields: set[str]):
-    return [(lambda field, value: SearchFilter(field, value, search_type))(field, value)
-            for
-            (field, value) in filter(lambda search: search[0] in search_fields,
-                                     ((lambda search: search.split(':'))(search) for search in
-                                      request.args.get(param).split(',')))]
+    fields = {field.strip() for field in current_request().args.get('fields').split(',') if field.strip()}
+    unknown = fields - resource_fields.keys()
 
+    if unknown:
+        raise InvalidFieldException("unknown fields {}".format(', '.join(sorted(unknown))))
 
-def parse_search_meta_data(identity_order_field: SearchOrder, order_fields: set[str], search_fields: set[str],
-                           page_limit: int):
-    filter_meta: list[SearchFilter] = []
+    return fields
 
-    if request.args.get('se'):
-        filter_meta += parse_filter_meta('se', SearchType.EQUIVALENT, search_fields)
 
-    if request.args.get('sl'):
-        filter_meta += parse_filter_meta('sl', SearchType.LIKE, search_fields)
+def expand_requested() -> bool:
+    """Whether the caller asked for the expanded representation, with the $lookup modifiers applied
+    """
+    return current_request().args.get('expand', '').lower() == 'true'
 
-    if request.args.get('sil'):
-        filter_meta += parse_filter_meta('sil', SearchType.ILIKE, search_fields)
 
-    order_meta: list[SearchOrder] = []
+SEARCH_PARAMS: Final[tuple[tuple[str, SearchType], ...]] = (
+    ('se', SearchType.EQUIVALENT),
+    ('sl', SearchType.LIKE),
+    ('sil', SearchType.ILIKE),
+    ('sp', SearchType.PREFIX),
+    ('st', SearchType.TERMS),
+)
+ORDER_PARAMS: Final[tuple[tuple[str, OrderType, bool], ...]] = (
+    ('oa', OrderType.ASCENDING, False),
+    ('oan', OrderType.ASCENDING, True),
+    ('od', OrderType.DESCENDING, False),
+    ('odn', OrderType.DESCENDING, True),
+)
+
+
+def parse_limit(value: str | None, page_limit: int) -> int:
+    """The l= page size capped at page_limit, anything but a positive number is an invalid page
+    """
+    if not value:
+        return page_limit
+
+    try:
+        limit = int(value)
+    except ValueError:
+        raise InvalidPaginationException("expected a number of rows, got {}".format(value))
+
+    if limit < 1:
+        raise InvalidPaginationException("expected at least one row, got {}".format(limit))
+
+    return min(limit, page_limit)
 
-    if request.args.get('oa'):
-        order_meta += parse_order_meta('oa', OrderType.ASCENDING, False, order_fields)
 
-    if request.args.get('oan'):
-        order_meta += parse_order_meta('oan', OrderType.ASCENDING, True, order_fields)
+def parse_order_meta(param, order_type: OrderType, allow_nulls: bool, order_fields: set[str]):
+    orders = []
+    for field in current_request().args.get(param).split(','):
+        if field in order_fields:
+            orders.append(SearchOrder(field, order_type, allow_nulls))
+    return orders
+
+
+def filter_search_type(search_type: SearchType, field: str, term_fields: set[str]) -> SearchType | None:
+    """Like filters on a field with stored terms become term searches, term searches need stored terms
+    """
+    if field in term_fields and search_type in (SearchType.LIKE, SearchType.ILIKE):
+        return SearchType.TERMS
+    if search_type == SearchType.TERMS and field not in term_fields:
+        return None
+    return search_type
+
+
+def parse_filter_meta(param, search_type: SearchType, search_fields: set[str], term_fields: set[str] = frozenset()):
+    filters = []
+    for search in current_request().args.get(param).split(','):
+        (field, separator, value) = search.partition(':')
+        field_search_type = filter_search_type(search_type, field, term_fields)
+        if separator and field in search_fields and field_search_type is not None:
+            filters.append(SearchFilter(field, value, field_search_type))
+    return filters
+
+
+def parse_search_meta_data(identity_order_field: SearchOrder, order_fields: set[str], search_fields: set[str],
+                           page_limit: int, term_fields: set[str] = frozenset()):
+    args = current_request().args
+    filter_meta: list[SearchFilter] = []
+
+    for (param, search_type) in SEARCH_PARAMS:
+        if args.get(param):
+            filter_meta += parse_filter_meta(param, search_type, search_fields, term_fields)
+
+    order_meta: list[SearchOrder] = []
 
-    if request.args.get('od'):
-        order_meta += parse_order_meta('od', OrderType.DESCENDING, False, order_fields)
+    for (param, order_type, allow_nulls) in ORDER_PARAMS:
+        if args.get(param):
+            order_meta += parse_order_meta(param, order_type, allow_nulls, order_fields)
 
-    if request.args.get('odn'):
-        order_meta += parse_order_meta('odn', OrderType.DESCENDING, True, order_fields)
+    if len(order_meta) == 0 and any(search_filter.type == SearchType.TERMS for search_filter in filter_meta):
+        # term searches without an explicit order are ranked
+        order_meta += [SearchOrder(SEARCH_SCORE_FIELD, OrderType.DESCENDING, False)]
 
     if len(order_meta) == 0:
         order_meta += [identity_order_field]
 
-    limit = page_limit
-    if request.args.get('l'):
-        limit = min(limit, int(request.args.get('l')))
+    limit = parse_limit(args.get('l'), page_limit)
 
     position = None
-    if request.args.get('p'):
-        position = urllib.parse.parse_qs(base64.b64decode(request.args.get('p')).decode("ascii"))
+    if args.get('p'):
+        position = decode_cursor(args.get('p'))
 
     return SearchMetaData(
         filter_meta,
@@ -141,42 +278,175 @@ def parse_search_meta_data(identity_order_field: SearchOrder, order_fields: set[
     )
 
 
+@dataclass
+class PipelineModifier:
+    """Stages run after the match, skipped when none of the fields they provide were requested
+    """
+    provides: set[str]
+    stages: list[dict]
+
+
+class CursorDirection(Enum):
+    NEXT = 1
+    PREVIOUS = 2
+
+
+@dataclass
+class Position:
+    values: dict[str, any]
+    direction: CursorDirection
+
+
+def encode_cursor(orders: list[SearchOrder], row: dict[str, any], direction: CursorDirection) -> str:
+    """Packs the row's sort key values as BSON, so they come back with their types, and signs them
+    """
+    payload = bson.encode({
+        'd': direction.value,
+        'f': [order.field for order in orders],
+        'v': [row.get(order.field) for order in orders],
+    })
+    signature = hmac.new(CURSOR_SECRET, payload, hashlib.sha256).digest()[:CURSOR_SIGNATURE_SIZE]
+
+    return base64.urlsafe_b64encode(payload + signature).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Position:
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    except (binascii.Error, ValueError):
+        raise InvalidPaginationException("malformed cursor")
+
+    payload, signature = data[:-CURSOR_SIGNATURE_SIZE], data[-CURSOR_SIGNATURE_SIZE:]
+    expected = hmac.new(CURSOR_SECRET, payload, hashlib.sha256).digest()[:CURSOR_SIGNATURE_SIZE]
+
+    if len(payload) == 0 or not hmac.compare_digest(signature, expected):
+        raise InvalidPaginationException("cursor signature does not match")
+
+    position = bson.decode(payload)
+
+    return Position(dict(zip(position['f'], position['v'])), CursorDirection(position['d']))
+
+
+@dataclass(frozen=True)
+class QueryShape:
+    filters: tuple[tuple[str, SearchType], ...]
+    orders: tuple[tuple[str, OrderType, bool], ...]
+    paged: bool
+
+
+class CompiledQuery:
+    """The $match and $sort stages of one QueryShape, built once and filled with each request's values
+
+    The match comes first so a single index range serves both, with the keyset position compiled into
+    the tuple comparison (a > x) OR (a = x AND b > y) OR ...
+
+    Mongo sorts null before every value, $gt and $lt never match across null and non-null, so an order
+    allowing nulls steps over that boundary with a branch of its own.
+
+    A ranked term search scores the matched titles by the share of their terms the query covers, the
+    score is computed after the match, so the keyset position gets a $match of its own behind it.
+    """
+
+    def __init__(self, shape: QueryShape, resource_fields: dict[str, str]):
+        def db_field(field):
+            return resource_fields[field].removeprefix('$')
+
+        self._sort: Final[dict[str, int]] = {db_field(field): order_type.order()
+                                             for (field, order_type, _) in shape.orders}
+        self._not_null: Final[list[dict]] = [{db_field(field): {'$ne': None}}
+                                             for (field, _, allow_nulls) in shape.orders
+                                             if not allow_nulls and field != SEARCH_SCORE_FIELD]
+        self._filters: Final[list[tuple[str, SearchType]]] = [(search_type.db_field(db_field(field)), search_type)
+                                                              for (field, search_type) in shape.filters]
+        self._key_set: Final[list[tuple[str, OrderType, bool]]] = [(db_field(field), order_type, allow_nulls)
+                                                                   for (field, order_type, allow_nulls)
+                                                                   in shape.orders] \
+            if shape.paged else []
+        self._scored: Final[bool] = any(field == SEARCH_SCORE_FIELD for (field, _, _) in shape.orders)
+
+    @staticmethod
+    def _and(conditions: list[dict]) -> dict[str, object]:
+        if len(conditions) == 1:
+            return conditions[0]
+        elif len(conditions) > 1:
+            return {
+                "$and": conditions
+            }
+        return {}
+
+    @staticmethod
+    def _after(order_type: OrderType, allow_nulls: bool, value) -> list[any]:
+        """The conditions a field's values sorting after the position's value match
+        """
+        if not allow_nulls:
+            return [{order_type.comparator(): value}]
+
+        match (order_type, value is None):
+            case (OrderType.ASCENDING, True):
+                return [{'$ne': None}]
+            case (OrderType.ASCENDING, False):
+                return [{'$gt': value}]
+            case (OrderType.DESCENDING, True):
+                return []
+            case (OrderType.DESCENDING, False):
+                return [{'$lt': value}, None]
+
+    def _score(self, filter_values: list[str]) -> dict[str, object]:
+        shares = [{'$divide': [len(search_terms(value)), {'$max': [1, {'$size': {'$ifNull': ['$' + field, []]}}]}]}
+                  for ((field, search_type), value) in zip(self._filters, filter_values)
+                  if search_type == SearchType.TERMS]
+
+        return {'$set': {SEARCH_SCORE_FIELD: {'$add': shares} if shares else 0}}
+
+    def stages(self, filter_values: list[str], position_values: list[any] | None = None) -> list[dict]:
+        conditions = list(self._not_null)
+
+        for ((field, search_type), value) in zip(self._filters, filter_values):
+            conditions.append({field: search_type.condition(value)})
+
+        key_set = []
+        if self._key_set:
+            branches = []
+            equalities: dict[str, any] = {}
+
+            for ((field, order_type, allow_nulls), value) in zip(self._key_set, position_values):
+                branches += [{**equalities, field: after} for after in self._after(order_type, allow_nulls, value)]
+                equalities[field] = value
+
+            key_set.append(branches[0] if len(branches) == 1 else {'$or': branches})
+
+        if not self._scored:
+            return [{"$match": self._and(conditions + key_set)}, {"$sort": self._sort}]
+
+        stages = [{"$match": self._and(conditions)}, self._score(filter_values)]
+        if key_set:
+            stages.append({"$match": self._and(key_set)})
+
+        return stages + [{"$sort": self._sort}]
+
+
 @dataclass
 class SearchMetaData:
     filters: list[SearchFilter]
     orders: list[SearchOrder]
     limit: int
-    position: dict[str, str] | None
-
-    def digest(self, resource_fields: dict[str, str]):
-        query: dict[str, object] = {}
-        search_fields: list[object] = []
-        orders_fields: dict[str, any] = {}
-
-        orders_prioritised = self.orders[::-1]
-        for order in orders_prioritised:
-            (field, orderMeta) = order.match_field(resource_fields)
-            orders_fields[field] = orderMeta
-            if not order.allow_nulls:
-                search_fields += [{field: {
-                    "$ne": None
-                }}]
-
-        if len(orders_fields) > 0:
-            query["$sort"] = orders_fields
-
-        for searchFilter in self.filters:
-            (field, searchMeta) = searchFilter.search_field(resource_fields)
-            search_fields += [{field: searchMeta}]
-
-        if len(search_fields) == 1:
-            query["$match"] = search_fields[0]
-        elif len(search_fields) > 1:
-            query["$match"] = {
-                "$and": search_fields
-            }
+    position: Position | None
+    fields: set[str] | None = None
+
+    def shape(self) -> QueryShape:
+        return QueryShape(
+            tuple((search_filter.field, search_filter.type) for search_filter in self.filters),
+            tuple((order.field, order.type, order.allow_nulls) for order in self.orders),
+            self.position is not None
+        )
 
-        return [{"$match": query["$match"]}, {"$sort": query["$sort"]}]
+    def filter_values(self) -> list[str]:
+        return [search_filter.value for search_filter in self.filters]
+
+    def digest(self, resource_fields: dict[str, str], position_values: list[any] | None = None):
+        """Builds the $match and $sort stages without going through a FieldLogic's compiled shape cache
+        """
+        return CompiledQuery(self.shape(), resource_fields).stages(self.filter_values(), position_values)
 
 
 class FieldLogic:
@@ -189,7 +459,9 @@ class FieldLogic:
             order_fields: set[str] = None,
             search_fields: set[str] = None,
             page_size_limit: int = None,
-            pipeline_query_modifiers=None
+            pipeline_query_modifiers: list[PipelineModifier] = None,
+            indexes: list[IndexSpec] = None,
+            term_fields: set[str] = None
     ):
         self._collection_name: Final[str] = collection_name
         self._identifier_field: Final[str] = identifier_field
@@ -198,128 +470,297 @@ class FieldLogic:
         self._order_fields: Final[set[str]] = order_fields
         self._search_fields: Final[set[str]] = search_fields
         self._resource_fields: Final[dict[str, str]] = resource_fields
-        self._pipeline_query_modifiers = pipeline_query_modifiers
+        self._pipeline_query_modifiers: Final[list[PipelineModifier]] = pipeline_query_modifiers or []
+        self._indexes: Final[list[IndexSpec]] = indexes or []
+        self._term_fields: Final[set[str]] = term_fields or set()
+
+        declare_indexes(collection_name, self._indexes)
+
+        self._compiled_queries = functools.lru_cache(maxsize=QUERY_SHAPE_CACHE_SIZE)(
+            functools.partial(CompiledQuery, resource_fields=resource_fields))
 
     @abstractmethod
-    def _enhancer(self, mongo, values):
+    def _enhancer(self, mongo, values, fields: set[str] | None = None):
         pass
 
+    def requested_fields(self) -> set[str] | None:
+        return requested_fields(self._resource_fields)
+
+    def _projection(self, fields: set[str] | None, extra: Iterable[str] = ()) -> dict[str, str]:
+        """Narrows the resource projection to the requested fields, always keeping the identifier
+        """
+        if fields is None:
+            return self._resource_fields
+
+        return {field: self._resource_fields[field] for field in self._resource_fields
+                if field in fields or field == self._identifier_field or field in extra}
+
+    def _modifier_stages(self, fields: set[str] | None) -> list[dict]:
+        stages = []
+        for modifier in self._pipeline_query_modifiers:
+            if fields is None or not modifier.provides.isdisjoint(fields):
+                stages += modifier.stages
+        return stages
+
     def map_db_field_name(self, field):
         return self._resource_fields.get(field).removeprefix('$')
 
-    def _listing_key_set_actions(self, search_meta_data: SearchMetaData):
-        key_set_actions = []
-
-        if search_meta_data.position:
-            primary = search_meta_data.position['p'][0]
-            primary_field = search_meta_data.position['pf'][0]
-            secondary = None
-            secondary_field = None
-
-            if 's' in search_meta_data.position and 'sf' in search_meta_data.position:
-                secondary = search_meta_data.position['s'][0]
-                secondary_field = search_meta_data.position['sf'][0]
-
-            if not (primary or (primary and secondary)):
-                raise InvalidPaginationException("expected both a position and secondary position")
-
-            if len(search_meta_data.orders) < 0:
-                raise InvalidPaginationException("expected a order field")
-
-            key_set_actions = []
-
-            if len(search_meta_data.orders) == 1:
-                primary_order = list(filter(lambda p: p.field == primary_field, search_meta_data.orders))[0]
-                primary_order_comparator = primary_order.type.comparator()
-                primary_order_field = self._resource_fields[primary_order.field].removeprefix('$')
-
-                key_set_actions = [{
-                    '$match': {
-                        '$and': [{
-                            '$or': [{
-                                primary_order_field: {
-                                    primary_order_comparator: parse_search_value(primary)
-                                }
-                            }]
-                        }, {
-                            '$and': [{
-                                primary_order_field: {
-                                    '$ne': parse_search_value(primary)
-                                }
-                            }]
-                        }]
-                    }
-                }]
-
-            elif len(search_meta_data.orders) > 1:
-                primary_order = list(filter(lambda p: p.field == primary_field, search_meta_data.orders))[0]
-                primary_order_comparator = primary_order.type.comparator()
-                primary_order_field = self._resource_fields[primary_order.field].removeprefix('$')
-
-                secondary_order = list(filter(lambda p: p.field == secondary_field, search_meta_data.orders))[0]
-                secondary_order_comparator = secondary_order.type.comparator()
-                secondary_order_field = self._resource_fields[secondary_order.field].removeprefix('$')
-
-                key_set_actions = [{
-                    '$match': {
-                        '$and': [{
-                            '$or': [{
-                                '$and': [{
-                                    primary_order_field: {
-                                        primary_order_comparator: parse_search_value(primary)
-                                    }
-                                }, {
-                                    secondary_order_field: {
-                                        secondary_order_comparator: parse_search_value(secondary)
-                                    }
-                                }]
-                            }, {
-                                primary_order_field: {
-                                    primary_order_comparator: parse_search_value(primary)
-                                }
-                            }]
-                        }, {
-                            '$and': [{
-                                primary_order_field: {
-                                    '$ne': parse_search_value(primary)
-                                },
-                            }]
-                        }]
-                    }
-                }]
-
-        return key_set_actions
-
-    def create_m(self, mongo: MongoClient, event, identity):
-        result = mongo['movieDB'][self._collection_name].insert_one(event)
-        return self.fetch_single(mongo, identity)
+    def _key_set_orders(self, orders: list[SearchOrder]) -> list[SearchOrder]:
+        """Appends the identity order and the identifier as tie-breakers so every sort is total
+        """
+        orders = list(orders)
 
-    def create(self, mongo: MongoClient, event):
-        result = mongo['movieDB'][self._collection_name].insert_one(event)
-        identity = result.inserted_id
-        return self.fetch_single(mongo, identity)
+        if self._identity_order_field.field not in (order.field for order in orders):
+            # follow the last order's direction so a single compound index can be walked either way
+            identity_type = orders[-1].type if orders else self._identity_order_field.type
+            orders += [SearchOrder(self._identity_order_field.field, identity_type, False)]
 
-    def update(self, mongo: MongoClient, event, identifier: str):
-        identifier_field = self.map_db_field_name(self._identifier_field)
-        mongo['movieDB'][self._collection_name].update_one({identifier_field: identifier}, {'$set': event})
-        return self.fetch_single(mongo, identifier)
+        if self._identifier_field not in (order.field for order in orders):
+            orders += [SearchOrder(self._identifier_field, orders[-1].type, False)]
+
+        return orders
+
+    def _listing_key_set_actions(self, search_meta_data: SearchMetaData) -> list[any] | None:
+        """Checks the position belongs to this listing's order and returns its values in sort order
+        """
+        if not search_meta_data.position:
+            return None
+
+        if len(search_meta_data.orders) == 0:
+            raise InvalidPaginationException("expected a order field")
+
+        if [order.field for order in search_meta_data.orders] != list(search_meta_data.position.values):
+            raise InvalidPaginationException("cursor does not match the listing order")
+
+        return [search_meta_data.position.values[order.field] for order in search_meta_data.orders]
+
+    def _project_document(self, document: Mapping[str, Any], fields: set[str] | None) -> dict[str, any]:
+        """Applies the resource projection to a document in memory, for writes that already hold it
+        """
+        resource = {'_id': document.get('_id')}
 
-    def update_m(self, mongo: MongoClient, event, match_expression: Mapping[str, Any]):
-        mongo['movieDB'][self._collection_name].update_one(match_expression, {'$set': event})
-        return self.fetch_single_with_expression(mongo, match_expression)
+        for (field, expression) in self._projection(fields).items():
+            if not isinstance(expression, str) or not expression.startswith('$'):
+                continue
+
+            value = document
+            for part in expression.removeprefix('$').split('.'):
+                value = value.get(part) if isinstance(value, Mapping) else None
+
+            if value is not None:
+                resource[field] = value
 
-    def delete(self, mongo: MongoClient, match_expression: Mapping[str, Any]):
-        resource = self.fetch_single_with_expression(mongo, match_expression)
-        mongo['movieDB'][self._collection_name].delete_one(match_expression)
         return resource
 
-    def fetch_single_with_expression(self, mongo: MongoClient, match_expression: object):
+    def _stored_projection(self, fields: set[str] | None, tracked: Iterable[str] = ()) -> dict[str, int]:
+        """The stored fields behind the resource projection plus `tracked`, for writes that return the previous
+        document and rebuild the resource from it in memory
+        """
+        projection = {'_id': 1}
+
+        for expression in self._projection(fields).values():
+            if isinstance(expression, str) and expression.startswith('$'):
+                projection[expression.removeprefix('$').split('.')[0]] = 1
+
+        projection.update({field: 1 for field in tracked})
+        return projection
+
+    def _written(self, mongo: MongoClient, document: Mapping[str, Any] | None, description: object,
+                 fields: set[str] | None):
+        if document is None:
+            raise ResourceNotFoundException("resource not found with {}".format(description))
+
+        return self._enhancer(mongo, [document], fields)[0]
+
+    async def _enhancer_async(self, mongo: 'AsyncIOMotorClient', values, fields: set[str] | None = None):
+        """Enhancers only queue background work, so they run inline with the driver's own sync client
+        """
+        return self._enhancer(mongo.delegate, values, fields)
+
+    async def _written_async(self, mongo: 'AsyncIOMotorClient', document: Mapping[str, Any] | None,
+                             description: object, fields: set[str] | None):
+        if document is None:
+            raise ResourceNotFoundException("resource not found with {}".format(description))
+
+        return (await self._enhancer_async(mongo, [document], fields))[0]
+
+    def create_m(self, mongo: MongoClient, event, identity, expand: bool = False):
+        mongo['movieDB'][self._collection_name].insert_one(event)
+
+        if expand:
+            return self.fetch_single(mongo, identity)
+
+        fields = self.requested_fields()
+        return self._written(mongo, self._project_document(event, fields), identity, fields)
+
+    async def create_m_async(self, mongo: 'AsyncIOMotorClient', event, identity, expand: bool = False):
+        await mongo['movieDB'][self._collection_name].insert_one(event)
+
+        if expand:
+            return await self.fetch_single_async(mongo, identity)
+
+        fields = self.requested_fields()
+        return await self._written_async(mongo, self._project_document(event, fields), identity, fields)
+
+    def create(self, mongo: MongoClient, event, expand: bool = False):
+        result = mongo['movieDB'][self._collection_name].insert_one(event)
+
+        if expand:
+            return self.fetch_single(mongo, result.inserted_id)
+
+        fields = self.requested_fields()
+        return self._written(mongo, self._project_document(event, fields), result.inserted_id, fields)
+
+    async def create_async(self, mongo: 'AsyncIOMotorClient', event, expand: bool = False):
+        result = await mongo['movieDB'][self._collection_name].insert_one(event)
+
+        if expand:
+            return await self.fetch_single_async(mongo, result.inserted_id)
+
+        fields = self.requested_fields()
+        return await self._written_async(mongo, self._project_document(event, fields), result.inserted_id, fields)
+
+    def update(self, mongo: MongoClient, event, identifier: str, expand: bool = False):
+        identifier_field = self.map_db_field_name(self._identifier_field)
+        return self.update_m(mongo, event, {identifier_field: identifier}, expand)
+
+    async def update_async(self, mongo: 'AsyncIOMotorClient', event, identifier: str, expand: bool = False):
+        identifier_field = self.map_db_field_name(self._identifier_field)
+        return await self.update_m_async(mongo, event, {identifier_field: identifier}, expand)
+
+    def update_m(self, mongo: MongoClient, event, match_expression: Mapping[str, Any], expand: bool = False):
+        """Updates and returns the resource in one round trip, the $lookup modifiers only run when expanded
+        """
+        fields = self.requested_fields()
+        document = mongo['movieDB'][self._collection_name].find_one_and_update(
+            match_expression,
+            {'$set': event},
+            projection=self._projection(fields),
+            return_document=ReturnDocument.AFTER
+        )
+
+        if expand and document is not None:
+            return self.fetch_single_with_expression(mongo, match_expression)
+
+        return self._written(mongo, document, match_expression, fields)
+
+    async def update_m_async(self, mongo: 'AsyncIOMotorClient', event, match_expression: Mapping[str, Any],
+                             expand: bool = False):
+        fields = self.requested_fields()
+        document = await mongo['movieDB'][self._collection_name].find_one_and_update(
+            match_expression,
+            {'$set': event},
+            projection=self._projection(fields),
+            return_document=ReturnDocument.AFTER
+        )
+
+        if expand and document is not None:
+            return await self.fetch_single_with_expression_async(mongo, match_expression)
+
+        return await self._written_async(mongo, document, match_expression, fields)
+
+    def update_m_with_previous(self, mongo: MongoClient, event, match_expression: Mapping[str, Any],
+                               tracked: Iterable[str], expand: bool = False):
+        """Updates in one round trip and returns the resource along with the previous `tracked` values
+
+        The write returns the document as it was, the resource is that document with the $set applied in
+        memory, so `event` holds top level fields only.
+        """
+        fields = self.requested_fields()
+        previous = mongo['movieDB'][self._collection_name].find_one_and_update(
+            match_expression,
+            {'$set': event},
+            projection=self._stored_projection(fields, tracked),
+            return_document=ReturnDocument.BEFORE
+        )
+
+        if expand and previous is not None:
+            return self.fetch_single_with_expression(mongo, match_expression), previous
+
+        document = None if previous is None else self._project_document({**previous, **event}, fields)
+        return self._written(mongo, document, match_expression, fields), previous
+
+    async def update_m_with_previous_async(self, mongo: 'AsyncIOMotorClient', event,
+                                           match_expression: Mapping[str, Any], tracked: Iterable[str],
+                                           expand: bool = False):
+        fields = self.requested_fields()
+        previous = await mongo['movieDB'][self._collection_name].find_one_and_update(
+            match_expression,
+            {'$set': event},
+            projection=self._stored_projection(fields, tracked),
+            return_document=ReturnDocument.BEFORE
+        )
+
+        if expand and previous is not None:
+            return await self.fetch_single_with_expression_async(mongo, match_expression), previous
+
+        document = None if previous is None else self._project_document({**previous, **event}, fields)
+        return await self._written_async(mongo, document, match_expression, fields), previous
+
+    def delete_with_previous(self, mongo: MongoClient, match_expression: Mapping[str, Any], tracked: Iterable[str]):
+        """Deletes in one round trip and returns the resource along with the deleted `tracked` values
+        """
+        fields = self.requested_fields()
+        previous = mongo['movieDB'][self._collection_name].find_one_and_delete(
+            match_expression,
+            projection=self._stored_projection(fields, tracked)
+        )
+
+        document = None if previous is None else self._project_document(previous, fields)
+        return self._written(mongo, document, match_expression, fields), previous
+
+    async def delete_with_previous_async(self, mongo: 'AsyncIOMotorClient', match_expression: Mapping[str, Any],
+                                         tracked: Iterable[str]):
+        fields = self.requested_fields()
+        previous = await mongo['movieDB'][self._collection_name].find_one_and_delete(
+            match_expression,
+            projection=self._stored_projection(fields, tracked)
+        )
+
+        document = None if previous is None else self._project_document(previous, fields)
+        return await self._written_async(mongo, document, match_expression, fields), previous
+
+    def delete(self, mongo: MongoClient, match_expression: Mapping[str, Any], expand: bool = False):
+        if expand:
+            resource = self.fetch_single_with_expression(mongo, match_expression)
+            mongo['movieDB'][self._collection_name].delete_one(match_expression)
+            return resource
+
+        fields = self.requested_fields()
+        document = mongo['movieDB'][self._collection_name].find_one_and_delete(
+            match_expression,
+            projection=self._projection(fields)
+        )
+
+        return self._written(mongo, document, match_expression, fields)
+
+    async def delete_async(self, mongo: 'AsyncIOMotorClient', match_expression: Mapping[str, Any],
+                           expand: bool = False):
+        if expand:
+            resource = await self.fetch_single_with_expression_async(mongo, match_expression)
+            await mongo['movieDB'][self._collection_name].delete_one(match_expression)
+            return resource
+
+        fields = self.requested_fields()
+        document = await mongo['movieDB'][self._collection_name].find_one_and_delete(
+            match_expression,
+            projection=self._projection(fields)
+        )
+
+        return await self._written_async(mongo, document, match_expression, fields)
+
+    def _single_with_expression_pipeline(self, match_expression: object, fields: set[str] | None) -> list[dict]:
         pipeline = [{'$match': match_expression}, {'$limit': 1}]
 
-        if self._pipeline_query_modifiers:
-            pipeline += self._pipeline_query_modifiers
+        pipeline += self._modifier_stages(fields)
+
+        pipeline += [{'$project': self._projection(fields)}]
+
+        return pipeline
 
-        pipeline += [{'$project': self._resource_fields}]
+    def fetch_single_with_expression(self, mongo: MongoClient, match_expression: object):
+        fields = self.requested_fields()
+        pipeline = self._single_with_expression_pipeline(match_expression, fields)
 
         print("pipe-{}".format(self._collection_name), pipeline)
         result = list(mongo['movieDB'][self._collection_name].aggregate(pipeline))
@@ -327,9 +768,20 @@ class FieldLogic:
         if len(result) == 0:
             raise ResourceNotFoundException("resource not found")
 
-        return self._enhancer(mongo, result)[0]
+        return self._enhancer(mongo, result, fields)[0]
 
-    def fetch_single(self, mongo: MongoClient, identifier, match_expression: object | None = None):
+    async def fetch_single_with_expression_async(self, mongo: 'AsyncIOMotorClient', match_expression: object):
+        fields = self.requested_fields()
+        pipeline = self._single_with_expression_pipeline(match_expression, fields)
+
+        result = await mongo['movieDB'][self._collection_name].aggregate(pipeline).to_list(None)
+
+        if len(result) == 0:
+            raise ResourceNotFoundException("resource not found")
+
+        return (await self._enhancer_async(mongo, result, fields))[0]
+
+    def _single_pipeline(self, identifier, match_expression: object | None, fields: set[str] | None) -> list[dict]:
         identifier_field = self._resource_fields.get(self._identifier_field).removeprefix('$')
 
         pipeline = [{'$match': {
@@ -343,60 +795,166 @@ class FieldLogic:
 
         pipeline += [{'$limit': 1}]
 
-        if self._pipeline_query_modifiers:
-            pipeline += self._pipeline_query_modifiers
+        pipeline += self._modifier_stages(fields)
+
+        pipeline += [{'$project': self._projection(fields)}]
 
-        pipeline += [{'$project': self._resource_fields}]
+        return pipeline
+
+    def fetch_single(self, mongo: MongoClient, identifier, match_expression: object | None = None):
+        fields = self.requested_fields()
+        pipeline = self._single_pipeline(identifier, match_expression, fields)
 
         result = list(mongo['movieDB'][self._collection_name].aggregate(pipeline))
 
         if len(result) == 0:
             raise ResourceNotFoundException("resource not found with id {}".format(identifier))
 
-        return self._enhancer(mongo, result)[0]
+        return self._enhancer(mongo, result, fields)[0]
+
+    async def fetch_single_async(self, mongo: 'AsyncIOMotorClient', identifier, match_expression: object | None = None):
+        fields = self.requested_fields()
+        pipeline = self._single_pipeline(identifier, match_expression, fields)
+
+        result = await mongo['movieDB'][self._collection_name].aggregate(pipeline).to_list(None)
+
+        if len(result) == 0:
+            raise ResourceNotFoundException("resource not found with id {}".format(identifier))
+
+        return (await self._enhancer_async(mongo, result, fields))[0]
+
+    def _many_pipeline(self, identifiers: list, match_expression: object | None,
+                       fields: set[str] | None) -> list[dict]:
+        identifier_field = self.map_db_field_name(self._identifier_field)
+
+        pipeline = [{'$match': {
+            identifier_field: {
+                '$in': identifiers
+            }
+        }}]
+
+        if match_expression is not None:
+            pipeline += [match_expression]
+
+        pipeline += self._modifier_stages(fields)
+
+        pipeline += [{'$project': self._projection(fields)}]
+
+        return pipeline
+
+    def _batch_response(self, identifiers: list, result: list) -> BatchResponse:
+        by_identifier = {str(resource.get(self._identifier_field)): resource for resource in result}
+
+        return BatchResponse(
+            [by_identifier[str(identifier)] for identifier in identifiers if str(identifier) in by_identifier],
+            [str(identifier) for identifier in identifiers if str(identifier) not in by_identifier]
+        )
+
+    def fetch_many(self, mongo: MongoClient, identifiers: list,
+                   match_expression: object | None = None) -> BatchResponse:
+        """Loads many resources with one $in match, in the order given, reporting the identifiers not found
+        """
+        fields = self.requested_fields()
+        identifiers = list(dict.fromkeys(parse_search_value(identifier) for identifier in identifiers))
+        pipeline = self._many_pipeline(identifiers, match_expression, fields)
+
+        result = list(mongo['movieDB'][self._collection_name].aggregate(pipeline))
+
+        self._enhancer(mongo, result, fields)
+
+        return self._batch_response(identifiers, result)
+
+    async def fetch_many_async(self, mongo: 'AsyncIOMotorClient', identifiers: list,
+                               match_expression: object | None = None) -> BatchResponse:
+        fields = self.requested_fields()
+        identifiers = list(dict.fromkeys(parse_search_value(identifier) for identifier in identifiers))
+        pipeline = self._many_pipeline(identifiers, match_expression, fields)
+
+        result = await mongo['movieDB'][self._collection_name].aggregate(pipeline).to_list(None)
+
+        await self._enhancer_async(mongo, result, fields)
+
+        return self._batch_response(identifiers, result)
 
     def get_search_meta_data(self):
-        return parse_search_meta_data(self._identity_order_field, self._order_fields,
-                                      self._search_fields, self._page_size_limit)
+        search_meta_data = parse_search_meta_data(self._identity_order_field, self._order_fields,
+                                                  self._search_fields, self._page_size_limit, self._term_fields)
+        search_meta_data.fields = self.requested_fields()
+        return search_meta_data
 
-    def fetch_listing(self, mongo: MongoClient, search_meta_data: SearchMetaData = None):
-        if search_meta_data is None:
-            search_meta_data = self.get_search_meta_data()
+    def _listing_pipeline(self, search_meta_data: SearchMetaData) -> list[dict]:
+        orders = self._key_set_orders(search_meta_data.orders)
 
-        pipeline = [
-            *search_meta_data.digest(self._resource_fields),
-            *self._listing_key_set_actions(search_meta_data),
-            {'$limit': search_meta_data.limit},
+        # a previous page is the next page of the reversed sort, read back to front
+        query_meta_data = replace(search_meta_data,
+                                  orders=[order.reversed() for order in orders] if self._backwards(search_meta_data)
+                                  else orders)
 
+        pipeline = [
+            *self._compiled_queries(query_meta_data.shape()).stages(query_meta_data.filter_values(),
+                                                                    self._listing_key_set_actions(query_meta_data)),
+            {'$limit': search_meta_data.limit + 1},
         ]
 
-        if self._pipeline_query_modifiers:
-            pipeline += self._pipeline_query_modifiers
+        pipeline += self._modifier_stages(search_meta_data.fields)
 
+        # sort fields stay projected, the cursor is built from them
         pipeline += [
-            {'$project': self._resource_fields}
+            {'$project': self._projection(search_meta_data.fields, {order.field for order in orders})}
         ]
 
-        result = self._enhancer(mongo, list(mongo['movieDB'][self._collection_name].aggregate(pipeline)))
+        return pipeline
+
+    @staticmethod
+    def _backwards(search_meta_data: SearchMetaData) -> bool:
+        position = search_meta_data.position
+        return position is not None and position.direction == CursorDirection.PREVIOUS
+
+    def _listing_page(self, search_meta_data: SearchMetaData, result: list) -> tuple[list, Cursor | None]:
+        """Trims the lookahead row and builds the cursors, before the enhancer may rewrite any sort values
+        """
+        orders = self._key_set_orders(search_meta_data.orders)
+        backwards = self._backwards(search_meta_data)
+
+        has_more = len(result) > search_meta_data.limit
+        result = result[:search_meta_data.limit]
+
+        if backwards:
+            result.reverse()
+
+        has_next = True if backwards else has_more
+        has_previous = has_more if backwards else search_meta_data.position is not None
+
+        cursor_next = encode_cursor(orders, result[-1], CursorDirection.NEXT) \
+            if has_next and result else None
+        cursor_previous = encode_cursor(orders, result[0], CursorDirection.PREVIOUS) \
+            if has_previous and result else None
+
+        if cursor_next is not None or cursor_previous is not None:
+            return result, Cursor(cursor_next, cursor_previous)
 
-        if len(result) > 0 and len(result) == self._page_size_limit:
-            last = result[len(result) - 1]
+        return result, None
+
+    def fetch_listing(self, mongo: MongoClient, search_meta_data: SearchMetaData = None):
+        if search_meta_data is None:
+            search_meta_data = self.get_search_meta_data()
+
+        pipeline = self._listing_pipeline(search_meta_data)
+
+        result = list(mongo['movieDB'][self._collection_name].aggregate(pipeline))
+
+        (result, cursor) = self._listing_page(search_meta_data, result)
+
+        return PageResponse(self._enhancer(mongo, result, search_meta_data.fields), cursor)
+
+    async def fetch_listing_async(self, mongo: 'AsyncIOMotorClient', search_meta_data: SearchMetaData = None):
+        if search_meta_data is None:
+            search_meta_data = self.get_search_meta_data()
 
-            if len(search_meta_data.orders) == 1:
-                cursor_next = base64.b64encode(urllib.parse.urlencode({
-                    'p': last[self._identity_order_field.field],
-                    'pf': self._identity_order_field.field,
-                }).encode('ascii')).decode('ascii')
+        pipeline = self._listing_pipeline(search_meta_data)
 
-                return PageResponse(result, Cursor(cursor_next, "prev"))
-            elif len(search_meta_data.orders) > 1:
-                cursor_next = base64.b64encode(urllib.parse.urlencode({
-                    'p': last[self._identity_order_field.field],
-                    'pf': self._identity_order_field.field,
-                    's': last[search_meta_data.orders[1].field],
-                    'sf': search_meta_data.orders[1].field,
-                }).encode('ascii')).decode('ascii')
+        result = await mongo['movieDB'][self._collection_name].aggregate(pipeline).to_list(None)
 
-                return PageResponse(result, Cursor(cursor_next, "prev"))
+        (result, cursor) = self._listing_page(search_meta_data, result)
 
-        return PageResponse(result, None)
+        return PageResponse(await self._enhancer_async(mongo, result, search_meta_data.fields), cursor)
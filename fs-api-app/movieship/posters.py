@@ -0,0 +1,338 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Final
+
+import requests
+from pymongo import UpdateOne
+from requests.adapters import HTTPAdapter
+
+from movieship.indexes import declare_indexes, index
+
+OMDB_URL: Final[str] = "http://www.omdbapi.com/"
+OMDB_API_KEY: Final[str] = "8126e5b4"
+# the only OMDb error saying the title has no entry, the others (e.g. "Request limit reached!") are failures
+OMDB_NOT_FOUND_ERROR: Final[str] = "Movie not found!"
+POSTER_PLACEHOLDER: Final[str] = "https://placehold.co/332x249"
+POSTER_WORKERS: Final[int] = 4
+POSTER_WRITE_BATCH_SIZE: Final[int] = 50
+POSTER_WRITE_INTERVAL_SECONDS: Final[float] = 1.0
+POSTER_MISS_COLLECTION_NAME: Final[str] = 'poster_misses'
+POSTER_MISS_RETRY_AFTER: Final[timedelta] = timedelta(days=7)
+POSTER_MISS_CACHE_SIZE: Final[int] = 10_000
+OMDB_CONNECT_TIMEOUT_SECONDS: Final[float] = 2.0
+OMDB_READ_TIMEOUT_SECONDS: Final[float] = 3.0
+BREAKER_FAILURE_THRESHOLD: Final[int] = 5
+BREAKER_RESET_SECONDS: Final[float] = 30.0
+
+
+def poster_missing(poster) -> bool:
+    return poster == '' or poster == 'N/A' or poster is None
+
+
+class OmdbError(Exception):
+    pass
+
+
+class BreakerState(Enum):
+    CLOSED = 1
+    OPEN = 2
+    HALF_OPEN = 3
+
+
+class CircuitBreaker:
+    """Stops outbound calls after `failure_threshold` consecutive failures
+
+    Once `reset_seconds` have passed a single probe call is let through, closing the
+    breaker when it succeeds and reopening it when it fails.
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self._failure_threshold = failure_threshold
+        self._reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._state = BreakerState.CLOSED
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> BreakerState:
+        return self._state
+
+    def rejecting(self) -> bool:
+        """Whether calls are currently being refused, without claiming the probe call
+        """
+        with self._lock:
+            match self._state:
+                case BreakerState.CLOSED:
+                    return False
+                case BreakerState.OPEN:
+                    return time.monotonic() - self._opened_at < self._reset_seconds
+                case BreakerState.HALF_OPEN:
+                    return True
+
+    def allow(self) -> bool:
+        with self._lock:
+            match self._state:
+                case BreakerState.CLOSED:
+                    return True
+                case BreakerState.OPEN:
+                    if time.monotonic() - self._opened_at >= self._reset_seconds:
+                        self._state = BreakerState.HALF_OPEN
+                        return True
+                    return False
+                case BreakerState.HALF_OPEN:
+                    return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._state = BreakerState.CLOSED
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == BreakerState.HALF_OPEN or self._failures >= self._failure_threshold:
+                self._state = BreakerState.OPEN
+                self._opened_at = time.monotonic()
+
+
+class PosterEnricher:
+    """Fetches missing posters from OMDb on a bounded worker pool
+
+    Requests for an imdb_id already being fetched are dropped, and fetched posters
+    are written back to the collection in batched bulk writes by a single writer thread.
+    Titles OMDb has no entry for are remembered in a persisted negative cache until their
+    retry time, the most recent `miss_cache_size` of them also in memory. Any other OMDb error
+    counts as a failure, and a circuit breaker stops calling OMDb while it keeps failing.
+    """
+
+    def __init__(
+            self,
+            collection_name: str,
+            identifier_field: str,
+            omdb_url: str = OMDB_URL,
+            api_key: str = OMDB_API_KEY,
+            workers: int = POSTER_WORKERS,
+            batch_size: int = POSTER_WRITE_BATCH_SIZE,
+            flush_interval: float = POSTER_WRITE_INTERVAL_SECONDS,
+            miss_collection_name: str = POSTER_MISS_COLLECTION_NAME,
+            miss_retry_after: timedelta = POSTER_MISS_RETRY_AFTER,
+            miss_cache_size: int = POSTER_MISS_CACHE_SIZE,
+            timeout: tuple[float, float] = (OMDB_CONNECT_TIMEOUT_SECONDS, OMDB_READ_TIMEOUT_SECONDS),
+            breaker: CircuitBreaker = None
+    ):
+        self._collection_name: Final[str] = collection_name
+        self._identifier_field: Final[str] = identifier_field
+        self._omdb_url = omdb_url
+        self._api_key = api_key
+        self._workers = workers
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._executor = None
+        self._writer = None
+        self._writes = queue.Queue()
+        self._in_flight: set[str] = set()
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._miss_collection_name: Final[str] = miss_collection_name
+        declare_indexes(miss_collection_name, [index('retryAfter', expire_after_seconds=0)])
+        self._miss_retry_after = miss_retry_after
+        self._misses: OrderedDict[str, datetime] = OrderedDict()
+        self._miss_cache_size = miss_cache_size
+        self._timeout = timeout
+        self._breaker = breaker if breaker is not None else CircuitBreaker()
+        self._session = requests.Session()
+        self._session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self._counters: dict[str, int] = {
+            'hits': 0,
+            'misses': 0,
+            'errors': 0,
+            'negative_cache_hits': 0,
+            'breaker_rejections': 0,
+        }
+
+    def add_listener(self, listener):
+        """Registers a callable receiving the client and the set of imdb_ids whose posters were just written
+        """
+        self._listeners.append(listener)
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def stats(self) -> dict[str, any]:
+        with self._lock:
+            return {**self._counters, 'in_flight': len(self._in_flight), 'breaker': self._breaker.state.name}
+
+    def _start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="poster")
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="poster-writer", daemon=True)
+            self._writer.start()
+
+    def fetch_poster(self, imdb_id: str):
+        """Returns the OMDb poster, the placeholder when OMDb has none, or None when OMDb has no such title
+
+        Raises OmdbError for any other error OMDb reports.
+        """
+        response = self._session.get(self._omdb_url, params={'apikey': self._api_key, 'i': imdb_id},
+                                     timeout=self._timeout)
+        response.raise_for_status()
+        response = response.json()
+
+        poster = response.get('Poster')
+
+        if poster_missing(poster):
+            if response.get('Error') == OMDB_NOT_FOUND_ERROR:
+                return None
+            if 'Error' in response:
+                raise OmdbError(response['Error'])
+            poster = POSTER_PLACEHOLDER
+
+        return poster
+
+    def _negative_cached(self, imdb_id: str) -> bool:
+        retry_after = self._misses.get(imdb_id)
+        if retry_after is None:
+            return False
+        if retry_after <= datetime.utcnow():
+            self._misses.pop(imdb_id, None)
+            return False
+        return True
+
+    def submit(self, mongo, imdb_id: str) -> bool:
+        """Queues a poster fetch for imdb_id, returns whether a fetch is pending for it
+        """
+        with self._lock:
+            if imdb_id in self._in_flight:
+                return True
+            if self._negative_cached(imdb_id):
+                self._counters['negative_cache_hits'] += 1
+                return False
+            if self._breaker.rejecting():
+                self._counters['breaker_rejections'] += 1
+                return False
+            self._in_flight.add(imdb_id)
+            self._start()
+
+        self._executor.submit(self._enrich, mongo, imdb_id)
+        return True
+
+    def pending(self, imdb_id: str) -> bool:
+        with self._lock:
+            return imdb_id in self._in_flight
+
+    def _remember_miss(self, imdb_id: str, retry_after: datetime):
+        with self._lock:
+            self._misses[imdb_id] = retry_after
+            self._misses.move_to_end(imdb_id)
+
+            while len(self._misses) > self._miss_cache_size:
+                self._misses.popitem(last=False)
+
+    def _load_miss(self, mongo, imdb_id: str) -> bool:
+        miss = mongo['movieDB'][self._miss_collection_name].find_one(
+            {'_id': imdb_id, 'retryAfter': {'$gt': datetime.utcnow()}})
+
+        if miss is None:
+            return False
+
+        self._remember_miss(imdb_id, miss['retryAfter'])
+        return True
+
+    def _record_miss(self, mongo, imdb_id: str):
+        retry_after = datetime.utcnow() + self._miss_retry_after
+        self._remember_miss(imdb_id, retry_after)
+
+        mongo['movieDB'][self._miss_collection_name].update_one(
+            {'_id': imdb_id}, {'$set': {'retryAfter': retry_after}}, upsert=True)
+
+    def _enrich(self, mongo, imdb_id: str):
+        poster = None
+
+        try:
+            if self._load_miss(mongo, imdb_id):
+                self._count('negative_cache_hits')
+            elif not self._breaker.allow():
+                self._count('breaker_rejections')
+            else:
+                try:
+                    poster = self.fetch_poster(imdb_id)
+                except Exception as ex:
+                    print("poster fetch failed", imdb_id, ex)
+                    self._breaker.failure()
+                    self._count('errors')
+                else:
+                    self._breaker.success()
+                    if poster is None:
+                        self._count('misses')
+                        self._record_miss(mongo, imdb_id)
+                    else:
+                        self._count('hits')
+        except Exception as ex:
+            print("poster enrichment failed", imdb_id, ex)
+
+        if poster is None:
+            self._done(imdb_id)
+        else:
+            self._writes.put((mongo, imdb_id, poster))
+
+    def _done(self, imdb_id: str):
+        with self._lock:
+            self._in_flight.discard(imdb_id)
+
+    def _write_loop(self):
+        while True:
+            batch = [self._writes.get()]
+
+            try:
+                while len(batch) < self._batch_size:
+                    batch.append(self._writes.get(timeout=self._flush_interval))
+            except queue.Empty:
+                pass
+
+            self._flush(batch)
+
+    def _flush(self, batch):
+        by_client = {}
+        for (mongo, imdb_id, poster) in batch:
+            by_client.setdefault(id(mongo), (mongo, []))[1].append((imdb_id, poster))
+
+        for (mongo, posters) in by_client.values():
+            try:
+                mongo['movieDB'][self._collection_name].bulk_write(
+                    [UpdateOne({self._identifier_field: imdb_id}, {"$set": {'poster': poster}})
+                     for (imdb_id, poster) in posters],
+                    ordered=False
+                )
+            except Exception as ex:
+                print("poster write failed", ex)
+            else:
+                for listener in self._listeners:
+                    listener(mongo, {imdb_id for (imdb_id, _) in posters})
+            finally:
+                for (imdb_id, _) in posters:
+                    self._done(imdb_id)
+
+    def join(self, timeout: float | None = None) -> bool:
+        """Waits until every queued fetch has been fetched and written back
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self._lock:
+                if not self._in_flight:
+                    return True
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+            time.sleep(0.05)
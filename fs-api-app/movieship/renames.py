@@ -0,0 +1,154 @@
+import os
+import queue
+import socket
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Final
+
+from pymongo import ReturnDocument
+
+from movieship.indexes import declare_indexes, index
+
+RENAME_COLLECTION_NAME: Final[str] = 'profile_renames'
+RENAME_BATCH_SIZE: Final[int] = 500
+RENAME_LEASE: Final[timedelta] = timedelta(minutes=1)
+RENAME_KEEP_FINISHED: Final[timedelta] = timedelta(days=7)
+RENAME_NEVER_LEASED: Final[datetime] = datetime(1970, 1, 1)
+
+
+@dataclass(frozen=True)
+class RenameTarget:
+    collection_name: str
+    user_field: str
+    name_field: str
+
+
+class NameFanout:
+    """Rewrites the display name copied onto other collections after a profile is renamed
+
+    Each rename is a persisted job keyed by sub, so a later rename of the same profile takes over
+    the pending one and an interrupted job is picked up again by `resume`. Jobs are leased, only
+    one process works on a sub at a time, and documents are rewritten in batches of `batch_size`
+    with the progress recorded after every batch.
+    """
+
+    def __init__(
+            self,
+            collection_name: str = RENAME_COLLECTION_NAME,
+            batch_size: int = RENAME_BATCH_SIZE,
+            lease: timedelta = RENAME_LEASE,
+            keep_finished: timedelta = RENAME_KEEP_FINISHED
+    ):
+        self._collection_name: Final[str] = collection_name
+        declare_indexes(collection_name, [index('done'), index('expireAt', expire_after_seconds=0)])
+        self._batch_size = batch_size
+        self._lease = lease
+        self._keep_finished = keep_finished
+        self._targets: list[RenameTarget] = []
+        self._jobs = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def add_target(self, collection_name: str, user_field: str, name_field: str):
+        """Registers a collection holding a copy of the name in name_field for the sub in user_field
+        """
+        self._targets.append(RenameTarget(collection_name, user_field, name_field))
+
+    def _start(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work_loop, name="name-fanout", daemon=True)
+                self._worker.start()
+
+    @staticmethod
+    def _owner() -> str:
+        return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+    def record(self, mongo, sub: str, name: str):
+        """Persists the rename as the pending job of sub, replacing any pending rename of the same sub
+        """
+        mongo['movieDB'][self._collection_name].update_one({'_id': sub}, {
+            '$set': {'name': name, 'done': False, 'requested': datetime.utcnow()},
+            '$unset': {'expireAt': ''},
+            '$setOnInsert': {'leaseUntil': RENAME_NEVER_LEASED, 'rewritten': 0}
+        }, upsert=True)
+
+    def submit(self, mongo, sub: str, name: str):
+        """Records the rename and queues the rewrite on the background thread
+        """
+        self.record(mongo, sub, name)
+
+        self._jobs.put((mongo, sub))
+        self._start()
+
+    def resume(self, mongo) -> int:
+        """Queues every unfinished job, returns how many were found
+        """
+        subs = [job['_id'] for job in mongo['movieDB'][self._collection_name].find({'done': False}, {'_id': 1})]
+
+        for sub in subs:
+            self._jobs.put((mongo, sub))
+        if subs:
+            self._start()
+
+        return len(subs)
+
+    def _work_loop(self):
+        while True:
+            (mongo, sub) = self._jobs.get()
+
+            try:
+                self.run(mongo, sub)
+            except Exception as ex:
+                print("name fan-out failed", sub, ex)
+
+    def _lease_job(self, mongo, sub: str):
+        now = datetime.utcnow()
+
+        return mongo['movieDB'][self._collection_name].find_one_and_update({
+            '_id': sub,
+            'done': False,
+            '$or': [{'leaseUntil': {'$lt': now}}, {'owner': self._owner()}]
+        }, {
+            '$set': {'leaseUntil': now + self._lease, 'owner': self._owner()}
+        }, return_document=ReturnDocument.AFTER)
+
+    def _rewrite_batch(self, mongo, target: RenameTarget, sub: str, name: str) -> int:
+        collection = mongo['movieDB'][target.collection_name]
+        ids = [document['_id'] for document in collection.find(
+            {target.user_field: sub, target.name_field: {'$ne': name}}, {'_id': 1}).limit(self._batch_size)]
+
+        if ids:
+            collection.update_many({'_id': {'$in': ids}}, {'$set': {target.name_field: name}})
+
+        return len(ids)
+
+    def run(self, mongo, sub: str) -> bool:
+        """Works on the job of sub until it is done, returns False when another process holds it
+        """
+        jobs = mongo['movieDB'][self._collection_name]
+
+        while True:
+            job = self._lease_job(mongo, sub)
+            if job is None:
+                return False
+
+            name = job['name']
+            rewritten = sum(self._rewrite_batch(mongo, target, sub, name) for target in self._targets)
+
+            if rewritten > 0:
+                jobs.update_one({'_id': sub}, {'$inc': {'rewritten': rewritten},
+                                               '$set': {'updated': datetime.utcnow()}})
+                continue
+
+            # a rename submitted meanwhile changed the name, its job carries on with the next lease
+            finished = jobs.update_one({'_id': sub, 'name': name}, {'$set': {
+                'done': True,
+                'updated': datetime.utcnow(),
+                'leaseUntil': RENAME_NEVER_LEASED,
+                'expireAt': datetime.utcnow() + self._keep_finished
+            }, '$unset': {'owner': ''}})
+
+            if finished.modified_count > 0:
+                return True
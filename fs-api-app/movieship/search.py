@@ -0,0 +1,48 @@
+import re
+import unicodedata
+from typing import Final
+
+TERMS_FIELD_FORMAT: Final[str] = '{}Terms'
+TERM_PATTERN: Final[re.Pattern] = re.compile(r'\w+')
+
+
+def terms_field(field: str) -> str:
+    """The stored field holding the search terms of `field`, e.g. primaryTitle -> primaryTitleTerms
+    """
+    return TERMS_FIELD_FORMAT.format(field)
+
+
+def normalize(value: str) -> str:
+    """Case-folds and strips accents, so 'Amélie' and 'AMELIE' normalize alike
+    """
+    decomposed = unicodedata.normalize('NFKD', value)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+def search_terms(value: str | None) -> list[str]:
+    """The distinct normalized word terms of a value, in order of appearance
+    """
+    if not value:
+        return []
+
+    return list(dict.fromkeys(TERM_PATTERN.findall(normalize(str(value)))))
+
+
+def typed_terms(value: str | None) -> tuple[list[str], str | None]:
+    """The complete terms of a value still being typed, and its last term when the value ends inside it
+
+    'the godf' is (['the'], 'godf'), 'the godf ' is (['the', 'godf'], None).
+    """
+    normalized = normalize(str(value or ''))
+    terms = TERM_PATTERN.findall(normalized)
+
+    if terms and TERM_PATTERN.match(normalized[-1]):
+        return list(dict.fromkeys(terms[:-1])), terms[-1]
+
+    return list(dict.fromkeys(terms)), None
+
+
+def title_key(value: str | None) -> str:
+    """The normalized title, its words joined by single spaces, used to match title prefixes
+    """
+    return ' '.join(TERM_PATTERN.findall(normalize(value or '')))
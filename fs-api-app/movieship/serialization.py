@@ -0,0 +1,38 @@
+from typing import Final
+
+import orjson
+from bson import ObjectId, Decimal128
+from flask.json.provider import JSONProvider
+
+JSON_OPTIONS: Final[int] = orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC
+
+
+def default(value):
+    """Encodes the BSON types orjson does not know, datetimes and dataclasses are handled natively
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def dumps_bytes(obj) -> bytes:
+    return orjson.dumps(obj, default=default, option=JSON_OPTIONS)
+
+
+class OrjsonProvider(JSONProvider):
+    """Serializes responses straight from documents holding ObjectIds, so enhancers need not rewrite _id
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        return dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype='application/json')
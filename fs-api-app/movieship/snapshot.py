@@ -0,0 +1,570 @@
+import functools
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import Final, Callable
+
+from bson import ObjectId
+
+from movieship.importer import IMPORT_SHOWS_COLLECTION_NAME, tconst_key, imdb_id
+from movieship.logic import SearchType, parse_search_value
+
+CATALOG_SNAPSHOT_DIRECTORY: Final[str | None] = os.environ.get('MOVIESHIP_CATALOG_SNAPSHOT_DIR') or None
+CATALOG_SNAPSHOT_MAGIC: Final[bytes] = b'MSCATLG2'
+CATALOG_SNAPSHOT_POINTER: Final[str] = 'CURRENT'
+CATALOG_SNAPSHOT_FILE_FORMAT: Final[str] = 'catalog-{}.snapshot'
+CATALOG_SNAPSHOT_KEEP: Final[int] = 3
+CATALOG_SNAPSHOT_CHECK_SECONDS: Final[float] = 5.0
+CATALOG_SNAPSHOT_SCAN_BUDGET: Final[int] = 20_000
+CATALOG_SNAPSHOT_FETCH_BATCH_SIZE: Final[int] = 5000
+CATALOG_SNAPSHOT_ALIGNMENT: Final[int] = 8
+CATALOG_NULL: Final[int] = -2 ** 31
+CATALOG_NULL_CODE: Final[int] = 255
+# the length of a null text or list, so a length of 0 stays the empty string or the empty list
+CATALOG_NULL_LENGTH: Final[int] = 2 ** 16 - 1
+CATALOG_MAX_TEXT_BYTES: Final[int] = CATALOG_NULL_LENGTH - 1
+CATALOG_MAX_BLOB_BYTES: Final[int] = 2 ** 32 - 1
+CATALOG_INT_FIELDS: Final[tuple[str, ...]] = ('startYear', 'endYear', 'runtimeMinutes', 'averageRatingVotes')
+CATALOG_TENTHS_FIELDS: Final[tuple[str, ...]] = ('averageRating',)
+CATALOG_CODE_FIELDS: Final[tuple[str, ...]] = ('titleType',)
+CATALOG_TEXT_FIELDS: Final[tuple[str, ...]] = ('primaryTitle', 'originalTitle')
+CATALOG_LIST_FIELDS: Final[tuple[str, ...]] = ('genres',)
+# the stored fields of EXPLORE_ALLOWED_ORDER_FIELDS, tconst needs none as it is the row order itself
+CATALOG_ORDER_FIELDS: Final[tuple[str, ...]] = ('startYear', 'primaryTitle', 'titleType')
+CATALOG_LIST_SEPARATOR: Final[str] = ','
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // CATALOG_SNAPSHOT_ALIGNMENT) * CATALOG_SNAPSHOT_ALIGNMENT
+
+
+def _stored_int(value) -> int:
+    if isinstance(value, bool) or not isinstance(value, int) or not CATALOG_NULL < value < 2 ** 31:
+        return CATALOG_NULL
+    return value
+
+
+def _stored_tenths(value) -> int:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return CATALOG_NULL
+    return _stored_int(round(value * 10))
+
+
+class _SnapshotWriter:
+    """Accumulates the shows of one snapshot into compact columns, in tconst order
+    """
+
+    def __init__(self):
+        self.ids = bytearray()
+        self.keys = array('I')
+        self.numbers = {field: array('i') for field in CATALOG_INT_FIELDS + CATALOG_TENTHS_FIELDS}
+        self.codes = {field: array('B') for field in CATALOG_CODE_FIELDS}
+        self.tables: dict[str, dict[str, int]] = {field: {} for field in CATALOG_CODE_FIELDS}
+        self.starts = {field: array('I') for field in CATALOG_TEXT_FIELDS + CATALOG_LIST_FIELDS}
+        self.lengths = {field: array('H') for field in CATALOG_TEXT_FIELDS + CATALOG_LIST_FIELDS}
+        self.blob = bytearray()
+
+    def _text(self, field: str, value: str | None, row_texts: dict[bytes, int]):
+        if value is None:
+            self.starts[field].append(len(self.blob))
+            self.lengths[field].append(CATALOG_NULL_LENGTH)
+            return
+
+        encoded = value.encode('utf-8')
+        if len(encoded) > CATALOG_MAX_TEXT_BYTES:
+            raise ValueError("{} of {} bytes does not fit a snapshot".format(field, len(encoded)))
+
+        # an originalTitle equal to the primaryTitle shares its bytes
+        start = row_texts.get(encoded)
+        if start is None:
+            start = len(self.blob)
+            self.blob += encoded
+            row_texts[encoded] = start
+
+        self.starts[field].append(start)
+        self.lengths[field].append(len(encoded))
+
+    def add(self, show: dict[str, any]):
+        key = tconst_key(show.get('tconst') or '')
+        if key is None:
+            return
+
+        self.ids += ObjectId(show['_id']).binary
+        self.keys.append(key)
+
+        for field in CATALOG_INT_FIELDS:
+            self.numbers[field].append(_stored_int(show.get(field)))
+        for field in CATALOG_TENTHS_FIELDS:
+            self.numbers[field].append(_stored_tenths(show.get(field)))
+
+        for field in CATALOG_CODE_FIELDS:
+            value = show.get(field)
+            if not isinstance(value, str):
+                self.codes[field].append(CATALOG_NULL_CODE)
+                continue
+            if value not in self.tables[field] and len(self.tables[field]) >= CATALOG_NULL_CODE:
+                raise ValueError("{} has more distinct values than a snapshot holds".format(field))
+            self.codes[field].append(self.tables[field].setdefault(value, len(self.tables[field])))
+
+        row_texts: dict[bytes, int] = {}
+        for field in CATALOG_TEXT_FIELDS:
+            value = show.get(field)
+            self._text(field, value if isinstance(value, str) else None, row_texts)
+        for field in CATALOG_LIST_FIELDS:
+            value = show.get(field)
+            self._text(field, CATALOG_LIST_SEPARATOR.join(value) if isinstance(value, list) else None, row_texts)
+
+        if len(self.blob) > CATALOG_MAX_BLOB_BYTES:
+            raise ValueError("snapshot strings exceed 4GiB")
+
+    def sorted_codes(self) -> dict[str, list[str]]:
+        """Renumbers the codes in the order of their values, so codes sort like the strings they stand for
+        """
+        tables = {}
+        for field in CATALOG_CODE_FIELDS:
+            table = sorted(self.tables[field])
+            renumbered = {self.tables[field][value]: code for (code, value) in enumerate(table)}
+            renumbered[CATALOG_NULL_CODE] = CATALOG_NULL_CODE
+            self.codes[field] = array('B', (renumbered[code] for code in self.codes[field]))
+            tables[field] = table
+        return tables
+
+    def permutation(self, field: str) -> tuple[array, int]:
+        """The rows in (field, tconst) order with the nulls first, as Mongo sorts them, and the null count
+        """
+        rows = range(len(self.keys))
+
+        if field in self.numbers:
+            values = self.numbers[field]
+            nulls = [row for row in rows if values[row] == CATALOG_NULL]
+            ordered = sorted((row for row in rows if values[row] != CATALOG_NULL), key=values.__getitem__)
+        elif field in self.codes:
+            values = self.codes[field]
+            nulls = [row for row in rows if values[row] == CATALOG_NULL_CODE]
+            ordered = sorted((row for row in rows if values[row] != CATALOG_NULL_CODE), key=values.__getitem__)
+        else:
+            (starts, lengths, blob) = (self.starts[field], self.lengths[field], self.blob)
+            nulls = [row for row in rows if lengths[row] == CATALOG_NULL_LENGTH]
+            ordered = sorted((row for row in rows if lengths[row] != CATALOG_NULL_LENGTH),
+                             key=lambda row: blob[starts[row]:starts[row] + lengths[row]])
+
+        # sorted is stable, ties stay in tconst order
+        return array('I', nulls + ordered), len(nulls)
+
+
+def write_snapshot(database, directory: str, collection_name: str = IMPORT_SHOWS_COLLECTION_NAME,
+                   keep: int = CATALOG_SNAPSHOT_KEEP) -> str:
+    """Writes the shows as a new snapshot version and points the running workers at it, returns its path
+
+    The file is written beside the current one and renamed into place, then the pointer file is
+    replaced the same way, so readers only ever see a complete snapshot. Older versions past `keep`
+    are unlinked, processes still mapping one keep it until they swap.
+    """
+    started = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+
+    writer = _SnapshotWriter()
+    projection = ['_id', 'tconst', *CATALOG_INT_FIELDS, *CATALOG_TENTHS_FIELDS, *CATALOG_CODE_FIELDS,
+                  *CATALOG_TEXT_FIELDS, *CATALOG_LIST_FIELDS]
+    for show in database[collection_name].find({}, projection, sort=[('tconst', 1)],
+                                               batch_size=CATALOG_SNAPSHOT_FETCH_BATCH_SIZE):
+        writer.add(show)
+
+    tables = writer.sorted_codes()
+    sections: list[tuple[str, object, str]] = [('_id', writer.ids, 'B'), ('tconst', writer.keys, 'I')]
+    sections += [(field, values, 'i') for (field, values) in writer.numbers.items()]
+    sections += [(field, values, 'B') for (field, values) in writer.codes.items()]
+    for field in writer.starts:
+        sections += [(field + '.starts', writer.starts[field], 'I'), (field + '.lengths', writer.lengths[field], 'H')]
+    sections.append(('blob', writer.blob, 'B'))
+
+    nulls = {}
+    for field in CATALOG_ORDER_FIELDS:
+        (rows, nulls[field]) = writer.permutation(field)
+        sections.append(('order.' + field, rows, 'I'))
+
+    layout = {}
+    offset = 0
+    for (name, values, format) in sections:
+        offset = _aligned(offset)
+        size = len(memoryview(values).cast('B'))
+        layout[name] = [offset, size, format]
+        offset += size
+
+    version = '{:016x}'.format(time.time_ns())
+    header = json.dumps({
+        'version': version,
+        'created': datetime.utcnow().isoformat(),
+        'rows': len(writer.keys),
+        'byteorder': sys.byteorder,
+        'kinds': {**{field: 'int' for field in CATALOG_INT_FIELDS},
+                  **{field: 'tenths' for field in CATALOG_TENTHS_FIELDS},
+                  **{field: 'code' for field in CATALOG_CODE_FIELDS},
+                  **{field: 'text' for field in CATALOG_TEXT_FIELDS},
+                  **{field: 'list' for field in CATALOG_LIST_FIELDS}},
+        'tables': tables,
+        'nulls': nulls,
+        'sections': layout,
+    }).encode('utf-8')
+
+    prefix = CATALOG_SNAPSHOT_MAGIC + struct.pack('<I', len(header)) + header
+    data_start = _aligned(len(prefix))
+    name = CATALOG_SNAPSHOT_FILE_FORMAT.format(version)
+    path = os.path.join(directory, name)
+
+    with open(path + '.partial', 'wb') as file:
+        file.write(prefix)
+        for (section, values, _) in sections:
+            file.seek(data_start + layout[section][0])
+            file.write(memoryview(values).cast('B'))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.partial', path)
+
+    pointer = os.path.join(directory, CATALOG_SNAPSHOT_POINTER)
+    with open(pointer + '.partial', 'w', encoding='utf-8') as file:
+        file.write(name)
+    os.replace(pointer + '.partial', pointer)
+
+    for stale in sorted(glob.glob(os.path.join(directory, CATALOG_SNAPSHOT_FILE_FORMAT.format('*'))))[:-keep]:
+        os.remove(stale)
+
+    print("wrote catalog snapshot {} of {} shows, {} bytes in {:.1f}s".format(
+        name, len(writer.keys), os.path.getsize(path), time.perf_counter() - started))
+
+    return path
+
+
+class CatalogSnapshot:
+    """One snapshot version, mapped read only and read in place
+
+    Columns are memoryview casts over the mapping, so nothing is copied until a row is returned, and
+    every process mapping the file shares the same page cache pages. A row is a position in tconst
+    order, the `order.<field>` permutations list the rows in (field, tconst) order for keyset listings.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(self._map)
+        if bytes(view[:len(CATALOG_SNAPSHOT_MAGIC)]) != CATALOG_SNAPSHOT_MAGIC:
+            raise ValueError("{} is not a catalog snapshot".format(path))
+
+        (header_size,) = struct.unpack_from('<I', view, len(CATALOG_SNAPSHOT_MAGIC))
+        header_start = len(CATALOG_SNAPSHOT_MAGIC) + 4
+        header = json.loads(bytes(view[header_start:header_start + header_size]))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError("{} was written on a {} endian machine".format(path, header['byteorder']))
+
+        data_start = _aligned(header_start + header_size)
+
+        def section(name):
+            (offset, size, format) = header['sections'][name]
+            values = view[data_start + offset:data_start + offset + size]
+            return values if format == 'B' else values.cast(format)
+
+        self.name: Final[str] = os.path.basename(path)
+        self.version: Final[str] = header['version']
+        self.created: Final[str] = header['created']
+        self.rows: Final[int] = header['rows']
+        self._kinds: Final[dict[str, str]] = {'_id': 'id', 'tconst': 'key', **header['kinds']}
+        self._ids = section('_id')
+        self._keys = section('tconst')
+        self._blob = section('blob')
+        self._columns = {field: section(field) for (field, kind) in header['kinds'].items()
+                         if kind in ('int', 'tenths', 'code')}
+        self._texts = {field: (section(field + '.starts'), section(field + '.lengths'))
+                       for (field, kind) in header['kinds'].items() if kind in ('text', 'list')}
+        self._tables = {field: tuple(table) for (field, table) in header['tables'].items()}
+        self._encoded_tables = {field: tuple(value.encode('utf-8') for value in table)
+                                for (field, table) in header['tables'].items()}
+        self._orders = {field: (section('order.' + field), nulls) for (field, nulls) in header['nulls'].items()}
+
+    def __len__(self):
+        return self.rows
+
+    def nbytes(self) -> int:
+        return len(self._map)
+
+    def has_field(self, field: str) -> bool:
+        return field in self._kinds
+
+    def _text(self, field: str, row: int) -> memoryview | None:
+        (starts, lengths) = self._texts[field]
+        length = lengths[row]
+        return None if length == CATALOG_NULL_LENGTH else self._blob[starts[row]:starts[row] + length]
+
+    def value(self, field: str, row: int):
+        """The stored value of a field, as the shows collection holds it
+        """
+        match self._kinds[field]:
+            case 'id':
+                return ObjectId(bytes(self._ids[12 * row:12 * row + 12]))
+            case 'key':
+                return imdb_id(self._keys[row])
+            case 'int':
+                value = self._columns[field][row]
+                return None if value == CATALOG_NULL else value
+            case 'tenths':
+                value = self._columns[field][row]
+                return None if value == CATALOG_NULL else value / 10
+            case 'code':
+                code = self._columns[field][row]
+                return None if code == CATALOG_NULL_CODE else self._tables[field][code]
+            case 'text':
+                text = self._text(field, row)
+                return None if text is None else str(text, 'utf-8')
+            case 'list':
+                text = self._text(field, row)
+                if text is None:
+                    return None
+                return str(text, 'utf-8').split(CATALOG_LIST_SEPARATOR) if len(text) else []
+
+    def _comparable(self, field: str, row: int) -> int | bytes | None:
+        """The value the way the listings compare it, strings as their UTF-8 bytes like Mongo does
+        """
+        match self._kinds[field]:
+            case 'key':
+                return imdb_id(self._keys[row]).encode('utf-8')
+            case 'int':
+                value = self._columns[field][row]
+                return None if value == CATALOG_NULL else value
+            case 'code':
+                code = self._columns[field][row]
+                return None if code == CATALOG_NULL_CODE else self._encoded_tables[field][code]
+            case 'text':
+                text = self._text(field, row)
+                return None if text is None else bytes(text)
+
+    def find(self, tconst) -> int | None:
+        """The row of a tconst, a binary search over the rows in tconst order
+        """
+        if not isinstance(tconst, str) or tconst_key(tconst) is None:
+            return None
+
+        row = bisect_left(range(self.rows), tconst, key=lambda row: imdb_id(self._keys[row]))
+        return row if row < self.rows and imdb_id(self._keys[row]) == tconst else None
+
+    def _sort_key(self, field: str, row: int):
+        tconst = self._comparable('tconst', row)
+        if field == 'tconst':
+            return tconst
+
+        value = self._comparable(field, row)
+        return (0, b'', tconst) if value is None else (1, value, tconst)
+
+    def _position_key(self, field: str, values: list):
+        """The sort key of a cursor position, None when its values are not of the column's types
+        """
+        tconst = values[-1]
+        if not isinstance(tconst, str):
+            return None
+        if field == 'tconst':
+            return tconst.encode('utf-8')
+
+        value = values[0]
+        if value is None:
+            return 0, b'', tconst.encode('utf-8')
+        if self._kinds[field] == 'int' and isinstance(value, int) and not isinstance(value, bool):
+            return 1, value, tconst.encode('utf-8')
+        if self._kinds[field] in ('code', 'text') and isinstance(value, str):
+            return 1, value.encode('utf-8'), tconst.encode('utf-8')
+        return None
+
+    def _filter(self, field: str, search_type: SearchType, value: str) \
+            -> tuple[Callable[[int], bool], int | bytes | None] | None:
+        """The predicate of a filter and the value it pins, None when only Mongo can evaluate it
+        """
+        kind = self._kinds.get(field)
+        if kind not in ('key', 'int', 'code', 'text'):
+            return None
+
+        if search_type == SearchType.EQUIVALENT:
+            value = parse_search_value(value)
+            if kind == 'int' and isinstance(value, int) and not isinstance(value, bool):
+                expected = value
+            elif kind != 'int' and isinstance(value, str):
+                expected = value.encode('utf-8')
+            else:
+                return (lambda row: False), None
+
+            return (lambda row: self._comparable(field, row) == expected), expected
+
+        if search_type == SearchType.PREFIX and kind != 'int':
+            prefix = value.encode('utf-8')
+
+            def starts_with(row):
+                comparable = self._comparable(field, row)
+                return comparable is not None and comparable.startswith(prefix)
+
+            return starts_with, None
+
+        return None
+
+    def _bounds(self, order_field: str, field: str, search_type: SearchType, value: str, expected) -> tuple | None:
+        """The sort key range a filter on the listing's own order field narrows the scan to
+        """
+        if field != order_field:
+            return None
+
+        if search_type == SearchType.PREFIX:
+            prefix = value.encode('utf-8')
+            # UTF-8 never holds 0xff, so every string starting with prefix sorts below prefix + 0xff
+            return (prefix, prefix + b'\xff') if field == 'tconst' else ((1, prefix, b''), (1, prefix + b'\xff', b''))
+
+        if expected is None:
+            return None
+        return (expected, expected + b'\x00') if field == 'tconst' else ((1, expected, b''), (1, expected, b'\xff'))
+
+    def listing(self, order_field: str, descending: bool, allow_nulls: bool, position: list | None,
+                filters: list[tuple[str, SearchType, str]], limit: int,
+                budget: int = CATALOG_SNAPSHOT_SCAN_BUDGET) -> list[int] | None:
+        """The rows of a listing page ordered by (order_field, tconst), plus the lookahead row
+
+        `position` holds the cursor values of the last row seen, `filters` the (field, type, value) of
+        each filter. Returns None when the snapshot cannot answer it: an unsupported order or filter, or
+        filters so selective that `budget` rows were scanned without filling the page.
+        """
+        if order_field == 'tconst':
+            (sequence, nulls) = (range(self.rows), 0)
+        elif order_field in self._orders:
+            (sequence, nulls) = self._orders[order_field]
+        else:
+            return None
+
+        key = functools.partial(self._sort_key, order_field)
+        (low, high) = (0 if allow_nulls else nulls, len(sequence))
+        predicates = []
+
+        for (field, search_type, value) in filters:
+            search = self._filter(field, search_type, value)
+            if search is None:
+                return None
+
+            (predicate, expected) = search
+            predicates.append(predicate)
+
+            bounds = self._bounds(order_field, field, search_type, value, expected)
+            if bounds is not None:
+                low = max(low, bisect_left(sequence, bounds[0], key=key))
+                high = min(high, bisect_left(sequence, bounds[1], key=key))
+
+        if position is not None:
+            position_key = self._position_key(order_field, position)
+            if position_key is None:
+                return None
+
+            if descending:
+                high = min(high, bisect_left(sequence, position_key, key=key))
+            else:
+                low = max(low, bisect_right(sequence, position_key, key=key))
+
+        rows = []
+        for (scanned, index) in enumerate(range(high - 1, low - 1, -1) if descending else range(low, high)):
+            if scanned >= budget:
+                return None
+
+            row = sequence[index]
+            if all(predicate(row) for predicate in predicates):
+                rows.append(row)
+                if len(rows) > limit:
+                    break
+
+        return rows
+
+
+class CatalogSnapshots:
+    """The current catalog snapshot of a directory, swapped for a newer version once the importer writes one
+
+    The pointer file is checked at most every `check_seconds`, on the request that needs the snapshot
+    or from the response cache poller.
+    A swap only replaces the reference, requests still reading the previous version finish on it and
+    its mapping is released with the last of them. Without a directory every listing goes to Mongo.
+    """
+
+    def __init__(self, directory: str | None = CATALOG_SNAPSHOT_DIRECTORY,
+                 check_seconds: float = CATALOG_SNAPSHOT_CHECK_SECONDS):
+        self._directory: Final[str | None] = directory
+        self._check_seconds = check_seconds
+        self._snapshot: CatalogSnapshot | None = None
+        self._checked_at = float('-inf')
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._counters: dict[str, int] = {
+            'served': 0,
+            'fallbacks': 0,
+            'swaps': 0,
+        }
+
+        os.register_at_fork(after_in_child=self._forget_lock)
+
+    def _forget_lock(self):
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """Registers a callable run with None, i.e. every tag, after each swap
+        """
+        self._listeners.append(listener)
+
+    def current(self) -> CatalogSnapshot | None:
+        if self._directory is None:
+            return None
+
+        now = time.monotonic()
+        if now >= self._checked_at + self._check_seconds:
+            self._check(now)
+
+        return self._snapshot
+
+    def _check(self, now: float):
+        with self._lock:
+            if now < self._checked_at + self._check_seconds:
+                return
+            self._checked_at = now
+
+            try:
+                with open(os.path.join(self._directory, CATALOG_SNAPSHOT_POINTER), encoding='utf-8') as pointer:
+                    name = pointer.read().strip()
+            except FileNotFoundError:
+                return
+
+            if self._snapshot is not None and self._snapshot.name == name:
+                return
+
+            try:
+                snapshot = CatalogSnapshot(os.path.join(self._directory, name))
+            except (OSError, ValueError, KeyError) as ex:
+                print("catalog snapshot swap failed", name, ex)
+                return
+
+            self._snapshot = snapshot
+            self._counters['swaps'] += 1
+
+        for listener in self._listeners:
+            listener(None)
+
+    def record(self, served: bool):
+        with self._lock:
+            self._counters['served' if served else 'fallbacks'] += 1
+
+    def stats(self) -> dict[str, any]:
+        snapshot = self._snapshot
+
+        with self._lock:
+            return {
+                'directory': self._directory,
+                'version': snapshot.version if snapshot else None,
+                'created': snapshot.created if snapshot else None,
+                'rows': len(snapshot) if snapshot else 0,
+                'bytes': snapshot.nbytes() if snapshot else 0,
+                **self._counters,
+            }
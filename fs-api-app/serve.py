@@ -0,0 +1,107 @@
+import argparse
+import multiprocessing
+import os
+import sys
+from typing import Final
+
+from gunicorn.app.base import BaseApplication
+
+from app import APP, MONGO
+from movieship.auth import JWKS_CACHE
+from movieship.controllers.explore import POSTER_ENRICHER, TITLE_AUTOCOMPLETE, EXPLORE_RESPONSE_CACHE
+from movieship.controllers.profile import PROFILE_RENAMES
+from movieship.logic import CURSOR_SECRET_VARIABLE
+
+SERVE_BIND: Final[str] = os.environ.get('MOVIESHIP_BIND', '0.0.0.0:5000')
+SERVE_WORKERS: Final[int] = int(os.environ.get('MOVIESHIP_WORKERS', multiprocessing.cpu_count()))
+SERVE_THREADS: Final[int] = int(os.environ.get('MOVIESHIP_THREADS', 4))
+SERVE_GRACEFUL_TIMEOUT_SECONDS: Final[int] = int(os.environ.get('MOVIESHIP_GRACEFUL_TIMEOUT', 30))
+SERVE_POSTER_DRAIN_SECONDS: Final[float] = 5.0
+WARMUP_PATHS: Final[tuple[str, ...]] = (
+    '/api/v1/explore',
+    '/api/v1/explore?od=startYear',
+    '/api/v1/explore?oa=primaryTitle',
+)
+
+
+def warmup(worker):
+    """Connects, loads the key set and primes the per-process caches before the worker accepts requests
+    """
+    MONGO.admin.command('ping')
+
+    try:
+        JWKS_CACHE.refresh()
+    except Exception as ex:
+        worker.log.warning("warmup could not load the key set: %s", ex)
+
+    # inherited from the master when it was loaded before the fork
+    TITLE_AUTOCOMPLETE.ensure_loaded(MONGO)
+    TITLE_AUTOCOMPLETE.start(MONGO)
+
+    # reviews and posters written by the other workers drop their cached responses here too
+    EXPLORE_RESPONSE_CACHE.start(MONGO)
+
+    # renames interrupted by a restart, the lease keeps the workers from running the same one twice
+    PROFILE_RENAMES.resume(MONGO)
+
+    client = APP.test_client()
+    for path in WARMUP_PATHS:
+        response = client.get(path)
+        if response.status_code != 200:
+            worker.log.warning("warmup %s answered %s", path, response.status_code)
+
+    worker.log.info("worker %s warm", worker.pid)
+
+
+def preload(server):
+    """Packs the autocomplete titles once in the master, the forked workers share its pages
+    """
+    TITLE_AUTOCOMPLETE.load(MONGO)
+    server.log.info("autocomplete %s", TITLE_AUTOCOMPLETE.stats())
+
+
+def shutdown(server, worker):
+    # let queued poster writes land before the connections go away
+    POSTER_ENRICHER.join(SERVE_POSTER_DRAIN_SECONDS)
+    MONGO.close()
+
+
+class MovieshipApplication(BaseApplication):
+    """Pre-forks the WSGI app with gunicorn, the app is imported once in the master and shared by the workers
+    """
+
+    def __init__(self, options: dict[str, any]):
+        self._options = options
+        super().__init__()
+
+    def load_config(self):
+        for (name, value) in self._options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        return APP
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves the API with pre-forked, warmed up workers")
+    parser.add_argument('--bind', default=SERVE_BIND)
+    parser.add_argument('--workers', type=int, default=SERVE_WORKERS)
+    parser.add_argument('--threads', type=int, default=SERVE_THREADS)
+    parser.add_argument('--graceful-timeout', type=int, default=SERVE_GRACEFUL_TIMEOUT_SECONDS)
+    args = parser.parse_args()
+
+    # every worker has to verify the cursors the others signed, and keep doing so after a restart
+    if not os.environ.get(CURSOR_SECRET_VARIABLE):
+        sys.exit("{} has to be set to serve the API".format(CURSOR_SECRET_VARIABLE))
+
+    MovieshipApplication({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'graceful_timeout': args.graceful_timeout,
+        'when_ready': preload,
+        'post_worker_init': warmup,
+        'worker_exit': shutdown,
+    }).run()
@@ -0,0 +1,28 @@
+import argparse
+import os
+import sys
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.controllers.profile import PROFILE_COLLECTION_NAME, PROFILE_RENAMES
+# imported for its side effect, it registers the reviews collection with PROFILE_RENAMES
+import movieship.controllers.review  # noqa: F401
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copies every profile's name onto its reviews, written before "
+                                                 "reviews stored the username")
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    profiles = client['movieDB'][PROFILE_COLLECTION_NAME].find({'name': {'$exists': True}},
+                                                                {'_id': 0, 'sub': 1, 'name': 1})
+
+    for (number, profile) in enumerate(profiles, 1):
+        PROFILE_RENAMES.record(client, profile['sub'], profile['name'])
+        PROFILE_RENAMES.run(client, profile['sub'])
+
+        if number % 1000 == 0:
+            print("profiles", number)
@@ -0,0 +1,50 @@
+import argparse
+import os
+import resource
+import statistics
+import sys
+import time
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.autocomplete import TitleAutocomplete, AUTOCOMPLETE_LIMIT
+from movieship.controllers.explore import EXPLORE_COLLECTION_NAME
+
+# every keystroke of a few typical queries
+AUTOCOMPLETE_QUERIES = ('star wars', 'the godfather', 'breaking bad', 'amelie', 'lord of the rings')
+
+
+def max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loads the title autocomplete and measures its memory and "
+                                                 "per-keystroke latency")
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--limit', type=int, default=AUTOCOMPLETE_LIMIT)
+    parser.add_argument('queries', nargs='*', default=AUTOCOMPLETE_QUERIES)
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    autocomplete = TitleAutocomplete(EXPLORE_COLLECTION_NAME)
+
+    rss_before = max_rss_mb()
+    autocomplete.load(client)
+    print("loaded {} (max rss {:.1f}MB -> {:.1f}MB)".format(autocomplete.stats(), rss_before, max_rss_mb()))
+
+    for query in args.queries:
+        for end in range(1, len(query) + 1):
+            prefix = query[:end]
+            timings = []
+            for _ in range(args.rounds):
+                started = time.perf_counter()
+                suggestions = autocomplete.suggest(prefix, args.limit)
+                timings.append(time.perf_counter() - started)
+
+            print("{:<20} rows {:>3} median {:>8.1f}us max {:>8.1f}us  {}".format(
+                prefix, len(suggestions), 1e6 * statistics.median(timings), 1e6 * max(timings),
+                suggestions[0].primaryTitle if suggestions else ''))
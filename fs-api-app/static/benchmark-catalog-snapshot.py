@@ -0,0 +1,94 @@
+import argparse
+import os
+import resource
+import statistics
+import sys
+import time
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.controllers.explore import EXPLORE_COLLECTION_NAME, EXPLORE_IDENTIFIER_FIELD, \
+    EXPLORE_IDENTITY_ORDER_FIELD, EXPLORE_RESOURCE_FIELDS, EXPLORE_ALLOWED_ORDER_FIELDS, \
+    EXPLORE_ALLOWED_SEARCH_FIELDS, EXPLORE_PAGE_SIZE_LIMIT, EXPLORE_TERM_FIELDS, EXPLORE_FIELD_LOGIC
+from movieship.logic import FieldLogic, SearchMetaData, SearchFilter, SearchType, SearchOrder, OrderType
+from movieship.snapshot import CatalogSnapshots, CATALOG_SNAPSHOT_DIRECTORY
+
+# the live fields are read from Mongo on both paths, so they are left out to compare the catalog reads alone
+BENCHMARK_FIELDS = {'imdb_id', 'titleType', 'primaryTitle', 'startYear', 'genres', 'averageRating'}
+LISTING_SHAPES = {
+    'identity': ([], [EXPLORE_IDENTITY_ORDER_FIELD]),
+    'startYear desc': ([], [SearchOrder('startYear', OrderType.DESCENDING, False)]),
+    'primaryTitle asc': ([], [SearchOrder('primaryTitle', OrderType.ASCENDING, False)]),
+    'movies by year': ([SearchFilter('titleType', 'movie', SearchType.EQUIVALENT)],
+                       [SearchOrder('startYear', OrderType.DESCENDING, False)]),
+    'prefix by title': ([SearchFilter('primaryTitle', 'The ', SearchType.PREFIX)],
+                        [SearchOrder('primaryTitle', OrderType.ASCENDING, False)]),
+}
+
+
+class BenchmarkFieldLogic(FieldLogic):
+    def _enhancer(self, mongo, values, fields=None):
+        return values
+
+
+BENCHMARK_FIELD_LOGIC = BenchmarkFieldLogic(
+    EXPLORE_COLLECTION_NAME,
+    EXPLORE_IDENTIFIER_FIELD,
+    EXPLORE_IDENTITY_ORDER_FIELD,
+    EXPLORE_RESOURCE_FIELDS,
+    EXPLORE_ALLOWED_ORDER_FIELDS,
+    EXPLORE_ALLOWED_SEARCH_FIELDS,
+    EXPLORE_PAGE_SIZE_LIMIT,
+    term_fields=EXPLORE_TERM_FIELDS
+)
+
+
+def mongo_page(client, search_meta_data):
+    return BENCHMARK_FIELD_LOGIC.fetch_listing(client, search_meta_data).page
+
+
+def snapshot_page(snapshot, search_meta_data):
+    rows = EXPLORE_FIELD_LOGIC._snapshot_rows(snapshot, search_meta_data)
+    if rows is None:
+        return None
+    return EXPLORE_FIELD_LOGIC._snapshot_resources(snapshot, rows[:search_meta_data.limit], search_meta_data.fields)
+
+
+def timed(read, rounds):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        page = read()
+        timings.append(time.perf_counter() - started)
+    return timings, page
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares explore listings read from Mongo and from the catalog "
+                                                 "snapshot")
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--snapshot-dir', default=CATALOG_SNAPSHOT_DIRECTORY,
+                        required=CATALOG_SNAPSHOT_DIRECTORY is None)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    snapshot = CatalogSnapshots(args.snapshot_dir).current()
+    if snapshot is None:
+        sys.exit("no catalog snapshot in {}".format(args.snapshot_dir))
+
+    print("snapshot {} rows {} file {:.1f}MB max rss {:.1f}MB".format(
+        snapshot.version, len(snapshot), snapshot.nbytes() / 1024 / 1024,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    for (label, (filters, orders)) in LISTING_SHAPES.items():
+        search_meta_data = SearchMetaData(filters, orders, EXPLORE_PAGE_SIZE_LIMIT, None, BENCHMARK_FIELDS)
+
+        for (source, read) in (('mongo', lambda: mongo_page(client, search_meta_data)),
+                               ('snapshot', lambda: snapshot_page(snapshot, search_meta_data))):
+            (timings, page) = timed(read, args.rounds)
+            print("{:<18} {:<9} rows {:>4} median {:>9.3f}ms max {:>9.3f}ms".format(
+                label, source, 'n/a' if page is None else len(page), 1000 * statistics.median(timings),
+                1000 * max(timings)))
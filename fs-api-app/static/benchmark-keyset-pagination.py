@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import time
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.controllers.explore import EXPLORE_COLLECTION_NAME, EXPLORE_IDENTIFIER_FIELD, \
+    EXPLORE_IDENTITY_ORDER_FIELD, EXPLORE_RESOURCE_FIELDS, EXPLORE_ALLOWED_ORDER_FIELDS, \
+    EXPLORE_ALLOWED_SEARCH_FIELDS, EXPLORE_PAGE_SIZE_LIMIT
+from movieship.logic import FieldLogic, SearchMetaData, SearchOrder, OrderType, decode_cursor
+
+
+class BenchmarkFieldLogic(FieldLogic):
+    def _enhancer(self, mongo, values, fields=None):
+        return values
+
+
+BENCHMARK_FIELD_LOGIC = BenchmarkFieldLogic(
+    EXPLORE_COLLECTION_NAME,
+    EXPLORE_IDENTIFIER_FIELD,
+    EXPLORE_IDENTITY_ORDER_FIELD,
+    EXPLORE_RESOURCE_FIELDS,
+    EXPLORE_ALLOWED_ORDER_FIELDS,
+    EXPLORE_ALLOWED_SEARCH_FIELDS,
+    EXPLORE_PAGE_SIZE_LIMIT,
+)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pages through shows and reports the latency of each page")
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--order', default='startYear')
+    parser.add_argument('--report-every', type=int, default=200)
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    position = None
+    timings = []
+
+    for page in range(args.pages):
+        search_meta_data = SearchMetaData([], [SearchOrder(args.order, OrderType.ASCENDING, False)],
+                                          EXPLORE_PAGE_SIZE_LIMIT, position)
+
+        started = time.perf_counter()
+        response = BENCHMARK_FIELD_LOGIC.fetch_listing(client, search_meta_data)
+        timings.append(time.perf_counter() - started)
+
+        if (page + 1) % args.report_every == 0:
+            window = timings[-args.report_every:]
+            print("pages {:>6}-{:<6} mean {:.2f}ms max {:.2f}ms".format(
+                page + 2 - args.report_every, page + 1,
+                1000 * sum(window) / len(window), 1000 * max(window)))
+
+        if response.cursor is None:
+            break
+
+        position = decode_cursor(response.cursor.next)
@@ -0,0 +1,37 @@
+import argparse
+import os
+import sys
+import timeit
+
+from flask import Flask
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.controllers.explore import EXPLORE_FIELD_LOGIC, EXPLORE_RESOURCE_FIELDS
+from movieship.logic import CompiledQuery
+
+QUERY_STRING = 'se=titleType:movie&sil=primaryTitle:star wars&od=startYear&oa=primaryTitle&l=25'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures per-request CPU spent parsing and compiling a listing query")
+    parser.add_argument('--number', type=int, default=50_000)
+    parser.add_argument('--query', default=QUERY_STRING)
+    args = parser.parse_args()
+
+    with Flask(__name__).test_request_context('/api/v1/explore?' + args.query):
+        def parse():
+            return EXPLORE_FIELD_LOGIC.get_search_meta_data()
+
+        def uncached():
+            search_meta_data = parse()
+            return CompiledQuery(search_meta_data.shape(), EXPLORE_RESOURCE_FIELDS) \
+                .stages(search_meta_data.filter_values())
+
+        def cached():
+            search_meta_data = parse()
+            return EXPLORE_FIELD_LOGIC._compiled_queries(search_meta_data.shape()) \
+                .stages(search_meta_data.filter_values())
+
+        for (name, fn) in (('parse only', parse), ('compile per request', uncached), ('compiled shape', cached)):
+            seconds = timeit.timeit(fn, number=args.number)
+            print("{:<20} {:.2f}us/request".format(name, 1_000_000 * seconds / args.number))
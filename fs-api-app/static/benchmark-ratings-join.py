@@ -0,0 +1,103 @@
+import argparse
+import gzip
+import os
+import random
+import sys
+import tempfile
+import time
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.importer import RatingsIndex, attach_ratings, insert_batches, read_shows, read_tsv, \
+    IMPORT_BATCH_SIZE
+
+BENCHMARK_DATABASE_NAME = 'movieDB_benchmark'
+
+
+def write_dataset(directory, shows, rated_fraction):
+    basics_path = os.path.join(directory, 'title.basics.tsv.gz')
+    ratings_path = os.path.join(directory, 'title.ratings.tsv.gz')
+
+    with gzip.open(basics_path, 'wt', encoding='utf-8', compresslevel=1) as basics, \
+            gzip.open(ratings_path, 'wt', encoding='utf-8', compresslevel=1) as ratings:
+        basics.write('tconst\ttitleType\tprimaryTitle\toriginalTitle\tisAdult\tstartYear\tendYear\t'
+                     'runtimeMinutes\tgenres\n')
+        ratings.write('tconst\taverageRating\tnumVotes\n')
+
+        for number in range(1, shows + 1):
+            tconst = 'tt{:07d}'.format(number)
+            basics.write('{}\tmovie\tTitle {}\tTitle {}\t0\t{}\t\\N\t{}\tDrama,Comedy\n'.format(
+                tconst, number, number, random.randint(1900, 2023), random.randint(1, 240)))
+
+            if random.random() < rated_fraction:
+                ratings.write('{}\t{:.1f}\t{}\n'.format(tconst, random.randint(10, 100) / 10,
+                                                        random.randint(5, 2000000)))
+
+    return basics_path, ratings_path
+
+
+def hash_join(client, basics_path, ratings_path, batch_size):
+    collection = client[BENCHMARK_DATABASE_NAME]['shows_hash_join']
+    collection.drop()
+
+    started = time.perf_counter()
+    ratings = RatingsIndex.load(ratings_path)
+    insert_batches(collection, attach_ratings(read_shows(basics_path), ratings), batch_size)
+
+    return time.perf_counter() - started
+
+
+def aggregation_join(client, basics_path, ratings_path, batch_size):
+    database = client[BENCHMARK_DATABASE_NAME]
+    database['shows_lookup'].drop()
+    database['ratings'].drop()
+
+    started = time.perf_counter()
+    insert_batches(database['shows_lookup'], read_shows(basics_path), batch_size)
+    insert_batches(database['ratings'], ({
+        'tconst': row['tconst'],
+        'averageRating': float(row['averageRating']),
+        'numVotes': int(row['numVotes'])
+    } for row in read_tsv(ratings_path)), batch_size)
+    database['ratings'].create_index('tconst')
+
+    database['shows_lookup'].aggregate([{
+        '$lookup': {
+            'from': 'ratings',
+            'localField': 'tconst',
+            'foreignField': 'tconst',
+            'as': 'merged'
+        }
+    }, {
+        '$addFields': {
+            'averageRating': {'$first': '$merged.averageRating'},
+            'averageRatingVotes': {'$first': '$merged.numVotes'}
+        }
+    }, {
+        '$unset': 'merged'
+    }, {
+        '$out': 'shows_lookup'
+    }], allowDiskUse=True)
+
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the in-process ratings join with a $lookup pass")
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--shows', type=int, default=10_000_000)
+    parser.add_argument('--rated-fraction', type=float, default=0.14)
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+
+    with tempfile.TemporaryDirectory() as directory:
+        basics, ratings = write_dataset(directory, args.shows, args.rated_fraction)
+
+        print("hash join: {:.1f}s".format(hash_join(client, basics, ratings, args.batch_size)))
+        print("$lookup:   {:.1f}s".format(aggregation_join(client, basics, ratings, args.batch_size)))
+
+    client.drop_database(BENCHMARK_DATABASE_NAME)
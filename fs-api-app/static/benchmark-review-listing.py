@@ -0,0 +1,123 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.controllers.profile import PROFILE_COLLECTION_NAME
+from movieship.controllers.review import REVIEW_COLLECTION_NAME, REVIEW_IDENTIFIER_FIELD, \
+    REVIEW_FALLBACK_ORDER_FIELD, REVIEW_RESOURCE_FIELDS, REVIEW_ALLOWED_ORDER_FIELDS, \
+    REVIEW_ALLOWED_SEARCH_FIELDS, REVIEW_PAGE_SIZE_LIMIT, REVIEW_INDEXES, REVIEW_FIELD_LOGIC
+from movieship.logic import FieldLogic, PipelineModifier, SearchMetaData, SearchFilter, SearchType, \
+    decode_cursor
+
+BENCHMARK_IMDB_ID = 'tt-benchmark-reviews'
+BENCHMARK_SUB_PREFIX = 'benchmark-reviewer-'
+
+# the username join every listing page ran before the name was copied onto the review
+USERNAME_JOIN = [PipelineModifier({'username'}, [{
+    '$lookup': {
+        'from': PROFILE_COLLECTION_NAME,
+        'localField': 'user',
+        'foreignField': 'sub',
+        'as': 'result'
+    }
+}, {
+    '$set': {
+        'username': {
+            '$first': '$result.name'
+        }
+    }
+}])]
+
+
+class BenchmarkFieldLogic(FieldLogic):
+    def _enhancer(self, mongo, values, fields=None):
+        return values
+
+
+JOINED_FIELD_LOGIC = BenchmarkFieldLogic(
+    REVIEW_COLLECTION_NAME,
+    REVIEW_IDENTIFIER_FIELD,
+    REVIEW_FALLBACK_ORDER_FIELD,
+    REVIEW_RESOURCE_FIELDS,
+    REVIEW_ALLOWED_ORDER_FIELDS,
+    REVIEW_ALLOWED_SEARCH_FIELDS,
+    REVIEW_PAGE_SIZE_LIMIT,
+    pipeline_query_modifiers=USERNAME_JOIN,
+    indexes=REVIEW_INDEXES
+)
+
+
+def seed(database, reviews):
+    database[PROFILE_COLLECTION_NAME].insert_many([
+        {'sub': BENCHMARK_SUB_PREFIX + str(number), 'name': 'Reviewer {}'.format(number), 'watchlist': []}
+        for number in range(reviews)])
+    database[REVIEW_COLLECTION_NAME].insert_many([{
+        'user': BENCHMARK_SUB_PREFIX + str(number),
+        'username': 'Reviewer {}'.format(number),
+        'imdb_id': BENCHMARK_IMDB_ID,
+        'rating': random.randint(1, 10),
+        'comment': 'review {}'.format(number),
+        'timestamp': 1_600_000_000 + random.randint(0, 100_000_000)
+    } for number in range(reviews)])
+
+
+def clean(database):
+    database[PROFILE_COLLECTION_NAME].delete_many({'sub': {'$regex': '^' + BENCHMARK_SUB_PREFIX}})
+    database[REVIEW_COLLECTION_NAME].delete_many({'imdb_id': BENCHMARK_IMDB_ID})
+
+
+def page_through(client, field_logic):
+    timings = []
+    position = None
+
+    while True:
+        search_meta_data = SearchMetaData([SearchFilter('imdb_id', BENCHMARK_IMDB_ID, SearchType.EQUIVALENT)],
+                                          [REVIEW_FALLBACK_ORDER_FIELD], REVIEW_PAGE_SIZE_LIMIT, position)
+
+        started = time.perf_counter()
+        response = field_logic.fetch_listing(client, search_meta_data)
+        timings.append(time.perf_counter() - started)
+
+        if response.cursor is None or response.cursor.next is None:
+            return timings
+
+        position = decode_cursor(response.cursor.next)
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    print("{} pages {} p50 {:.2f}ms p99 {:.2f}ms".format(label, len(timings), 1000 * statistics.median(timings),
+                                                          1000 * timings[int(len(timings) * 0.99)]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pages through the reviews of one title with and without the "
+                                                 "username join")
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--reviews', type=int, default=50_000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    database = client['movieDB']
+    clean(database)
+    seed(database, args.reviews)
+
+    try:
+        joined = []
+        stored = []
+        for _ in range(args.rounds):
+            joined += page_through(client, JOINED_FIELD_LOGIC)
+            stored += page_through(client, REVIEW_FIELD_LOGIC)
+
+        report("$lookup username", joined)
+        report("stored username ", stored)
+    finally:
+        clean(database)
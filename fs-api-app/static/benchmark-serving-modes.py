@@ -0,0 +1,63 @@
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import httpx
+
+# run against `python app.py` and then `hypercorn asgi:APP`, each as a single process
+MIXED_LOAD = (
+    (4, lambda imdb_id: '/api/v1/explore?od=startYear&l={}'.format(random.randint(1, 25))),
+    (3, lambda imdb_id: '/api/v1/explore/{}'.format(imdb_id)),
+    (2, lambda imdb_id: '/api/v1/explore/{}/review/list'.format(imdb_id)),
+    (1, lambda imdb_id: '/api/v1/explore/batch?ids={}'.format(imdb_id)),
+)
+
+
+def next_path(imdb_ids):
+    weights = [weight for (weight, _) in MIXED_LOAD]
+    (_, path) = random.choices(MIXED_LOAD, weights)[0]
+    return path(random.choice(imdb_ids))
+
+
+async def worker(client, imdb_ids, deadline, timings, errors):
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            response = await client.get(next_path(imdb_ids))
+            if response.status_code >= 500:
+                errors.append(response.status_code)
+        except httpx.HTTPError as ex:
+            errors.append(type(ex).__name__)
+        timings.append(time.perf_counter() - started)
+
+
+async def run(url, concurrency, seconds, imdb_ids):
+    timings = []
+    errors = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        deadline = time.monotonic() + seconds
+        await asyncio.gather(*(worker(client, imdb_ids, deadline, timings, errors) for _ in range(concurrency)))
+
+    return timings, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drives a mixed read load against one serving mode")
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--seconds', type=int, default=30)
+    parser.add_argument('--titles', type=int, default=100_000)
+    args = parser.parse_args()
+
+    titles = ['tt{:07d}'.format(number) for number in random.sample(range(1, 10_000_000), args.titles)]
+    timings, errors = asyncio.run(run(args.url, args.concurrency, args.seconds, titles))
+    timings.sort()
+
+    print("requests {} errors {}".format(len(timings), len(errors)))
+    print("throughput {:.0f} req/s".format(len(timings) / args.seconds))
+    print("p50 {:.1f}ms p99 {:.1f}ms".format(1000 * statistics.median(timings),
+                                             1000 * timings[int(len(timings) * 0.99)]))
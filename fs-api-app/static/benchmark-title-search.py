@@ -0,0 +1,70 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.controllers.explore import EXPLORE_COLLECTION_NAME, EXPLORE_IDENTIFIER_FIELD, \
+    EXPLORE_IDENTITY_ORDER_FIELD, EXPLORE_RESOURCE_FIELDS, EXPLORE_ALLOWED_ORDER_FIELDS, \
+    EXPLORE_ALLOWED_SEARCH_FIELDS, EXPLORE_PAGE_SIZE_LIMIT, EXPLORE_TERM_FIELDS
+from movieship.logic import FieldLogic, SearchMetaData, SearchFilter, SearchType, SearchOrder, OrderType, \
+    SEARCH_SCORE_FIELD
+
+# run against a full title.basics import, the regex scans the whole collection for every query
+SEARCH_QUERIES = ('star wars', 'the godfather', 'love', 'breaking bad', 'amelie', 'x')
+
+
+class BenchmarkFieldLogic(FieldLogic):
+    def _enhancer(self, mongo, values, fields=None):
+        return values
+
+
+BENCHMARK_FIELD_LOGIC = BenchmarkFieldLogic(
+    EXPLORE_COLLECTION_NAME,
+    EXPLORE_IDENTIFIER_FIELD,
+    EXPLORE_IDENTITY_ORDER_FIELD,
+    EXPLORE_RESOURCE_FIELDS,
+    EXPLORE_ALLOWED_ORDER_FIELDS,
+    EXPLORE_ALLOWED_SEARCH_FIELDS,
+    EXPLORE_PAGE_SIZE_LIMIT,
+    term_fields=EXPLORE_TERM_FIELDS
+)
+
+SEARCH_MODES = {
+    'regex (sil before)': (SearchType.ILIKE, EXPLORE_IDENTITY_ORDER_FIELD),
+    'prefix (sp)': (SearchType.PREFIX, EXPLORE_IDENTITY_ORDER_FIELD),
+    'terms ranked (st)': (SearchType.TERMS, SearchOrder(SEARCH_SCORE_FIELD, OrderType.DESCENDING, False)),
+}
+
+
+def first_page(client, search_type, order, query, title_type):
+    filters = [SearchFilter('primaryTitle', query, search_type)]
+    if title_type:
+        filters.append(SearchFilter('titleType', title_type, SearchType.EQUIVALENT))
+
+    started = time.perf_counter()
+    response = BENCHMARK_FIELD_LOGIC.fetch_listing(client, SearchMetaData(filters, [order], EXPLORE_PAGE_SIZE_LIMIT,
+                                                                          None))
+    return time.perf_counter() - started, len(response.page)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the first page latency of the title search modes")
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--title-type', default=None)
+    parser.add_argument('queries', nargs='*', default=SEARCH_QUERIES)
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+
+    for query in args.queries:
+        for (label, (search_type, order)) in SEARCH_MODES.items():
+            runs = [first_page(client, search_type, order, query, args.title_type) for _ in range(args.rounds)]
+            timings = [timing for (timing, _) in runs]
+            print("{:<14} {:<20} rows {:>3} median {:>9.2f}ms max {:>9.2f}ms".format(
+                query, label, runs[-1][1], 1000 * statistics.median(timings), 1000 * max(timings)))
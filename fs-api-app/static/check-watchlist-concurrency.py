@@ -0,0 +1,64 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+from jose import jwt
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.controllers.profile import PROFILE_COLLECTION_NAME, add_to_watchlist, remove_from_watchlist
+
+CHECK_SUB = 'concurrency-check'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adds titles to watchlists from many threads and checks none is lost")
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--titles', type=int, default=2000)
+    parser.add_argument('--lists', type=int, default=4)
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    collection = client['movieDB'][PROFILE_COLLECTION_NAME]
+    collection.delete_one({'sub': CHECK_SUB})
+    collection.insert_one({'sub': CHECK_SUB, 'watchlist': []})
+
+    app = Flask(__name__)
+    token = jwt.encode({'sub': CHECK_SUB}, 'unused', algorithm='HS256')
+
+    def call(mutation, title, imdb_id):
+        with app.test_request_context('/', method='POST', json={'title': title, 'imdb_id': imdb_id},
+                                      headers={'Authorization': 'Bearer ' + token}):
+            mutation(client)
+
+    expected = {'list-{}'.format(number): set() for number in range(args.lists)}
+    jobs = []
+    for number in range(args.titles):
+        title = 'list-{}'.format(number % args.lists)
+        imdb_id = 'tt{:07d}'.format(number)
+        expected[title].add(imdb_id)
+        jobs.append((add_to_watchlist, title, imdb_id))
+
+        # every tenth title is added twice and removed once, racing the other writers
+        if number % 10 == 0:
+            jobs += [(add_to_watchlist, title, imdb_id), (remove_from_watchlist, title, imdb_id)]
+            expected[title].discard(imdb_id)
+
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(lambda job: call(*job), jobs))
+
+    watchlist = collection.find_one({'sub': CHECK_SUB})['watchlist']
+    actual = {entry['title']: set(entry['imdb_ids']) for entry in watchlist}
+
+    lists_ok = len(watchlist) == args.lists
+    print("lists {} (expected {})".format(len(watchlist), args.lists))
+    for (title, imdb_ids) in expected.items():
+        missing = imdb_ids - actual.get(title, set())
+        print("{} {} titles, {} missing".format(title, len(actual.get(title, set())), len(missing)))
+        lists_ok = lists_ok and not missing
+
+    collection.delete_one({'sub': CHECK_SUB})
+    sys.exit(0 if lists_ok else 1)
@@ -1,142 +1,92 @@
+import argparse
 import os
-import csv
+import sys
+from array import array
 
-import pymongo
 from pymongo import MongoClient
 
-client = MongoClient('mongodb://localhost:27017/')
-
-
-def mongo_import(collection_name, target_file):
-    os.system(
-        f'mongoimport --db movieDB --collection {collection_name} --type tsv --file {target_file} --headerline')
-
-
-def clean_movies_tsv_data():
-    movies_tsv = "./data/title.basics.tsv/data.tsv"
-    movies_tsv_clean = "./data/title.basics.tsv/data_clean.tsv"
-    with open(movies_tsv, 'r', encoding="mbcs") as fin, \
-            open(movies_tsv_clean, 'w', encoding="mbcs", newline="") as fout:
-        writer = csv.writer(fout, delimiter='\t')
-        for index, row in enumerate(csv.reader(fin, delimiter='\t')):
-            if row[4] == '0' or index == 0:
-                del row[4]
-                writer.writerow(row)
-    return movies_tsv_clean
-
-
-def aggregate_fix_movies_genre_array():
-    client['movieDB']['shows'].aggregate([
-        {
-            '$addFields': {
-                'genres': {
-                    '$split': [
-                        '$genres', ','
-                    ]
-                }
-            }
-        }, {
-            '$out': 'shows'
-        }
-    ])
-
-
-def fix_nulls():
-    client['movieDB']['shows'].update_many(
-        {"endYear": "\\N"},
-        {"$set": {
-            "endYear": None
-        }}
-    )
-    client['movieDB']['shows'].update_many(
-        {"startYear": "\\N"},
-        {"$set": {
-            "startYear": None
-        }}
-    )
-    client['movieDB']['shows'].update_many(
-        {"runtimeMinutes": "\\N"},
-        {"$set": {
-            "runtimeMinutes": None
-        }}
-    )
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.controllers.explore import EXPLORE_RESPONSE_CACHE
+from movieship.exceptions import ImportAbortedException
+from movieship.indexes import reconcile_indexes
+from movieship.importer import import_shows, refresh_shows, imdb_id, IMPORT_BATCH_SIZE, IMPORT_PARTITIONS, \
+    IMPORT_DATABASE_NAME, IMPORT_RUN_COLLECTION_NAME
+from movieship.snapshot import write_snapshot, CATALOG_SNAPSHOT_DIRECTORY
+
+MONGO_URI = 'mongodb://localhost:27017/'
+
+client = MongoClient(MONGO_URI)
 
 
 def make_index():
-    # client['movieDB']['profile'].create_index('sub', unique=True)
-    # client['movieDB']['profile'].create_index('name', unique=True)
-
-    client['movieDB']['reviews'].create_index([('user', pymongo.DESCENDING), ('imdb_id', pymongo.DESCENDING)],
-                                              unique=True)
-
-    # client['movieDB']['watchlist']
-    # .create_index([('sub', pymongo.DESCENDING), ('title', pymongo.DESCENDING)], unique=True)
-
-    client['movieDB']['watchlist'].create_index([('sub', pymongo.DESCENDING), ('title', pymongo.DESCENDING)],
-                                                unique=True)
-
-
-# // worked''
-# [
-#     {
-#         '$lookup': {
-#             'from': 'ratings',
-#             'localField': 'tconst',
-#             'foreignField': 'tconst',
-#             'as': 'merged'
-#         }
-#     }, {
-#     '$unwind': {
-#         'path': '$merged',
-#         'preserveNullAndEmptyArrays': False
-#     }
-# }, {
-#     '$addFields': {
-#         'averageRating': '$merged.averageRating',
-#         'averageRatingVotes': '$merged.numVotes'
-#     }
-# }, {
-#     '$unset': 'merged'
-# }, {
-#     '$out': 'shows'
-# }
-# ]
-
-
-#  TOO SLOW
-# def aggregate_ratings_to_movies():
-#     client['movieDB']['movies'].aggregate([
-#         {
-#             '$lookup': {
-#                 'from': 'ratings',
-#                 'localField': 'tconst',
-#                 'foreignField': 'tconst',
-#                 'as': 'ratings'
-#             }
-#         }, {
-#             '$addFields': {
-#                 'ratings': {
-#                     '$arrayElemAt': [
-#                         '$ratings', 0
-#                     ]
-#                 }
-#             }
-#         }, {
-#             '$unset': [
-#                 'ratings._id', 'ratings.tconst'
-#             ]
-#         }, {
-#             '$out': 'movies'
-#         }
-#     ])
-#     client['movieDB']['ratings'].drop()
+    # imported for their side effect, each controller declares the indexes of its collections
+    import movieship.controllers.explore  # noqa: F401
+    import movieship.controllers.profile  # noqa: F401
+    import movieship.controllers.review  # noqa: F401
+    import movieship.controllers.watchlist  # noqa: F401
+
+    for (name, result) in reconcile_indexes(client).items():
+        print(name, result)
+
+
+def publish_run():
+    """Drops the cached explore responses of the titles the last run changed in every worker, all of them
+    when the run does not know which
+    """
+    run = client[IMPORT_DATABASE_NAME][IMPORT_RUN_COLLECTION_NAME].find_one({}, sort=[('finishedAt', -1)])
+    tags = None
+
+    if run is not None and not run['rebuild']:
+        keys = array('I')
+        keys.frombytes(run['changed'])
+        keys.frombytes(run['removed'])
+        tags = {imdb_id(key) for key in keys}
+
+    EXPLORE_RESPONSE_CACHE.publish(client, tags)
 
 
 if __name__ == "__main__":
-    # clean_movies_tsv = clean_movies_tsv_data()
-    # mongo_import('movies', clean_movies_tsv)
-    # aggregate_fix_movies_genre_array()
-    # mongo_import('ratings', "./data/title.ratings.tsv/data.tsv")
-    # aggregate_ratings_to_movies()
-    # fix_nulls()
+    parser = argparse.ArgumentParser(description="Imports the IMDb dataset dumps into movieDB")
+    parser.add_argument('--basics', default="./data/title.basics.tsv.gz")
+    parser.add_argument('--ratings', default="./data/title.ratings.tsv.gz")
+    parser.add_argument('--rated-only', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument('--index-only', action='store_true')
+    parser.add_argument('--refresh', action='store_true',
+                        help="upsert only changed titles in parallel, resuming an interrupted refresh")
+    parser.add_argument('--partitions', type=int, default=IMPORT_PARTITIONS)
+    parser.add_argument('--allow-mass-delete', action='store_true',
+                        help="let a refresh remove more than a tenth of the stored titles")
+    parser.add_argument('--snapshot-dir', default=CATALOG_SNAPSHOT_DIRECTORY,
+                        help="also write the catalog snapshot the workers serve explore from")
+    parser.add_argument('--snapshot-only', action='store_true')
+    args = parser.parse_args()
+
+    if args.refresh:
+        try:
+            refresh_shows(MONGO_URI, args.basics, args.ratings, args.partitions, args.batch_size, args.rated_only,
+                          args.allow_mass_delete)
+        except ImportAbortedException as ex:
+            sys.exit("refresh aborted: {}".format(ex))
+    elif not args.index_only and not args.snapshot_only:
+        try:
+            import_shows(client, args.basics, args.ratings, args.batch_size, rated_only=args.rated_only)
+        except ImportAbortedException as ex:
+            sys.exit("import aborted: {}".format(ex))
+
     make_index()
+
+    if not args.refresh and not args.index_only and not args.snapshot_only:
+        # the shows were dropped along with the review aggregates stored on them, rebuilt once the
+        # tconst index is back so every per-title update is an index lookup
+        from movieship.controllers.review import REVIEW_AGGREGATES
+        print("rebuilt review aggregates of {} titles".format(REVIEW_AGGREGATES.rebuild(client)))
+
+    if not args.index_only and not args.snapshot_only:
+        # the workers cache ratings and votes with the responses, they would serve them until the TTL
+        publish_run()
+
+    # written last, reading the shows in tconst order needs their index
+    if args.snapshot_dir and not args.index_only:
+        write_snapshot(client[IMPORT_DATABASE_NAME], args.snapshot_dir)
@@ -0,0 +1,34 @@
+import argparse
+import os
+import sys
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from movieship.controllers.review import REVIEW_AGGREGATES
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the per-title review aggregates against the reviews, "
+                                                 "or rebuilds them from scratch")
+    parser.add_argument('command', choices=['check', 'rebuild'])
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--fix', action='store_true', help="rebuild only the titles found drifting")
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+
+    if args.command == 'rebuild':
+        print("rebuilt {} titles".format(REVIEW_AGGREGATES.rebuild(client)))
+        sys.exit(0)
+
+    drift = REVIEW_AGGREGATES.check(client)
+    for (imdb_id, stored, actual) in drift:
+        print("{} stored {} actual {}".format(imdb_id, stored, actual))
+    print("{} titles drifting".format(len(drift)))
+
+    if drift and args.fix:
+        REVIEW_AGGREGATES.rebuild(client, [imdb_id for (imdb_id, _, _) in drift])
+        print("rebuilt {} titles".format(len(drift)))
+
+    sys.exit(1 if drift and not args.fix else 0)
@@ -301,8 +301,8 @@ const buildPath = <MODEL extends object>(
 };
 
 type Cursor = {
-  next: string;
-  previous: string;
+  next: string | null;
+  previous: string | null;
 };
 
 type PageResponse<MODEL> = {
@@ -876,12 +876,12 @@ export abstract class FieldLogicComponent<MODEL extends object>
           );
 
           let pagedPath = path;
-          if (this.listingCursor && path === this.listingLastPath) {
+          if (this.listingCursor?.next && path === this.listingLastPath) {
             pagedPath += pathParamsStarted ? '&' : '?';
             pagedPath += 'p=' + this.listingCursor.next;
           }
 
-          if (this.listingLastPath == path && this.listingCursor == undefined) {
+          if (this.listingLastPath == path && !this.listingCursor?.next) {
             return;
           }
 